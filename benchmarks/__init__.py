@@ -0,0 +1 @@
+"""vse benchmarks. Run a benchmark with: python -m benchmarks.<name> --help"""
@@ -0,0 +1,60 @@
+"""Synthetic benchmark data, generated deterministically without network or image files."""
+
+import cv2
+import numpy
+
+
+def synthetic_hists(count, recognized_visual_words=1000, descriptors_per_image=300, seed=0, chunk_size=10000):
+    """Returns count x recognized_visual_words float32 matrix of normalized visual words histograms.
+    Descriptors are assigned to visual words with Zipf-like word popularity, like in real vocabularies.
+    """
+    random = numpy.random.RandomState(seed)
+    popularity = 1. / numpy.arange(1, recognized_visual_words + 1)
+    popularity = random.permutation(popularity / popularity.sum())
+    hists = numpy.empty((count, recognized_visual_words), dtype=numpy.float32)
+    for start in range(0, count, chunk_size):
+        rows = min(chunk_size, count - start)
+        words = random.choice(recognized_visual_words, size=(rows, descriptors_per_image), p=popularity)
+        words += numpy.arange(rows)[:, None] * recognized_visual_words
+        counts = numpy.bincount(words.ravel(), minlength=rows * recognized_visual_words)
+        hists[start:start + rows] = counts.reshape(rows, recognized_visual_words) / descriptors_per_image
+    return hists
+
+
+def perturbed_hists(hists, noise=0.3, seed=1):
+    """Returns copies of hists with part of their mass moved to random visual words, used as queries."""
+    random = numpy.random.RandomState(seed)
+    noise_hists = random.rand(*hists.shape).astype(numpy.float32) ** 8
+    noise_hists /= noise_hists.sum(axis=1, keepdims=True)
+    return ((1 - noise) * hists + noise * noise_hists).astype(numpy.float32)
+
+
+def synthetic_images(count, height=480, width=640, seed=0):
+    """Returns list of textured grayscale images with random shapes, which give plenty of local features."""
+    random = numpy.random.RandomState(seed)
+    images = []
+    for i in range(count):
+        image = cv2.GaussianBlur((random.rand(height, width) * 255).astype(numpy.uint8), (0, 0), 3)
+        for shape in range(30):
+            color = int(random.randint(256))
+            x, y = int(random.randint(width)), int(random.randint(height))
+            size = int(random.randint(10, 80))
+            kind = random.randint(3)
+            if kind == 0:
+                cv2.rectangle(image, (x, y), (x + size, y + size // 2), color, -1)
+            elif kind == 1:
+                cv2.circle(image, (x, y), size // 2, color, 2)
+            else:
+                cv2.putText(image, str(random.randint(1000)), (x, y), cv2.FONT_HERSHEY_SIMPLEX, size / 40, color, 2)
+        images.append(image)
+    return images
+
+
+def modified_image(image, seed=0):
+    """Returns rotated, rescaled and noisy version of image, as a near-duplicate query."""
+    random = numpy.random.RandomState(seed)
+    height, width = image.shape
+    matrix = cv2.getRotationMatrix2D((width / 2, height / 2), random.uniform(-15, 15), random.uniform(0.8, 1.2))
+    warped = cv2.warpAffine(image, matrix, (width, height), borderMode=cv2.BORDER_REFLECT)
+    noise = random.normal(scale=5, size=image.shape)
+    return numpy.clip(warped + noise, 0, 255).astype(numpy.uint8)
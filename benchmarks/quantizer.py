@@ -0,0 +1,97 @@
+"""Quantizer benchmark
+
+Compares speed of visual word assignment and its agreement with cv2.BFMatcher baseline.
+Descriptors are sampled around vocabulary words with gaussian noise, so that no images are needed.
+With --binary, a random vocabulary of binary descriptors of given length in bytes (32 for ORB) is used
+and descriptors are sampled around its words by flipping bits.
+
+    $ python -m benchmarks.quantizer --vocabulary vocabulary/vocabulary_sift_1k.dat --descriptors 100000
+    $ python -m benchmarks.quantizer --binary 32
+
+"""
+
+import argparse
+import json
+import time
+
+import numpy
+
+from vse.features import load_vocabulary
+from vse.quantizer import MatcherQuantizer, BruteForceQuantizer, FlannQuantizer, HammingQuantizer
+
+
+def synthetic_descriptors(vocabulary, count, noise=0.5, seed=0):
+    """Returns descriptors drawn around random vocabulary words."""
+    random = numpy.random.RandomState(seed)
+    words = random.randint(len(vocabulary), size=count)
+    scale = noise * vocabulary.std(axis=0)
+    return (vocabulary[words] + random.normal(size=(count, vocabulary.shape[1])) * scale).astype(numpy.float32)
+
+
+def synthetic_binary_descriptors(vocabulary, count, flip=0.1, seed=0):
+    """Returns binary descriptors drawn around random vocabulary words, every bit flipped with probability flip."""
+    random = numpy.random.RandomState(seed)
+    words = random.randint(len(vocabulary), size=count)
+    flips = numpy.packbits(random.random_sample((count, 8 * vocabulary.shape[1])) < flip, axis=1)
+    return numpy.bitwise_xor(vocabulary[words], flips)
+
+
+def measure(quantizer, descriptors, repeat=3):
+    """Returns (best time in seconds, assigned words)."""
+    best = float('inf')
+    for i in range(repeat):
+        start = time.perf_counter()
+        words = quantizer.quantize(descriptors)
+        best = min(best, time.perf_counter() - start)
+    return best, words
+
+
+def run(vocabulary, descriptors, repeat=3):
+    if vocabulary.dtype == numpy.uint8:
+        quantizers = [('BFMatcher(NORM_HAMMING)', MatcherQuantizer(vocabulary)),
+                      ('HammingQuantizer', HammingQuantizer(vocabulary))]
+    else:
+        quantizers = [('BFMatcher', MatcherQuantizer(vocabulary)),
+                      ('BruteForceQuantizer', BruteForceQuantizer(vocabulary)),
+                      ('FlannQuantizer', FlannQuantizer(vocabulary)),
+                      ('FlannQuantizer(checks=128)', FlannQuantizer(vocabulary, checks=128))]
+    measurements = [(name, measure(quantizer, descriptors, repeat)) for name, quantizer in quantizers]
+    baseline_time, baseline_words = measurements[0][1]
+    results = []
+    for name, (seconds, words) in measurements:
+        results.append({'quantizer': name,
+                        'seconds': seconds,
+                        'descriptors_per_second': len(descriptors) / seconds,
+                        'speedup': baseline_time / seconds,
+                        'agreement': float(numpy.mean(words == baseline_words))})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[2])
+    parser.add_argument('--vocabulary', default='vocabulary/vocabulary_sift_1k.dat')
+    parser.add_argument('--descriptors', type=int, default=50000)
+    parser.add_argument('--noise', type=float, default=0.5)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--binary', type=int, metavar='BYTES', help='use random binary vocabulary of 1000 words')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    if args.binary:
+        vocabulary = numpy.random.RandomState(1).randint(256, size=(1000, args.binary)).astype(numpy.uint8)
+        descriptors = synthetic_binary_descriptors(vocabulary, args.descriptors)
+    else:
+        vocabulary = numpy.asarray(load_vocabulary(args.vocabulary)[0], dtype=numpy.float32)
+        descriptors = synthetic_descriptors(vocabulary, args.descriptors, args.noise)
+    results = run(vocabulary, descriptors, args.repeat)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print('{:<28}{:>10}{:>16}{:>10}{:>11}'.format('quantizer', 'seconds', 'descriptors/s', 'speedup', 'agreement'))
+    for result in results:
+        print('{quantizer:<28}{seconds:>10.3f}{descriptors_per_second:>16.0f}{speedup:>10.2f}{agreement:>11.3f}'.format(
+            **result))
+
+
+if __name__ == '__main__':
+    main()
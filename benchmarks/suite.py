@@ -0,0 +1,287 @@
+"""Benchmark suite
+
+Measures ingest throughput, query latency, memory footprint and maintenance cost of indexes for every
+Ranker x HistComparator pair. Data is synthetic (see benchmarks.data), so the suite runs without network.
+Results are saved as JSON; compared with a baseline, the run fails if any metric regressed by more than
+the tolerance.
+
+    $ python -m benchmarks.suite --sizes 1000,10000,100000 --output results.json
+    $ python -m benchmarks.suite --baseline results.json --tolerance 0.25
+
+"""
+
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+
+import cv2
+import numpy
+
+import vse.comparator
+from vse.engine import VisualSearchEngine, BagOfVisualWords
+from vse.encoding import ENCODINGS
+from vse.features import load_vocabulary
+from vse.keypoints import KeypointBudget
+from vse.index import ForwardIndex, InvertedIndex, IVFIndex, SegmentedIndex
+from vse.ranker import SimpleRanker, WeighingRanker
+from benchmarks.data import synthetic_hists, perturbed_hists, synthetic_images, modified_image
+
+RECOGNIZED_VISUAL_WORDS = 1000
+
+COMPARATORS = [getattr(vse.comparator, name) for name in vse.comparator.__all__ if name != 'HistComparator']
+
+RANKERS = {'SimpleRanker': SimpleRanker,
+           'WeighingRanker': WeighingRanker,
+           'WeighingRanker(cache)': lambda comparator: WeighingRanker(comparator, cache_tolerance=0.05)}
+
+
+def inverted_index(ranker):
+    return InvertedIndex(ranker, RECOGNIZED_VISUAL_WORDS)
+
+
+INDEXES = {'ForwardIndex': lambda ranker: ForwardIndex(ranker),
+           'InvertedIndex': inverted_index,
+           'SegmentedIndex': lambda ranker: SegmentedIndex(ranker, inverted_index)}
+
+
+def result(benchmark, metric, value, unit, better='lower', **params):
+    """Returns result record. Its name identifies the measurement when compared with a baseline."""
+    name = '/'.join([benchmark] + ['{}={}'.format(key, params[key]) for key in sorted(params)] + [metric])
+    return dict(name=name, benchmark=benchmark, metric=metric, value=value, unit=unit, better=better, **params)
+
+
+def latencies(function, arguments):
+    """Returns seconds spent on function call for every argument."""
+    times = []
+    for argument in arguments:
+        start = time.perf_counter()
+        function(argument)
+        times.append(time.perf_counter() - start)
+    return numpy.array(times)
+
+
+def latency_results(benchmark, times, **params):
+    return [result(benchmark, 'p50', float(numpy.percentile(times, 50)) * 1e3, 'ms', **params),
+            result(benchmark, 'p99', float(numpy.percentile(times, 99)) * 1e3, 'ms', **params)]
+
+
+def build_index(index_name, ranker, hists):
+    index = INDEXES[index_name](ranker)
+    index.add_many(enumerate(hists))
+    return index
+
+
+def index_benchmark(sizes, queries, deletions):
+    """Ingest rate, memory, len, delete and find cost of every index across index sizes."""
+    results = []
+    for size in sizes:
+        hists = synthetic_hists(size, RECOGNIZED_VISUAL_WORDS)
+        query_hists = perturbed_hists(hists[:queries])
+        for index_name in INDEXES:
+            tracemalloc.start()
+            index = build_index(index_name, SimpleRanker(vse.comparator.Intersection()), hists)
+            memory = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            del index
+
+            start = time.perf_counter()
+            index = build_index(index_name, SimpleRanker(vse.comparator.Intersection()), hists)
+            ingest_time = time.perf_counter() - start
+
+            params = dict(index=index_name, size=size)
+            results.append(result('index', 'ingest', size / ingest_time, 'hists/s', 'higher', **params))
+            results.append(result('index', 'memory_per_image', memory / size, 'B', **params))
+            results.append(result('index', 'len', float(numpy.median(latencies(lambda i: len(index), range(100))))
+                                  * 1e6, 'us', **params))
+            results.extend(latency_results('index_find', latencies(lambda hist: index.find(hist, 10), query_hists),
+                                           **params))
+            deleted = numpy.random.RandomState(0).choice(size, min(deletions, size), replace=False)
+            results.append(result('index', 'delete', float(numpy.mean(latencies(index.__delitem__, deleted.tolist())))
+                                  * 1e6, 'us', **params))
+    return results
+
+
+def pairs_benchmark(size, queries):
+    """Query latency of every index x ranker x comparator combination."""
+    hists = synthetic_hists(size, RECOGNIZED_VISUAL_WORDS)
+    query_hists = perturbed_hists(hists[:queries])
+    results = []
+    for index_name in INDEXES:
+        for ranker_name, ranker_class in RANKERS.items():
+            for comparator_class in COMPARATORS:
+                index = build_index(index_name, ranker_class(comparator_class()), hists)
+                index.find(query_hists[0], 10)
+                times = latencies(lambda hist: index.find(hist, 10), query_hists)
+                results.extend(latency_results('pairs', times, index=index_name, ranker=ranker_name,
+                                               comparator=comparator_class.__name__, size=size))
+    return results
+
+
+def encoding_benchmark(sizes, queries):
+    """Memory per image, query latency and recall@10 relative to float32 of every histogram encoding."""
+    results = []
+    for size in sizes:
+        hists = synthetic_hists(size, RECOGNIZED_VISUAL_WORDS)
+        query_hists = perturbed_hists(hists[:queries])
+        expected = None
+        for encoding in ENCODINGS:
+            ranker = SimpleRanker(vse.comparator.Intersection())
+            tracemalloc.start()
+            index = InvertedIndex(ranker, RECOGNIZED_VISUAL_WORDS, encoding=encoding)
+            index.add_many(enumerate(hists))
+            memory = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            found = []
+            times = latencies(lambda hist: found.append({image_id for image_id, _ in index.find(hist, 10)}),
+                              query_hists)
+            if expected is None:
+                expected = found
+            recall = numpy.mean([len(hits & exact) / max(len(exact), 1) for hits, exact in zip(found, expected)])
+            params = dict(encoding=encoding, size=size)
+            results.append(result('encoding', 'memory_per_image', memory / size, 'B', **params))
+            results.append(result('encoding', 'recall_at_10', float(recall), '', 'higher', **params))
+            results.extend(latency_results('encoding_find', times, **params))
+    return results
+
+
+def ann_benchmark(sizes, queries, n=10):
+    """Recall@n against exact ForwardIndex and query latency of IVFIndex across nprobe, with and without
+    product quantization, for comparators mapped to L2 distance.
+    """
+    results = []
+    for size in sizes:
+        hists = synthetic_hists(size, RECOGNIZED_VISUAL_WORDS)
+        query_hists = perturbed_hists(hists[:queries])
+        lists = max(int(numpy.sqrt(size)), 1)
+        for comparator_class in (vse.comparator.Euclidean, vse.comparator.CosineAngle, vse.comparator.Hellinger):
+            exact = build_index('ForwardIndex', SimpleRanker(comparator_class()), hists)
+            expected = [{image_id for image_id, _ in exact.find(hist, n)} for hist in query_hists]
+            for pq_subspaces in (None, 50):
+                index = IVFIndex(SimpleRanker(comparator_class()), lists, pq_subspaces=pq_subspaces, seed=0)
+                index.add_many(enumerate(hists))
+                for nprobe in (1, 4, 16):
+                    index.nprobe = nprobe
+                    found = []
+                    times = latencies(lambda hist: found.append({image_id for image_id, _ in index.find(hist, n)}),
+                                      query_hists)
+                    recall = numpy.mean([len(hits & exact_hits) / max(len(exact_hits), 1)
+                                         for hits, exact_hits in zip(found, expected)])
+                    params = dict(comparator=comparator_class.__name__, nprobe=nprobe, pq=pq_subspaces or 0, size=size)
+                    results.append(result('ann', 'recall_at_{}'.format(n), float(recall), '', 'higher', **params))
+                    results.extend(latency_results('ann_find', times, **params))
+    return results
+
+
+def engine_benchmark(sizes, images, vocabulary_path):
+    """add_to_index throughput and find_similar latency of engine with SIFT features on generated images."""
+    vocabulary = load_vocabulary(vocabulary_path, 'sift')[0]
+    bag_of_visual_words = BagOfVisualWords(cv2.SIFT_create(), cv2.BFMatcher(normType=cv2.NORM_L2), vocabulary)
+    originals = synthetic_images(images)
+    queries = [modified_image(image, seed) for seed, image in enumerate(originals)]
+    results = []
+    for size in sizes:
+        filler = synthetic_hists(max(size - images, 0), len(vocabulary), seed=size)
+        for index_name in INDEXES:
+            index = INDEXES[index_name](SimpleRanker(vse.comparator.Intersection()))
+            index.add_many(('filler{}'.format(i), hist) for i, hist in enumerate(filler))
+            engine = VisualSearchEngine(index, bag_of_visual_words)
+            start = time.perf_counter()
+            for i, image in enumerate(originals):
+                engine.add_to_index(i, image)
+            params = dict(index=index_name, size=size)
+            results.append(result('engine', 'add_to_index', images / (time.perf_counter() - start), 'images/s',
+                                  'higher', **params))
+            found = []
+            times = latencies(lambda i: found.append(engine.find_similar(queries[i], 1)), range(images))
+            results.extend(latency_results('engine_find_similar', times, **params))
+            precision = numpy.mean([bool(hits) and hits[0][0] == i for i, hits in enumerate(found)])
+            results.append(result('engine', 'precision_at_1', float(precision), '', 'higher', **params))
+    return results
+
+
+def keypoints_benchmark(images, vocabulary_path, budgets=(None, 1000, 300, 100)):
+    """Histogram generation latency and precision@1 of engine with SIFT features for key point budgets."""
+    vocabulary = load_vocabulary(vocabulary_path, 'sift')[0]
+    originals = synthetic_images(images)
+    queries = [modified_image(image, seed) for seed, image in enumerate(originals)]
+    results = []
+    for budget in budgets:
+        extractor = cv2.SIFT_create()
+        keypoint_budget = KeypointBudget(budget, parameter='ContrastThreshold') if budget else None
+        bag_of_visual_words = BagOfVisualWords(extractor, cv2.BFMatcher(normType=cv2.NORM_L2), vocabulary,
+                                               keypoint_budget=keypoint_budget)
+        engine = VisualSearchEngine(InvertedIndex(SimpleRanker(vse.comparator.Intersection()), len(vocabulary)),
+                                    bag_of_visual_words)
+        times = latencies(lambda image: engine.add_to_index(len(engine.image_index), image), originals)
+        found = [engine.find_similar(query, 1) for query in queries]
+        precision = numpy.mean([bool(hits) and hits[0][0] == i for i, hits in enumerate(found)])
+        params = dict(budget=budget or 0)
+        results.extend(latency_results('keypoints_generate_hist', times, **params))
+        results.append(result('keypoints', 'precision_at_1', float(precision), '', 'higher', **params))
+    return results
+
+
+def regressions(results, baseline, tolerance):
+    """Returns list of (result, baseline result) pairs of metrics worse than baseline by more than tolerance."""
+    baseline = {record['name']: record for record in baseline}
+    failed = []
+    for record in results:
+        expected = baseline.get(record['name'])
+        if expected is None:
+            continue
+        if record['better'] == 'lower' and record['value'] > expected['value'] * (1 + tolerance):
+            failed.append((record, expected))
+        elif record['better'] == 'higher' and record['value'] < expected['value'] * (1 - tolerance):
+            failed.append((record, expected))
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[2])
+    parser.add_argument('--sizes', default='1000,10000', help='comma separated index sizes, up to 1000000')
+    parser.add_argument('--pair-size', type=int, default=10000, help='index size of ranker x comparator benchmark')
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--deletions', type=int, default=100)
+    parser.add_argument('--images', type=int, default=20, help='number of generated images for engine benchmark')
+    parser.add_argument('--vocabulary', default='vocabulary/vocabulary_sift_1k.dat')
+    parser.add_argument('--skip', default='', help='comma separated benchmarks to skip: index, pairs, encoding, ann, engine, keypoints')
+    parser.add_argument('--output', help='save results to JSON file')
+    parser.add_argument('--baseline', help='JSON results to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed relative regression')
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    skip = set(args.skip.split(','))
+    results = []
+    if 'index' not in skip:
+        results.extend(index_benchmark(sizes, args.queries, args.deletions))
+    if 'pairs' not in skip:
+        results.extend(pairs_benchmark(args.pair_size, args.queries))
+    if 'encoding' not in skip:
+        results.extend(encoding_benchmark(sizes, args.queries))
+    if 'ann' not in skip:
+        results.extend(ann_benchmark(sizes, args.queries))
+    if 'engine' not in skip:
+        results.extend(engine_benchmark(sizes, args.images, args.vocabulary))
+    if 'keypoints' not in skip:
+        results.extend(keypoints_benchmark(args.images, args.vocabulary))
+
+    for record in results:
+        print('{name:<90} {value:>14.3f} {unit}'.format(**record))
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            failed = regressions(results, json.load(file), args.tolerance)
+        for record, expected in failed:
+            print('REGRESSION {}: {:.3f} {} (baseline {:.3f})'.format(record['name'], record['value'],
+                                                                     record['unit'], expected['value']))
+        if failed:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
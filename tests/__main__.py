@@ -1,9 +1,23 @@
 """Run all tests"""
 
 import unittest
-from .comparator_test import ComparatorTest
+from .aio_test import AsyncVisualSearchEngineTest
+from .cache_test import HistCacheTest
+from .comparator_test import ComparatorTest, CompareManyTest
+from .dedup_test import NearDuplicatesTest
+from .encoding_test import EncodingTest
 from .engine_test import VisualSearchEngineTest, BagOfVisualWordsTest
+from .features_test import FeaturesTest
+from .index_test import ConcurrentIndexTest, ForwardIndexTest, InvertedIndexTest, IVFIndexTest, \
+    PrunedInvertedIndexTest, SegmentedIndexTest, VisualWordStatsTest, WeightedCacheTest
+from .instrument_test import InstrumentationTest
+from .keypoints_test import KeypointBudgetTest
+from .quantizer_test import QuantizerTest, HammingQuantizerTest
+from .shard_test import ShardedIndexTest
+from .storage_test import StorageTest
 from .utils_test import UtilityTest
+from .verify_test import GeometricVerifierTest
+from .vocabulary_test import VocabularyTreeTest, MiniBatchKMeansTest, KMajorityTest
 
 
 if __name__ == '__main__':
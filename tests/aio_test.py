@@ -0,0 +1,55 @@
+import asyncio
+import numpy
+import unittest
+from unittest.mock import Mock
+
+from vse import *
+
+
+class AsyncVisualSearchEngineTest(unittest.TestCase):
+    def setUp(self):
+        self.bovw = Mock()
+        self.bovw.generate_hist = Mock(side_effect=lambda image: numpy.asarray(image, dtype=numpy.float32))
+        self.image_index = ForwardIndex(SimpleRanker(Euclidean()))
+        self.engine = AsyncVisualSearchEngine(VisualSearchEngine(self.image_index, self.bovw), batch_size=4)
+
+    def run_async(self, coroutine):
+        return asyncio.new_event_loop().run_until_complete(coroutine)
+
+    def test_should_add_and_find_similar(self):
+
+        async def scenario():
+            await asyncio.gather(*(self.engine.aadd_to_index(i, [i * i, 0, 1]) for i in range(5)))
+            return await self.engine.afind_similar([9, 0, 1], 2)
+
+        results = self.run_async(scenario())
+
+        self.assertEqual([image_id for image_id, _ in results], [3, 2])
+        self.assertEqual(self.engine.timings.summary()['add']['count'], 5)
+
+    def test_should_rank_concurrent_queries_in_batches(self):
+        self.image_index.add_many((i, numpy.array([i, 0, 1], dtype=numpy.float32)) for i in range(5))
+        self.image_index.find_many = Mock(wraps=self.image_index.find_many)
+        self.engine.batch_delay = 60
+
+        async def scenario():
+            return await asyncio.gather(*(self.engine.afind_similar([i, 0, 1], 1 + i % 2) for i in range(8)))
+
+        results = self.run_async(scenario())
+
+        self.assertEqual([result[0][0] for result in results], list(range(5)) + [4, 4, 4])
+        self.assertEqual([len(result) for result in results], [1, 2] * 4)
+        self.assertEqual(self.image_index.find_many.call_count, 2)
+        self.assertEqual(self.engine._tasks, set())
+
+    def test_should_remove_from_index(self):
+        self.image_index.add_many((i, numpy.array([i, 0, 1], dtype=numpy.float32)) for i in range(5))
+
+        self.run_async(self.engine.aremove_from_index(3))
+
+        self.assertEqual(len(self.image_index), 4)
+
+    def test_should_raise_ranking_error(self):
+        self.image_index.find_many = Mock(side_effect=ValueError)
+
+        self.assertRaises(ValueError, self.run_async, self.engine.afind_similar([1, 0, 1]))
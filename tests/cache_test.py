@@ -0,0 +1,81 @@
+import cv2
+import os
+import numpy
+import tempfile
+import unittest
+from unittest.mock import Mock, patch
+
+from vse.cache import *
+
+
+class HistCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.hist = numpy.arange(4, dtype=numpy.float32)
+        self.cache = HistCache(max_size=2)
+
+    def test_should_count_hits_and_misses(self):
+        self.assertIsNone(self.cache.get('a'))
+        self.cache.put('a', self.hist)
+
+        self.assertIs(self.cache.get('a'), self.hist)
+        self.assertEqual((self.cache.hits, self.cache.misses, self.cache.hit_rate), (1, 1, 0.5))
+
+    def test_should_evict_least_recently_used(self):
+        self.cache.put('a', self.hist)
+        self.cache.put('b', self.hist)
+        self.cache.get('a')
+        self.cache.put('c', self.hist)
+
+        self.assertEqual(list(self.cache.entries), ['a', 'c'])
+
+    @patch('vse.cache.time.monotonic')
+    def test_should_expire_entries(self, monotonic_mock):
+        cache = HistCache(ttl=10)
+        monotonic_mock.return_value = 100
+        cache.put('a', self.hist)
+        monotonic_mock.return_value = 111
+
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 0)
+
+    def test_should_generate_hist_once(self):
+        generate_hist = Mock(return_value=self.hist)
+        image = b'encoded image'
+
+        self.cache.get_or_generate(image, generate_hist)
+        hist = self.cache.get_or_generate(bytearray(image), generate_hist)
+
+        generate_hist.assert_called_once_with(image)
+        self.assertIs(hist, self.hist)
+
+    def test_should_distinguish_image_shapes(self):
+        image = numpy.zeros((4, 6), dtype=numpy.uint8)
+
+        self.assertEqual(image_key(image), image_key(image.copy()))
+        self.assertNotEqual(image_key(image), image_key(image.reshape(6, 4)))
+
+    def test_should_read_hist_from_store(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with ShelveHistStore(os.path.join(directory, 'hists')) as store:
+                HistCache(store=store).put('a', self.hist)
+                cache = HistCache(store=store)
+
+                numpy.testing.assert_array_equal(cache.get('a'), self.hist)
+                self.assertEqual((cache.hits, len(cache)), (1, 1))
+
+    def test_should_not_share_hists_of_other_configuration(self):
+        generate_hist = Mock(return_value=self.hist)
+        self.cache.get_or_generate(b'encoded image', generate_hist, 'vocabulary a')
+        self.cache.get_or_generate(b'encoded image', generate_hist, 'vocabulary b')
+
+        self.assertEqual(generate_hist.call_count, 2)
+
+    def test_should_fingerprint_vocabulary_and_extractor_parameters(self):
+        vocabulary = numpy.zeros((10, 32), dtype=numpy.uint8)
+        fingerprint = configuration_fingerprint(vocabulary, cv2.ORB_create())
+
+        self.assertEqual(configuration_fingerprint(vocabulary.copy(), cv2.ORB_create()), fingerprint)
+        self.assertNotEqual(configuration_fingerprint(vocabulary[:9], cv2.ORB_create()), fingerprint)
+        self.assertNotEqual(configuration_fingerprint(vocabulary, cv2.ORB_create(fastThreshold=10)), fingerprint)
+        self.assertNotEqual(configuration_fingerprint(vocabulary, cv2.BRISK_create()), fingerprint)
+        self.assertNotEqual(configuration_fingerprint(vocabulary, cv2.ORB_create(), 'FlannQuantizer'), fingerprint)
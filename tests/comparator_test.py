@@ -1,4 +1,5 @@
 import cv2
+import numpy
 import unittest
 from unittest.mock import Mock, patch, call
 from vse.comparator import *
@@ -110,3 +111,51 @@ class ComparatorTest(unittest.TestCase):
 
         self.assertEqual(unit_vector_mock.mock_calls, [call(hist1), call(hist2)])
         dot_mock.assert_called_with(unit_v_mock, unit_v_mock)
+
+
+class CompareManyTest(unittest.TestCase):
+    def setUp(self):
+        random = numpy.random.RandomState(0)
+        self.matrix = random.rand(20, 100).astype(numpy.float32)
+        self.matrix[self.matrix < 0.6] = 0
+        self.matrix /= self.matrix.sum(axis=1, keepdims=True)
+        self.query = self.matrix[0].copy()
+        self.query[:10] = 0
+
+    def assert_same_as_compare(self, comparator):
+        expected = [comparator.compare(row, self.query) for row in self.matrix]
+        numpy.testing.assert_allclose(comparator.compare_many(self.query, self.matrix), expected, rtol=1e-5, atol=1e-7)
+        self.assert_same_as_compare_many(comparator)
+
+    def assert_same_as_compare_many(self, comparator):
+        queries = numpy.array([self.query, self.matrix[3], self.matrix[5] + 0.01], dtype=numpy.float32)
+        expected = [comparator.compare_many(query, self.matrix) for query in queries]
+        numpy.testing.assert_allclose(comparator.compare_many_queries(queries, self.matrix), expected, rtol=1e-5,
+                                      atol=1e-7)
+
+    def test_should_compare_many_with_correlation(self):
+        self.assert_same_as_compare(Correlation())
+
+    def test_should_compare_many_with_chi_squared(self):
+        self.assert_same_as_compare(ChiSquared())
+
+    def test_should_compare_many_with_intersection(self):
+        self.assert_same_as_compare(Intersection())
+
+    def test_should_compare_many_with_hellinger(self):
+        self.assert_same_as_compare(Hellinger())
+
+    def test_should_compare_many_with_bhattacharyya(self):
+        self.assert_same_as_compare(Bhattacharyya())
+
+    def test_should_compare_many_with_chi_squared_alt(self):
+        self.assert_same_as_compare(ChiSquaredAlt())
+
+    def test_should_compare_many_with_kullback_leibler(self):
+        self.assert_same_as_compare(KullbackLeibler())
+
+    def test_should_compare_many_with_euclidean(self):
+        self.assert_same_as_compare(Euclidean())
+
+    def test_should_compare_many_with_cosine_angle(self):
+        self.assert_same_as_compare(CosineAngle())
@@ -0,0 +1,118 @@
+import numpy
+import pickle
+import tempfile
+import unittest
+
+from vse import *
+
+
+class NearDuplicatesTest(unittest.TestCase):
+    def setUp(self):
+        random = numpy.random.RandomState(0)
+        hists = random.rand(30, 40).astype(numpy.float32)
+        hists[hists < 0.7] = 0
+        hists[10:20] = hists[:10] * (1 + 0.05 * random.rand(10, 40))
+        self.hists = hists / hists.sum(axis=1, keepdims=True)
+        self.index = ForwardIndex(SimpleRanker(Intersection()))
+        self.index.add_many(('image{}'.format(i), hist) for i, hist in enumerate(self.hists))
+
+    def brute_force(self, threshold):
+        comparator = self.index.ranker.hist_comparator
+        pairs = set()
+        for a in range(len(self.hists)):
+            for b in range(a + 1, len(self.hists)):
+                score = comparator.compare(self.hists[b], self.hists[a])
+                if (score >= threshold) if comparator.reversed else (score <= threshold):
+                    pairs.add(('image{}'.format(a), 'image{}'.format(b)))
+        return pairs
+
+    def pairs(self, chunks):
+        return {(image_id_a, image_id_b) for chunk in chunks for image_id_a, image_id_b, score in chunk}
+
+    def test_should_find_near_duplicates(self):
+        chunks = list(near_duplicates(self.index, 0.9, block_size=7, processes=0))
+
+        self.assertEqual(len(chunks), 5)
+        self.assertEqual(self.pairs(chunks), self.brute_force(0.9))
+        self.assertEqual(self.pairs(chunks), {('image{}'.format(i), 'image{}'.format(i + 10)) for i in range(10)})
+
+    def test_should_pass_threshold_of_distance_comparator(self):
+        self.index.ranker = SimpleRanker(Hellinger())
+
+        chunks = near_duplicates(self.index, 0.5, block_size=4, processes=0)
+
+        self.assertEqual(self.pairs(chunks), self.brute_force(0.5))
+
+    def test_should_prune_pairs_not_sharing_visual_words(self):
+        chunks = list(near_duplicates(self.index, 0.3, block_size=8, cutoff=2.0, processes=0))
+
+        self.assertEqual(self.pairs(chunks), self.brute_force(0.3))
+
+    def test_should_join_in_processes(self):
+        expected = list(near_duplicates(self.index, 0.5, block_size=6, processes=0))
+
+        self.assertEqual(list(near_duplicates(self.index, 0.5, block_size=6, processes=2, max_in_flight=2)), expected)
+
+    def test_should_prune_pairs_in_processes(self):
+        expected = list(near_duplicates(self.index, 0.3, block_size=6, cutoff=2.0, processes=0))
+
+        self.assertEqual(list(near_duplicates(self.index, 0.3, block_size=6, cutoff=2.0, processes=2)), expected)
+
+    def test_should_pickle_shared_join_without_arrays(self):
+        join = SelfJoin(self.hists, self.index.ranker, self.index.vw_freq, 0.3, 8, cutoff=2.0)
+        expected = join.block(0, 8)
+        with tempfile.TemporaryDirectory() as directory:
+            join.share(directory)
+            pickled = pickle.dumps(join)
+
+            self.assertLess(len(pickled), self.hists.nbytes // 4)
+            for array, expected_array in zip(pickle.loads(pickled).block(0, 8), expected):
+                numpy.testing.assert_array_equal(array, expected_array)
+
+    def test_should_build_join_from_items_in_mapped_files(self):
+        expected = SelfJoin(self.hists, self.index.ranker, self.index.vw_freq, 0.3, 8, cutoff=2.0)
+        with tempfile.TemporaryDirectory() as directory:
+            join, image_ids = SelfJoin.from_items(self.index.iter_items(), self.index.ranker, self.index.vw_freq, 0.3,
+                                                  directory, 8, cutoff=2.0)
+
+            self.assertEqual(image_ids, ['image{}'.format(i) for i in range(30)])
+            for name in SelfJoin.arrays:
+                self.assertIsInstance(getattr(join, name), numpy.memmap)
+                numpy.testing.assert_array_equal(getattr(join, name), getattr(expected, name))
+
+    def test_should_join_concurrent_index(self):
+        index = ConcurrentIndex(SimpleRanker(Intersection()), merge_threshold=8)
+        index.add_many(('image{}'.format(i), hist) for i, hist in enumerate(self.hists[:25]))
+        index.add_many(('image{}'.format(i), hist) for i, hist in enumerate(self.hists[25:], 25))
+        del index['image12']
+
+        chunks = near_duplicates(index, 0.9, block_size=7, processes=0)
+
+        self.assertEqual(self.pairs(chunks), self.brute_force(0.9) - {('image2', 'image12')})
+
+    def test_should_weigh_queries_with_not_vectorized_function(self):
+        def weigh_largest_words(hist, freq_vector):
+            return hist * (hist >= hist.max() / 2)
+
+        self.index.ranker = WeighingRanker(CosineAngle(), weigh_largest_words, weigh_largest_words)
+        self.index['copy'] = self.hists[0]
+
+        chunks = list(near_duplicates(self.index, 0.999, block_size=7, processes=0))
+
+        self.assertIn(('image0', 'copy'), self.pairs(chunks))
+        for image_id_a, image_id_b, score in (pair for chunk in chunks for pair in chunk):
+            found = dict(self.index.find(self.index[image_id_b], len(self.index)))
+            self.assertAlmostEqual(score, found[image_id_a], places=5)
+
+    def test_should_join_with_tfidf_weighing_ranker(self):
+        self.index.ranker = WeighingRanker(Intersection())
+
+        chunks = list(near_duplicates(self.index, 0.9, block_size=7, processes=0))
+
+        for image_id_a, image_id_b, score in (pair for chunk in chunks for pair in chunk):
+            found = dict(self.index.find(self.index[image_id_b], len(self.index)))
+            self.assertAlmostEqual(score, found[image_id_a], places=5)
+        self.assertIn(('image0', 'image10'), self.pairs(chunks))
+
+    def test_should_not_find_duplicates_in_empty_index(self):
+        self.assertEqual(list(near_duplicates(ForwardIndex(SimpleRanker(Intersection())), 0.5)), [])
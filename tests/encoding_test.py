@@ -0,0 +1,127 @@
+import functools
+import numpy
+import pickle
+import unittest
+
+from vse import *
+
+
+class EncodingTest(unittest.TestCase):
+    def setUp(self):
+        random = numpy.random.RandomState(0)
+        self.hists = random.rand(40, 50).astype(numpy.float32)
+        self.hists[self.hists < 0.7] = 0
+        self.hists /= self.hists.sum(axis=1, keepdims=True)
+
+    def create_matrix(self, encoding):
+        matrix = create_hist_matrix(encoding)
+        matrix.initial_capacity = 8
+        for hist in self.hists:
+            matrix.append(hist)
+        return matrix
+
+    def assert_decoded(self, matrix, hists, encoding):
+        tolerance = {'float32': 0, 'float16': 1e-3, 'uint8': 2e-3, 'sparse': 0}[encoding]
+        numpy.testing.assert_allclose(numpy.asarray(matrix.view()), hists, atol=tolerance)
+        for row, hist in enumerate(hists):
+            numpy.testing.assert_allclose(matrix[row], hist, atol=tolerance)
+
+    def test_should_decode_rows(self):
+        for encoding in ENCODINGS:
+            self.assert_decoded(self.create_matrix(encoding), self.hists, encoding)
+
+    def test_should_move_overwrite_and_truncate_rows(self):
+        expected = self.hists.copy()
+        expected[3] = expected[39]
+        expected[5] = expected[0]
+        for encoding in ENCODINGS:
+            matrix = self.create_matrix(encoding)
+
+            matrix.move(39, 3)
+            matrix.truncate(39)
+            matrix[5] = self.hists[0]
+
+            self.assert_decoded(matrix, expected[:39], encoding)
+
+    def test_should_compact_sparse_rows(self):
+        matrix = self.create_matrix('sparse')
+        for i in range(100):
+            matrix[i % 40] = self.hists[(i + 1) % 40]
+
+        self.assertLessEqual(len(matrix.values), 4 * numpy.count_nonzero(self.hists))
+        self.assert_decoded(matrix, numpy.roll(self.hists, -1, axis=0), 'sparse')
+        self.assert_decoded(pickle.loads(pickle.dumps(matrix)), numpy.roll(self.hists, -1, axis=0), 'sparse')
+
+    def test_should_compare_encoded_rows_like_decoded_rows(self):
+        query = self.hists[7] + 0.01
+        rows = numpy.array([1, 7, 20, 33])
+        for encoding in ('uint8', 'sparse'):
+            view = self.create_matrix(encoding).view()
+            for comparator_class in (Correlation, Intersection, Hellinger, Bhattacharyya, ChiSquared, Euclidean,
+                                     CosineAngle):
+                comparator = comparator_class()
+                expected = comparator.compare_many(query, numpy.asarray(view))
+
+                numpy.testing.assert_allclose(comparator.compare_many(query, view), expected, rtol=1e-5, atol=1e-6)
+                numpy.testing.assert_allclose(comparator.compare_many(query, view[rows]), expected[rows], rtol=1e-5,
+                                              atol=1e-6)
+
+    def test_should_find_same_results_with_every_encoding(self):
+        for encoding in ENCODINGS:
+            for index in (ForwardIndex(SimpleRanker(Intersection()), encoding),
+                          InvertedIndex(WeighingRanker(CosineAngle()), 50, cutoff=0, encoding=encoding)):
+                index.add_many(enumerate(self.hists))
+                del index[3]
+
+                results = index.find(self.hists[8], 3)
+
+                self.assertEqual(len(index), 39)
+                self.assertEqual(results[0][0], 8)
+
+    def test_should_not_keep_rejected_rows(self):
+        for encoding in ENCODINGS:
+            matrix = self.create_matrix(encoding)
+
+            self.assertRaises(ValueError, matrix.append, numpy.ones(40))
+            self.assertRaises(ValueError, matrix.__setitem__, 3, numpy.ones(40))
+
+            self.assertEqual(len(matrix), 40)
+            self.assert_decoded(matrix, self.hists, encoding)
+
+    def test_should_find_after_rejected_hist(self):
+        for encoding in ENCODINGS:
+            index = ForwardIndex(SimpleRanker(Intersection()), encoding)
+            index.add_many(enumerate(self.hists[:5]))
+
+            self.assertRaises(ValueError, index.__setitem__, 'bad', numpy.ones(40))
+
+            self.assertEqual(len(index.hists), 5)
+            self.assertEqual(index.find(self.hists[2], 1)[0][0], 2)
+
+    def test_should_withdraw_stored_hists_from_stats(self):
+        hists = numpy.random.RandomState(1).rand(100, 50).astype(numpy.float32) ** 4
+        hists /= hists.sum(axis=1, keepdims=True)
+        for encoding in ('float16', 'uint8', 'sparse'):
+            factory = functools.partial(ForwardIndex, encoding=encoding)
+            indexes = (factory(SimpleRanker(Intersection())),
+                       InvertedIndex(WeighingRanker(CosineAngle()), 50, cutoff=0, encoding=encoding),
+                       SegmentedIndex(SimpleRanker(Intersection()), factory, segment_size=8, merge_factor=2,
+                                      background=False),
+                       ShardedIndex(SimpleRanker(Intersection()), 2, factory))
+            for index in indexes:
+                for image_id, hist in enumerate(hists[:50]):
+                    index[image_id] = hist
+                index.add_many(enumerate(hists[50:], 50))
+                for image_id in range(0, 100, 2):
+                    del index[image_id]
+                expected = factory(SimpleRanker(Intersection()))
+                expected.add_many((image_id, index[image_id]) for image_id in range(1, 100, 2))
+
+                numpy.testing.assert_array_equal(index.stats.doc_freq, expected.stats.doc_freq)
+                numpy.testing.assert_allclose(index.idf, expected.idf, rtol=1e-6)
+                numpy.testing.assert_allclose(index.vw_freq, expected.vw_freq, rtol=1e-4, atol=1e-7)
+                if isinstance(index, ShardedIndex):
+                    index.close()
+
+    def test_should_not_create_unknown_encoding(self):
+        self.assertRaises(ValueError, create_hist_matrix, 'int4')
@@ -1,13 +1,20 @@
+import numpy
 import unittest
 from unittest.mock import Mock, patch
 
-from vse import VisualSearchEngine, BagOfVisualWords
+from vse import *
+
+
+class FakeBagOfVisualWords:
+    def generate_hist(self, image):
+        return numpy.asarray(image, dtype=numpy.float32) / numpy.sum(image)
 
 
 class VisualSearchEngineTest(unittest.TestCase):
     def setUp(self):
         self.image_index = Mock()
         self.bovw = Mock()
+        self.bovw.fingerprint = 'bag of visual words'
         self.hist = Mock()
         self.bovw.generate_hist = Mock(return_value=self.hist)
         self.engine = VisualSearchEngine(self.image_index, self.bovw)
@@ -53,6 +60,134 @@ class VisualSearchEngineTest(unittest.TestCase):
         self.image_index.find.assert_called_with(self.hist, n)
         self.assertEqual(similar_image, result)
 
+    def test_should_add_many_images(self):
+        images = [('image1', Mock()), ('image2', Mock())]
+        self.image_index.add_many = Mock(return_value=[])
+
+        errors = self.engine.add_many(images)
+
+        self.assertEqual(errors, [])
+        self.image_index.add_many.assert_called_with([('image1', self.hist), ('image2', self.hist)])
+
+    def test_should_report_add_many_errors_in_order(self):
+        size_error = ImageSizeError('image2')
+        duplicate_error = DuplicatedImageError('image1')
+        self.bovw.generate_hist.side_effect = [self.hist, size_error, self.hist]
+        self.image_index.add_many = Mock(return_value=[('image1', duplicate_error)])
+        progress = Mock()
+
+        errors = self.engine.add_many([('image1', Mock()), ('image2', Mock()), ('image3', Mock())], progress=progress)
+
+        self.assertEqual(errors, [('image1', duplicate_error), ('image2', size_error)])
+        self.assertEqual(progress.call_args[0][:2], (3, 2))
+
+    def test_should_keep_features_of_stored_image_with_repeated_id(self):
+        hist = numpy.array([1, 0, 1], dtype=numpy.float32)
+        stored, repeated, other = Mock(), Mock(), Mock()
+        self.bovw.generate_features = Mock(side_effect=[(hist, stored), (hist, repeated), (hist, other)])
+        verifier = Mock(top_k=10, features={})
+        engine = VisualSearchEngine(ForwardIndex(SimpleRanker(Intersection())), self.bovw, verifier=verifier)
+
+        errors = engine.add_many([('image1', Mock()), ('image1', Mock()), ('image2', Mock())], processes=0)
+
+        self.assertEqual([image_id for image_id, error in errors], ['image1'])
+        self.assertEqual(verifier.features, {'image1': stored, 'image2': other})
+
+    def test_should_add_many_images_in_processes(self):
+        engine = VisualSearchEngine(ForwardIndex(SimpleRanker(Intersection())), FakeBagOfVisualWords(),
+                                    FakeBagOfVisualWords)
+        images = [(i, numpy.arange(1, 5) * (i + 1)) for i in range(10)]
+
+        errors = engine.add_many(images + [(3, numpy.arange(1, 5))], processes=2, max_in_flight=3, batch_size=4)
+
+        self.assertEqual(len(engine.image_index), 10)
+        self.assertEqual([(image_id, type(error)) for image_id, error in errors], [(3, DuplicatedImageError)])
+        numpy.testing.assert_allclose(engine.image_index.vw_freq, numpy.arange(1, 5) / 10)
+
+    def test_should_find_similar_many_like_find_similar(self):
+        engine = VisualSearchEngine(InvertedIndex(SimpleRanker(CosineAngle()), 4, cutoff=0), FakeBagOfVisualWords(),
+                                    FakeBagOfVisualWords)
+        images = numpy.random.RandomState(0).randint(1, 100, (13, 4))
+        engine.add_many(enumerate(images[:10]), processes=0)
+        queries = list(images[10:])
+
+        expected = [engine.find_similar(query, 3) for query in queries]
+
+        for processes in (0, 2):
+            results = engine.find_similar_many(queries, 3, processes=processes)
+            self.assertEqual([[image_id for image_id, _ in similar] for similar in results],
+                             [[image_id for image_id, _ in similar] for similar in expected])
+            numpy.testing.assert_allclose([[score for _, score in similar] for similar in results],
+                                          [[score for _, score in similar] for similar in expected])
+
+    def test_should_not_find_similar_many_if_any_image_fails(self):
+        self.bovw.generate_hist = Mock(side_effect=[self.hist, ImageLoaderError()])
+        self.image_index.find_many = Mock()
+
+        self.assertRaises(ImageLoaderError, self.engine.find_similar_many, [Mock(), Mock()], processes=0)
+        self.image_index.find_many.assert_not_called()
+
+    def test_should_not_generate_cached_hist_again(self):
+        self.engine.hist_cache = HistCache()
+        self.image_index.find = Mock()
+        image = numpy.zeros((4, 6), dtype=numpy.uint8)
+
+        self.engine.find_similar(image)
+        self.engine.find_similar(image)
+
+        self.bovw.generate_hist.assert_called_once()
+        self.image_index.find.assert_called_with(self.hist, 1)
+        self.assertEqual(self.engine.hist_cache.hits, 1)
+
+    def test_should_use_cache_when_adding_many_images_in_processes(self):
+        hist_cache = HistCache()
+        engine = VisualSearchEngine(ForwardIndex(SimpleRanker(Intersection())), FakeBagOfVisualWords(),
+                                    FakeBagOfVisualWords, hist_cache)
+        image = numpy.arange(1, 5)
+
+        engine.add_many([(0, image), (1, image)], processes=1)
+
+        self.assertEqual((hist_cache.hits, hist_cache.misses), (0, 2))
+        engine.add_many([(2, image)], processes=1)
+        self.assertEqual(hist_cache.hits, 1)
+
+    def test_should_not_add_missing_file_with_cache(self):
+        self.engine.hist_cache = HistCache()
+
+        self.assertRaises(ImageLoaderError, self.engine.add_to_index, 'image', '/nonexistent.jpg')
+        self.bovw.generate_hist.assert_not_called()
+
+    def test_should_report_missing_file_with_cache_in_add_many(self):
+        engine = VisualSearchEngine(ForwardIndex(SimpleRanker(Intersection())), FakeBagOfVisualWords(),
+                                    FakeBagOfVisualWords, HistCache())
+        images = [(0, numpy.arange(1, 5)), (1, '/nonexistent.jpg'), (2, numpy.arange(2, 6))]
+
+        for processes in (0, 1):
+            engine.image_index = ForwardIndex(SimpleRanker(Intersection()))
+            errors = engine.add_many(images, processes=processes)
+
+            self.assertEqual([(image_id, type(error)) for image_id, error in errors], [(1, ImageLoaderError)])
+            self.assertEqual(len(engine.image_index), 2)
+
+    def test_should_verify_similar_images_geometrically(self):
+        features = Mock()
+        self.bovw.generate_features = Mock(return_value=(self.hist, features))
+        verifier = Mock(top_k=10, features={})
+        verifier.verify = Mock(return_value=[('b', 0.2), ('a', 0.1), ('c', 0.3)])
+        self.image_index.find = Mock(return_value=[('a', 0.1), ('b', 0.2), ('c', 0.3)])
+        self.image_index.__setitem__ = Mock()
+        self.image_index.__delitem__ = Mock()
+        engine = VisualSearchEngine(self.image_index, self.bovw, verifier=verifier)
+
+        engine.add_to_index('a', Mock())
+        similar_images = engine.find_similar(Mock(), 2)
+        engine.remove_from_index('a')
+
+        self.image_index.find.assert_called_with(self.hist, 10)
+        verifier.verify.assert_called_with(features, [('a', 0.1), ('b', 0.2), ('c', 0.3)])
+        self.assertEqual(similar_images, [('b', 0.2), ('a', 0.1)])
+        self.assertEqual(verifier.features, {})
+
 
 class BagOfVisualWordsTest(unittest.TestCase):
     def setUp(self):
@@ -90,3 +225,35 @@ class BagOfVisualWordsTest(unittest.TestCase):
         self.extractor.detect.assert_called_with(image)
         extract_bow.compute.assert_called_with(image, self.key_points)
         self.assertEqual(result, hist)
+
+    def test_should_generate_hist_with_quantizer(self):
+        descriptors = Mock()
+        self.extractor.compute = Mock(return_value=(self.key_points, descriptors))
+        quantizer = Mock()
+        quantizer.quantize = Mock(return_value=numpy.array([0, 1, 1, 3]))
+        quantizer.__len__ = Mock(return_value=4)
+        image = Mock()
+
+        bovw = BagOfVisualWords(self.extractor, self.matcher, self.vocabulary, quantizer)
+        result = bovw.generate_hist(image)
+
+        self.extractor.detect.assert_called_with(image)
+        self.extractor.compute.assert_called_with(image, self.key_points)
+        quantizer.quantize.assert_called_with(descriptors)
+        numpy.testing.assert_array_equal(result, [0.25, 0.5, 0, 0.25])
+
+    def test_should_generate_features(self):
+        key_points = [Mock(pt=(1.4, 2.6)), Mock(pt=(10.5, 3)), Mock(pt=(7, 8))]
+        self.extractor.compute = Mock(return_value=(key_points, Mock()))
+        quantizer = Mock()
+        quantizer.quantize = Mock(return_value=numpy.array([0, 3, 3]))
+        quantizer.__len__ = Mock(return_value=4)
+
+        bovw = BagOfVisualWords(self.extractor, self.matcher, self.vocabulary, quantizer)
+        hist, features = bovw.generate_features(Mock())
+
+        numpy.testing.assert_allclose(hist, [1 / 3, 0, 0, 2 / 3])
+        numpy.testing.assert_array_equal(features.points, [[1, 3], [10, 3], [7, 8]])
+        self.assertEqual(features.points.dtype, numpy.uint16)
+        numpy.testing.assert_array_equal(features.words, [0, 3, 3])
+        self.assertEqual(features.words.dtype, numpy.uint32)
@@ -0,0 +1,68 @@
+import cv2
+import os
+import numpy
+import tempfile
+import unittest
+
+from vse import *
+
+
+class FeaturesTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.directory.name, 'vocabulary.dat')
+        self.vocabulary = numpy.random.RandomState(0).randint(256, size=(10, 32)).astype(numpy.uint8)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_should_load_vocabulary_with_feature_tag(self):
+        save_vocabulary(self.filename, self.vocabulary, 'orb')
+        vocabulary, feature = load_vocabulary(self.filename)
+
+        numpy.testing.assert_array_equal(vocabulary, self.vocabulary)
+        self.assertEqual(feature, 'orb')
+        self.assertEqual(load_vocabulary(self.filename, 'orb')[1], 'orb')
+
+    def test_should_not_load_vocabulary_for_other_feature(self):
+        save_vocabulary(self.filename, self.vocabulary, 'orb')
+
+        self.assertRaises(VocabularyFeatureError, load_vocabulary, self.filename, 'brisk')
+        self.assertRaises(VocabularyFeatureError, create_bag_of_visual_words, self.filename, None, 'sift')
+
+    def test_should_check_untagged_vocabulary_type(self):
+        save(self.filename, self.vocabulary)
+
+        self.assertEqual(load_vocabulary(self.filename)[1], None)
+        self.assertEqual(load_vocabulary(self.filename, 'akaze')[1], 'akaze')
+        self.assertRaises(VocabularyFeatureError, load_vocabulary, self.filename, 'sift')
+        self.assertRaises(VocabularyFeatureError, create_bag_of_visual_words, self.filename)
+
+    def test_should_match_binary_vocabulary_with_hamming_distance(self):
+        save_vocabulary(self.filename, self.vocabulary, 'orb')
+        bag_of_visual_words = create_bag_of_visual_words(self.filename)
+
+        self.assertEqual(extractor_feature(bag_of_visual_words.extractor), 'orb')
+        self.assertEqual(bag_of_visual_words.extractor.defaultNorm(), cv2.NORM_HAMMING)
+
+    def test_should_recognize_extractor_feature(self):
+        self.assertEqual(extractor_feature(cv2.AKAZE_create()), 'akaze')
+        self.assertEqual(extractor_feature(cv2.KAZE_create()), None)
+        self.assertTrue(is_binary('brisk'))
+        self.assertFalse(is_binary('sift'))
+        self.assertRaises(ValueError, create_extractor, 'freak')
+
+    def test_should_cluster_binary_descriptors_with_k_majority(self):
+        random = numpy.random.RandomState(0)
+        descriptors = [numpy.bitwise_xor(self.vocabulary[random.randint(10, size=100)],
+                                         random.randint(256, size=(100, 32)).astype(numpy.uint8) & 0x11)
+                       for i in range(3)]
+
+        vocabulary = cluster_vocabulary_from_descriptors(descriptors, 10, self.filename, 'orb')
+
+        self.assertEqual(vocabulary.dtype, numpy.uint8)
+        self.assertEqual(vocabulary.shape, (10, 32))
+        self.assertEqual(load_vocabulary(self.filename)[1], 'orb')
+
+    def test_should_not_cluster_without_descriptors(self):
+        self.assertRaisesRegex(ValueError, 'no descriptors', cluster_vocabulary_from_descriptors, [None], 10)
@@ -0,0 +1,539 @@
+import numpy
+import pickle
+import threading
+import unittest
+
+from vse import *
+
+
+class ForwardIndexTest(unittest.TestCase):
+    def setUp(self):
+        random = numpy.random.RandomState(0)
+        self.hists = random.rand(10, 50).astype(numpy.float32)
+        self.hists /= self.hists.sum(axis=1, keepdims=True)
+        self.index = ForwardIndex(SimpleRanker(Intersection()))
+        for i, hist in enumerate(self.hists):
+            self.index[i] = hist
+
+    def test_should_add_images(self):
+        self.assertEqual(len(self.index), 10)
+        numpy.testing.assert_array_equal(self.index[3], self.hists[3])
+
+    def test_should_not_add_duplicated_image(self):
+        self.assertRaises(DuplicatedImageError, self.index.__setitem__, 3, self.hists[3])
+
+    def test_should_keep_stats_of_images_added_before_error(self):
+        index = ForwardIndex(SimpleRanker(Intersection()))
+
+        self.assertRaises(ValueError, index.add_many, [(1, self.hists[1]), (2, self.hists[2]), (3, numpy.ones(40))])
+
+        self.assertEqual(len(index), 2)
+        self.assertEqual(index.stats.image_count, 2)
+        numpy.testing.assert_allclose(index.vw_freq, self.hists[1:3].mean(axis=0), rtol=1e-6)
+
+    def test_should_remove_image(self):
+        del self.index[3]
+
+        self.assertEqual(len(self.index), 9)
+        self.assertRaises(KeyError, self.index.__getitem__, 3)
+        numpy.testing.assert_array_equal(self.index[9], self.hists[9])
+
+    def test_should_not_remove_non_existing_image(self):
+        self.assertRaises(NoImageError, self.index.__delitem__, 10)
+
+    def test_should_find_same_results_as_ranker(self):
+        query = self.hists[4]
+        expected = self.index.ranker.rank(query, enumerate(self.hists), 3)
+
+        self.assertEqual(self.index.find(query, 3), expected)
+        self.assertEqual(self.index.find(query, 3)[0][0], 4)
+
+    def test_should_find_same_results_as_weighing_ranker(self):
+        self.index.ranker = WeighingRanker(Euclidean())
+        query = self.hists[4]
+        expected = self.index.ranker.rank(query, enumerate(self.hists), 3, self.index.vw_freq)
+
+        results = self.index.find(query, 3)
+
+        self.assertEqual([image_id for image_id, _ in results], [image_id for image_id, _ in expected])
+        numpy.testing.assert_allclose([score for _, score in results], [score for _, score in expected], rtol=1e-5)
+
+    def test_should_find_many_same_results_as_find(self):
+        queries = self.hists[[1, 4, 7]]
+
+        self.assertEqual(self.index.find_many(queries, 3), [self.index.find(query, 3) for query in queries])
+
+
+class InvertedIndexTest(unittest.TestCase):
+    def setUp(self):
+        random = numpy.random.RandomState(0)
+        self.hists = random.rand(10, 50).astype(numpy.float32)
+        self.hists[self.hists < 0.8] = 0
+        self.hists /= self.hists.sum(axis=1, keepdims=True)
+        self.index = InvertedIndex(SimpleRanker(Intersection()), recognized_visual_words=50)
+        for i, hist in enumerate(self.hists):
+            self.index[i] = hist
+
+    def test_should_add_images(self):
+        self.assertEqual(len(self.index), 10)
+        numpy.testing.assert_array_equal(self.index[3], self.hists[3])
+
+    def test_should_not_add_duplicated_image(self):
+        self.assertRaises(DuplicatedImageError, self.index.__setitem__, 3, self.hists[3])
+
+    def test_should_store_postings_above_cutoff(self):
+        word = int(numpy.argmax(self.hists[3]))
+        postings = self.index.postings[word]
+
+        self.assertIn(self.index.ids[3], postings.docs())
+        self.assertEqual(len(postings), numpy.count_nonzero(self.hists[:, word] > self.index.cutoff))
+
+    def test_should_remove_image(self):
+        del self.index[3]
+
+        self.assertEqual(len(self.index), 9)
+        self.assertRaises(KeyError, self.index.__getitem__, 3)
+        self.assertFalse(any(3 in postings.docs() for postings in self.index.postings))
+
+    def test_should_reuse_removed_doc(self):
+        doc = self.index.ids[3]
+        del self.index[3]
+        self.index['new'] = self.hists[3]
+
+        self.assertEqual(self.index.ids['new'], doc)
+        self.assertEqual(self.index.find(self.hists[3], 1)[0][0], 'new')
+
+    def test_should_find_only_images_sharing_visual_words(self):
+        query = numpy.zeros(50, dtype=numpy.float32)
+        word = int(numpy.argmax(self.hists[3]))
+        query[word] = 1
+        expected = [i for i, hist in enumerate(self.hists) if hist[word] > self.index.cutoff]
+
+        results = self.index.find(query, 10)
+
+        self.assertEqual(sorted(image_id for image_id, _ in results), expected)
+
+    def test_should_find_many_same_results_as_find(self):
+        queries = numpy.zeros((3, 50), dtype=numpy.float32)
+        queries[0] = self.hists[2]
+        queries[1, int(numpy.argmax(self.hists[3]))] = 1
+
+        self.assertEqual(self.index.find_many(queries, 4), [self.index.find(query, 4) for query in queries])
+
+
+class PrunedInvertedIndexTest(unittest.TestCase):
+    def setUp(self):
+        random = numpy.random.RandomState(0)
+        self.hists = random.rand(60, 20).astype(numpy.float32)
+        self.hists[self.hists < 0.5] = 0
+        self.hists /= self.hists.sum(axis=1, keepdims=True)
+        self.query = self.hists[7] + 0.01
+
+    def create_index(self, comparator, **kwargs):
+        index = InvertedIndex(SimpleRanker(comparator), 20, cutoff=0, **kwargs)
+        index.add_many(enumerate(self.hists))
+        return index
+
+    def test_should_find_same_results_as_full_evaluation_if_deep_enough(self):
+        for comparator in (Intersection(), CosineAngle()):
+            expected = self.create_index(comparator).find(self.query, 5)
+
+            self.assertEqual(self.create_index(comparator, prune_depth=60).find(self.query, 5), expected)
+
+    def test_should_rank_at_most_prune_depth_candidates(self):
+        for comparator in (Intersection(), CosineAngle()):
+            index = self.create_index(comparator, prune_depth=10)
+
+            self.assertEqual(len(index._query_candidates(self.query, 3)), 10)
+            self.assertEqual(len(index._query_candidates(self.query, 12)), 12)
+            self.assertEqual(index.find(self.query, 1)[0][0], 7)
+
+    def test_should_keep_recall_of_comparators_followed_by_impacts(self):
+        random = numpy.random.RandomState(1)
+        hists = numpy.zeros((2000, 200), dtype=numpy.float32)
+        for hist, words in zip(hists, random.zipf(1.3, size=(2000, 40)) % 200):
+            numpy.add.at(hist, words, 1)
+        hists /= hists.sum(axis=1, keepdims=True)
+        queries = hists[:20] * random.uniform(0.7, 1.3, size=(20, 200)).astype(numpy.float32)
+        for comparator in (Intersection(), CosineAngle(), Correlation(), Hellinger(), Bhattacharyya()):
+            full = InvertedIndex(SimpleRanker(comparator), 200)
+            pruned = InvertedIndex(SimpleRanker(comparator), 200, prune_depth=50)
+            full.add_many(enumerate(hists))
+            pruned.add_many(enumerate(hists))
+            found = [len({image_id for image_id, _ in full.find(query, 10)}
+                         & {image_id for image_id, _ in pruned.find(query, 10)}) for query in queries]
+
+            self.assertGreaterEqual(numpy.mean(found) / 10, 0.95, type(comparator).__name__)
+
+    def test_should_update_bounds_after_mutation(self):
+        index = self.create_index(Intersection(), prune_depth=1)
+        hist = numpy.zeros(20, dtype=numpy.float32)
+        hist[3] = 1
+        index.find(hist, 1)
+
+        index['new'] = hist
+        self.assertEqual(index.find(hist, 1)[0][0], 'new')
+        del index['new']
+        self.assertNotEqual(index.find(hist, 1)[0][0], 'new')
+
+    def test_should_skip_stop_words(self):
+        index = self.create_index(Intersection(), max_posting_length=25)
+        lengths = numpy.array([len(posting_list) for posting_list in index.postings])
+        words = index._words(self.query)
+
+        self.assertEqual(list(index._query_words(self.query)), list(words[lengths[words] <= 25]))
+        index.max_posting_length = 0
+        self.assertEqual(list(index._query_words(self.query)), list(words[lengths[words] == lengths[words].min()]))
+
+
+class IVFIndexTest(unittest.TestCase):
+    def setUp(self):
+        random = numpy.random.RandomState(0)
+        centers = random.rand(4, 50) ** 4
+        self.hists = (centers[numpy.arange(80) % 4] + 0.05 * random.rand(80, 50)).astype(numpy.float32)
+        self.hists /= self.hists.sum(axis=1, keepdims=True)
+        self.index = IVFIndex(SimpleRanker(Hellinger()), lists=4, nprobe=1, rerank=10, train_size=40, seed=0)
+        self.index.add_many(enumerate(self.hists))
+        self.exact = ForwardIndex(SimpleRanker(Hellinger()))
+        self.exact.add_many(enumerate(self.hists))
+
+    def image_ids(self, results):
+        return [image_id for image_id, _ in results]
+
+    def test_should_choose_transform_from_comparator(self):
+        self.assertEqual(self.index.transform, 'sqrt')
+        self.assertEqual(IVFIndex(SimpleRanker(CosineAngle())).transform, 'normalize')
+        self.assertIsNone(IVFIndex(SimpleRanker(Euclidean())).transform)
+        self.assertRaises(ValueError, IVFIndex, SimpleRanker(Euclidean()), transform='log')
+
+    def test_should_search_exhaustively_until_trained(self):
+        index = IVFIndex(SimpleRanker(Hellinger()), lists=4, rerank=1, train_size=40)
+        index.add_many(enumerate(self.hists[:39]))
+
+        self.assertIsNone(index.centers)
+        self.assertEqual(self.image_ids(index.find(self.hists[5], 10)),
+                         [image_id for image_id in self.image_ids(self.exact.find(self.hists[5], 20)) if image_id < 39][:10])
+
+    def test_should_assign_images_to_lists(self):
+        self.assertEqual(len(self.index.centers), 4)
+        self.assertEqual(sum(len(posting_list) for posting_list in self.index.postings), 80)
+        for position, posting_list in enumerate(self.index.postings):
+            self.assertEqual(len({image_id % 4 for image_id in posting_list.docs()}), 1)
+
+    def test_should_rank_shortlist_exactly(self):
+        for query in self.hists[[3, 42, 77]]:
+            results, expected = self.index.find(query, 5), self.exact.find(query, 5)
+
+            self.assertEqual(self.image_ids(results), self.image_ids(expected))
+            numpy.testing.assert_allclose([score for _, score in results], [score for _, score in expected], rtol=1e-5)
+
+    def test_should_shortlist_by_product_quantized_codes(self):
+        index = IVFIndex(SimpleRanker(Hellinger()), lists=4, nprobe=2, rerank=10, pq_subspaces=5, train_size=40,
+                         seed=0)
+        index.add_many(enumerate(self.hists))
+
+        self.assertEqual(index.codes.shape[1], 5)
+        for query in self.hists[[3, 42, 77]]:
+            self.assertEqual(self.image_ids(index.find(query, 3)), self.image_ids(self.exact.find(query, 3)))
+
+    def test_should_remove_image(self):
+        del self.index[42]
+        self.index[80] = self.hists[42]
+
+        self.assertEqual(len(self.index), 80)
+        self.assertRaises(KeyError, self.index.__getitem__, 42)
+        self.assertEqual(self.index.find(self.hists[42], 1)[0][0], 80)
+        self.assertRaises(NoImageError, self.index.__delitem__, 42)
+
+    def test_should_pickle(self):
+        index = pickle.loads(pickle.dumps(self.index))
+
+        self.assertEqual(index.find(self.hists[7], 5), self.index.find(self.hists[7], 5))
+
+
+class VisualWordStatsTest(unittest.TestCase):
+    def setUp(self):
+        self.hists = numpy.array([[0.5, 0.5, 0], [0.25, 0, 0.75]], dtype=numpy.float32)
+        self.stats = VisualWordStats()
+
+    def test_should_compute_mean_frequency(self):
+        self.stats.add(self.hists[0])
+        self.stats.add(self.hists[1])
+
+        numpy.testing.assert_allclose(self.stats.vw_freq(), [0.375, 0.25, 0.375])
+
+    def test_should_compute_idf(self):
+        self.stats.add(self.hists)
+
+        numpy.testing.assert_allclose(self.stats.idf(), [0, numpy.log(2), numpy.log(2)], rtol=1e-6)
+
+    def test_should_update_frequency_after_deletion(self):
+        self.stats.add(self.hists)
+        self.stats.remove(self.hists[1])
+
+        numpy.testing.assert_allclose(self.stats.vw_freq(), self.hists[0])
+        numpy.testing.assert_array_equal(self.stats.doc_freq, [1, 1, 0])
+
+    def test_should_delete_last_image(self):
+        self.stats.add(self.hists[0])
+        self.stats.remove(self.hists[0])
+
+        self.assertEqual(self.stats.image_count, 0)
+        numpy.testing.assert_array_equal(self.stats.vw_freq(), [0, 0, 0])
+
+    def test_should_cache_frequency_until_update(self):
+        self.stats.add(self.hists[0])
+        vw_freq = self.stats.vw_freq()
+
+        self.assertIs(self.stats.vw_freq(), vw_freq)
+        self.stats.add(self.hists[1])
+        self.assertIsNot(self.stats.vw_freq(), vw_freq)
+
+
+class WeightedCacheTest(unittest.TestCase):
+    def setUp(self):
+        random = numpy.random.RandomState(0)
+        self.hists = random.rand(20, 50).astype(numpy.float32)
+        self.hists[self.hists < 0.5] = 0
+        self.hists /= self.hists.sum(axis=1, keepdims=True)
+        self.exact = ForwardIndex(WeighingRanker(CosineAngle()))
+        self.cached = ForwardIndex(WeighingRanker(CosineAngle(), cache_tolerance=0))
+        for i, hist in enumerate(self.hists):
+            self.exact[i] = hist
+            self.cached[i] = hist
+
+    def assert_same_results(self, query):
+        expected = self.exact.find(query, 5)
+        results = self.cached.find(query, 5)
+        self.assertEqual([image_id for image_id, _ in results], [image_id for image_id, _ in expected])
+        numpy.testing.assert_allclose([score for _, score in results], [score for _, score in expected], rtol=1e-5)
+
+    def test_should_find_same_results_as_without_cache(self):
+        self.assert_same_results(self.hists[3])
+
+    def test_should_refresh_cache_after_mutation(self):
+        self.cached.find(self.hists[3], 5)
+        del self.exact[3]
+        del self.cached[3]
+
+        self.assert_same_results(self.hists[4])
+
+    def test_should_reuse_cache_within_tolerance(self):
+        self.cached.ranker.cache_tolerance = 1.0
+        self.cached.find(self.hists[3], 5)
+        weighted = self.cached.hists.weighted
+        self.cached['new'] = self.hists[3]
+
+        self.cached.find(self.hists[3], 5)
+
+        self.assertIs(self.cached.hists.weighted, weighted)
+
+    def test_should_weigh_matrix_like_rows(self):
+        ranker = self.exact.ranker
+        freq = self.exact.vw_freq
+        expected = [ranker.weigh_query(hist, freq) for hist in self.hists]
+
+        numpy.testing.assert_allclose(ranker.weigh_items(self.hists, freq), expected, rtol=1e-6)
+
+    def test_should_weigh_rows_with_not_vectorized_function(self):
+        def weigh_largest_words(hist, freq_vector):
+            return hist * (hist >= hist.max() / 2)
+
+        ranker = WeighingRanker(CosineAngle(), weigh_largest_words, weigh_largest_words)
+        freq = self.exact.vw_freq
+        expected = [ranker.weigh_query(hist, freq) for hist in self.hists]
+
+        numpy.testing.assert_allclose(ranker.weigh_items(self.hists, freq), expected, rtol=1e-6)
+
+    def test_should_validate_shape_of_vectorized_weighing(self):
+        ranker = WeighingRanker(CosineAngle(), item_weigh_function=lambda matrix, freq_vector: matrix.sum(axis=0),
+                                vectorized=True)
+
+        self.assertRaises(ValueError, ranker.weigh_items, self.hists, self.exact.vw_freq)
+
+
+class ConcurrentIndexTest(unittest.TestCase):
+    def setUp(self):
+        random = numpy.random.RandomState(0)
+        self.hists = random.rand(30, 50).astype(numpy.float32)
+        self.hists /= self.hists.sum(axis=1, keepdims=True)
+        self.expected = ForwardIndex(WeighingRanker(Euclidean()))
+        self.index = ConcurrentIndex(WeighingRanker(Euclidean()), merge_threshold=8)
+        for i, hist in enumerate(self.hists):
+            self.expected[i] = hist
+            self.index[i] = hist
+
+    def assert_same_results(self, query):
+        expected = self.expected.find(query, 5)
+        results = self.index.find(query, 5)
+        self.assertEqual([image_id for image_id, _ in results], [image_id for image_id, _ in expected])
+        numpy.testing.assert_allclose([score for _, score in results], [score for _, score in expected], rtol=1e-5)
+
+    def test_should_merge_delta_into_base(self):
+        self.assertEqual(len(self.index.snapshot.segments[0].index), 24)
+        self.assertEqual(len(self.index.snapshot.delta), 6)
+        self.assertEqual(len(self.index), 30)
+        numpy.testing.assert_array_equal(self.index[3], self.hists[3])
+        self.assert_same_results(self.hists[3])
+        self.assert_same_results(self.hists[27])
+
+    def test_should_hide_removed_base_images_until_merge(self):
+        for image_id in (3, 28):
+            del self.expected[image_id]
+            del self.index[image_id]
+
+        self.assertEqual(self.index.snapshot.segments[0].tombstones, {3})
+        self.assertEqual(len(self.index), 28)
+        self.assertRaises(KeyError, self.index.__getitem__, 3)
+        self.assertRaises(NoImageError, self.index.__delitem__, 3)
+        self.assert_same_results(self.hists[3])
+
+        self.index.merge()
+
+        self.assertEqual(self.index.snapshot.segments[0].tombstones, frozenset())
+        self.assertEqual(len(self.index.snapshot.segments[0].index), 28)
+        self.assert_same_results(self.hists[4])
+
+    def test_should_add_removed_image_again(self):
+        del self.index[3]
+        self.index[3] = self.hists[3]
+
+        self.assertEqual(self.index.find(self.hists[3], 1)[0][0], 3)
+        self.assertRaises(DuplicatedImageError, self.index.__setitem__, 3, self.hists[3])
+
+    def test_should_keep_results_consistent_under_concurrent_writes(self):
+        errors = []
+
+        def read():
+            try:
+                for i in range(50):
+                    results = self.index.find(self.hists[0], 3)
+                    self.assertEqual(results[0][0], 0)
+                    self.assertEqual(len(set(image_id for image_id, _ in results)), 3)
+            except Exception as error:
+                errors.append(error)
+
+        readers = [threading.Thread(target=read) for i in range(4)]
+        for reader in readers:
+            reader.start()
+        for i in range(30, 100):
+            self.index[i] = self.hists[i % 30][::-1]
+            if i % 3 == 0:
+                del self.index[i - 20]
+        for reader in readers:
+            reader.join()
+
+        self.assertEqual(errors, [])
+
+    def test_should_pickle(self):
+        index = pickle.loads(pickle.dumps(self.index))
+
+        self.assertEqual(len(index), 30)
+        index[30] = self.hists[0]
+        self.assertEqual(index.find(self.hists[0], 2)[1][0], 30)
+
+
+    def test_should_list_live_items(self):
+        del self.index[2]
+        del self.index[29]
+
+        items = dict(self.index.items())
+
+        self.assertEqual(sorted(items), [i for i in range(30) if i not in (2, 29)])
+        numpy.testing.assert_array_equal(items[28], self.hists[28])
+        numpy.testing.assert_array_equal(items[3], self.hists[3])
+
+
+class SegmentedIndexTest(unittest.TestCase):
+    def setUp(self):
+        random = numpy.random.RandomState(0)
+        self.hists = random.rand(40, 50).astype(numpy.float32)
+        self.hists[self.hists < 0.5] = 0
+        self.hists /= self.hists.sum(axis=1, keepdims=True)
+        self.expected = ForwardIndex(WeighingRanker(CosineAngle()))
+        self.expected.add_many(enumerate(self.hists))
+
+    def create_index(self, index_factory=ForwardIndex, background=False):
+        index = SegmentedIndex(WeighingRanker(CosineAngle()), index_factory, segment_size=4, merge_factor=2,
+                               background=background)
+        for i, hist in enumerate(self.hists):
+            index[i] = hist
+        index.join()
+        return index
+
+    def test_should_list_items_of_all_segments(self):
+        index = self.create_index()
+        del index[0]
+        index[40] = self.hists[0]
+
+        items = dict(index.items())
+
+        self.assertEqual(sorted(items), list(range(1, 41)))
+        numpy.testing.assert_array_equal(items[40], self.hists[0])
+
+    def assert_same_results(self, index, query):
+        expected = self.expected.find(query, 5)
+        results = index.find(query, 5)
+        self.assertEqual([image_id for image_id, _ in results], [image_id for image_id, _ in expected])
+        numpy.testing.assert_allclose([score for _, score in results], [score for _, score in expected], rtol=1e-5)
+
+    def test_should_compact_sealed_segments(self):
+        index = self.create_index()
+
+        self.assertEqual([len(segment_index) for segment_index, _ in index.snapshot.segments], [32, 8])
+        self.assertEqual(len(index), 40)
+        self.assert_same_results(index, self.hists[7])
+
+    def test_should_drop_removed_images_when_compacting(self):
+        index = self.create_index()
+        for image_id in (1, 38):
+            del self.expected[image_id]
+            del index[image_id]
+
+        self.assertEqual(index.snapshot.segments[0].tombstones, {1})
+        self.assertEqual(len(index), 38)
+        self.assert_same_results(index, self.hists[1])
+
+        hists = numpy.random.RandomState(1).rand(8, 50).astype(numpy.float32)
+        hists /= hists.sum(axis=1, keepdims=True)
+        for i, hist in enumerate(hists, 40):
+            index[i] = hist
+            self.expected[i] = hist
+
+        self.assertEqual([len(segment_index) for segment_index, _ in index.snapshot.segments], [32, 15])
+        self.assertEqual(index.snapshot.segments[1].tombstones, frozenset())
+        self.assert_same_results(index, self.hists[2])
+
+    def test_should_compact_in_background(self):
+        index = self.create_index(background=True)
+
+        self.assertEqual(len(index), 40)
+        self.assertLessEqual(len(index.snapshot.segments), 3)
+        self.assert_same_results(index, self.hists[11])
+
+    def test_should_raise_background_merge_error_and_merge_again(self):
+        index = SegmentedIndex(WeighingRanker(CosineAngle()), segment_size=4, merge_factor=2)
+        merge_indexes = index._merge_indexes
+
+        def failing_merge_indexes(segments, delta=None):
+            if delta is None:
+                raise RuntimeError('merge failed')
+            return merge_indexes(segments, delta)
+
+        index._merge_indexes = failing_merge_indexes
+        for start in (0, 4):
+            index.add_many(enumerate(self.hists[start:start + 4], start))
+
+        self.assertRaises(RuntimeError, index.join)
+        self.assertIsNone(index._merger)
+        index._merge_indexes = merge_indexes
+        for start in (8, 12):
+            index.add_many(enumerate(self.hists[start:start + 4], start))
+        index.join()
+        self.assertEqual([len(segment_index) for segment_index, _ in index.snapshot.segments], [16])
+
+    def test_should_seal_inverted_index_segments(self):
+        index = self.create_index(lambda ranker: InvertedIndex(ranker, 50, cutoff=0))
+
+        self.assertTrue(all(isinstance(segment_index, InvertedIndex) for segment_index, _ in index.snapshot.segments))
+        self.assert_same_results(index, self.hists[5])
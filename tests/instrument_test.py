@@ -0,0 +1,87 @@
+import numpy
+import threading
+import unittest
+
+from vse import *
+from vse import instrument
+
+
+class FakeExtractor:
+    def detect(self, image):
+        return [None] * 7
+
+    def compute(self, image, key_points):
+        return key_points, numpy.arange(len(key_points), dtype=numpy.float32).reshape(-1, 1)
+
+
+class FakeQuantizer:
+    def quantize(self, descriptors):
+        return descriptors.ravel().astype(numpy.int64) % 4
+
+    def __len__(self):
+        return 4
+
+
+class InstrumentationTest(unittest.TestCase):
+    def setUp(self):
+        bag_of_visual_words = BagOfVisualWords(FakeExtractor(), None, None, FakeQuantizer())
+        index = InvertedIndex(SimpleRanker(Intersection()), 4, cutoff=0)
+        self.engine = VisualSearchEngine(index, bag_of_visual_words, hist_cache=HistCache())
+        self.image = numpy.zeros((200, 200), dtype=numpy.uint8)
+        self.engine.add_to_index('a', self.image)
+        self.query = numpy.ones((200, 200), dtype=numpy.uint8)
+
+    def test_should_be_disabled_without_hooks_and_traces(self):
+        self.assertFalse(instrument.enabled())
+        self.assertIs(instrument.timed('rank'), instrument.timed('detect'))
+
+    def test_should_trace_stages_of_a_call(self):
+        with instrument.trace() as records:
+            self.assertTrue(instrument.enabled())
+            self.engine.find_similar(self.query)
+            self.engine.find_similar(self.query)
+
+        names = [name for name, value in records]
+        self.assertFalse(instrument.enabled())
+        self.assertEqual(names.count('find_similar'), 2)
+        self.assertEqual(dict(records)['keypoints'], 7)
+        self.assertEqual(dict(records)['candidate_count'], 1)
+        self.assertEqual([value for name, value in records if name == 'cache_hit'], [0, 1])
+        for stage in ('detect', 'describe', 'quantize', 'candidates', 'rank'):
+            self.assertIn(stage, names)
+
+    def test_should_report_to_hooks_until_removed(self):
+        timings = StageTimings()
+        instrument.add_hook(timings)
+        try:
+            self.engine.find_similar(self.query)
+        finally:
+            instrument.remove_hook(timings)
+        self.engine.find_similar(self.query)
+
+        summary = timings.summary()
+        self.assertEqual(summary['find_similar']['count'], 1)
+        self.assertEqual(summary['keypoints']['max'], 7)
+
+    def test_should_export_histograms(self):
+        metrics = HistogramMetrics(bounds=(0.001, 0.01, 0.1))
+        for value in (0.0005, 0.002, 0.003, 0.05, 1.):
+            metrics.record('rank', value)
+
+        self.assertEqual(metrics.quantile('rank', 0.5), 0.01)
+        self.assertEqual(metrics.quantile('rank', 1.), float('inf'))
+        self.assertEqual(metrics.summary()['rank']['count'], 5)
+        self.assertIn('vse_rank_bucket{le="0.01"} 3\n', metrics.export())
+        self.assertIn('vse_rank_bucket{le="+Inf"} 5\n', metrics.export())
+
+    def test_should_record_timings_from_many_threads(self):
+        timings = StageTimings()
+        threads = [threading.Thread(target=lambda: [timings.record('rank', 1.) for i in range(1000)])
+                   for thread in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(timings.summary()['rank']['count'], 8000)
+        self.assertEqual(timings.summary()['rank']['total'], 8000.)
@@ -0,0 +1,121 @@
+import concurrent.futures
+import cv2
+import numpy
+import os
+import pickle
+import tempfile
+import time
+import unittest
+
+from vse import *
+
+
+class FakeDetector:
+    def __init__(self, key_points, threshold=10.):
+        self.key_points = key_points
+        self.threshold = threshold
+        self.thresholds = []
+        self.shapes = []
+
+    def detect(self, image):
+        self.thresholds.append(self.threshold)
+        self.shapes.append(image.shape)
+        return [key_point for key_point in self.key_points if key_point.response > self.threshold]
+
+    def getHessianThreshold(self):
+        return self.threshold
+
+    def setHessianThreshold(self, threshold):
+        self.threshold = threshold
+
+
+class KeypointBudgetTest(unittest.TestCase):
+    def setUp(self):
+        self.image = numpy.zeros((100, 200), dtype=numpy.uint8)
+        strong = [cv2.KeyPoint(x, 10., 5., -1, 10. + x) for x in range(10, 100, 10)]
+        weak = [cv2.KeyPoint(150., y, 5., -1, 1. + y / 100) for y in range(5, 100, 10)]
+        self.key_points = strong + weak
+
+    def test_should_keep_all_key_points_within_budget(self):
+        self.assertEqual(select_keypoints(self.key_points, 100, self.image.shape), self.key_points)
+
+    def test_should_keep_strongest_key_points_spread_over_cells(self):
+        selected = select_keypoints(self.key_points, 8, self.image.shape, grid=2)
+
+        self.assertEqual(len(selected), 8)
+        self.assertEqual(sum(key_point.pt[0] > 100 for key_point in selected), 4)
+        self.assertIn(self.key_points[8], selected)
+        self.assertIn(self.key_points[-1], selected)
+        self.assertEqual(selected, [key_point for key_point in self.key_points if key_point in selected])
+
+    def test_should_detect_with_threshold_adjusted_to_target(self):
+        detector = FakeDetector(self.key_points)
+        budget = KeypointBudget(5, parameter='HessianThreshold', target=4, probe_scale=1)
+
+        selected = budget.detect(detector, self.image)
+
+        self.assertEqual(detector.thresholds, [10., 15.])
+        self.assertEqual(detector.threshold, 10.)
+        self.assertEqual(len(selected), 5)
+        self.assertEqual(budget.detect(detector, self.image), selected)
+
+    def test_should_detect_same_key_points_in_concurrent_threads(self):
+        detector = FakeDetector(self.key_points)
+        detect = detector.detect
+        detector.detect = lambda image: time.sleep(0.001) or detect(image)
+        budget = KeypointBudget(5, parameter='HessianThreshold', target=4, probe_scale=1)
+        expected = budget.detect(detector, self.image)
+
+        with concurrent.futures.ThreadPoolExecutor(8) as executor:
+            results = list(executor.map(lambda i: budget.detect(detector, self.image), range(40)))
+
+        self.assertEqual(results, [expected] * 40)
+        self.assertEqual(detector.thresholds, [10., 15.] * 41)
+        self.assertEqual(detector.threshold, 10.)
+
+    def test_should_pickle_without_lock(self):
+        budget = KeypointBudget(5, parameter='HessianThreshold', target=4, probe_scale=1)
+        expected = budget.detect(FakeDetector(self.key_points), self.image)
+
+        self.assertEqual(pickle.loads(pickle.dumps(budget)).detect(FakeDetector(self.key_points), self.image), expected)
+
+    def test_should_not_lower_initial_threshold(self):
+        detector = FakeDetector(self.key_points[:2])
+        budget = KeypointBudget(5, parameter='HessianThreshold', target=4, probe_scale=1)
+
+        self.assertEqual(len(budget.detect(detector, self.image)), 2)
+        self.assertEqual(detector.thresholds, [10., 10.])
+        self.assertEqual(budget.threshold(10., 16), 20.)
+        self.assertEqual(budget.threshold(10, 1), 10)
+        self.assertEqual(KeypointBudget(parameter='FastThreshold', target=4, bounds=(1, 100)).threshold(10, 1), 5)
+
+    def test_should_estimate_key_points_from_downscaled_probe(self):
+        detector = FakeDetector(self.key_points)
+        budget = KeypointBudget(5, parameter='HessianThreshold')
+
+        self.assertEqual(budget.estimate(detector, self.image), 9 * 16)
+        self.assertEqual(detector.shapes, [(25, 50)])
+        budget.detect(detector, self.image)
+        self.assertEqual(detector.shapes[1:], [(25, 50), (100, 200)])
+
+    def test_should_limit_key_points_of_bag_of_visual_words(self):
+        detector = FakeDetector(self.key_points)
+        detector.compute = lambda image, key_points: (key_points, numpy.zeros((len(key_points), 2), numpy.float32))
+        quantizer = BruteForceQuantizer(numpy.zeros((3, 2), dtype=numpy.float32))
+        bag_of_visual_words = BagOfVisualWords(detector, None, None, quantizer, KeypointBudget(6))
+
+        hist, features = bag_of_visual_words.generate_features(self.image)
+
+        self.assertEqual(len(features.points), 6)
+        self.assertAlmostEqual(float(hist.sum()), 1.)
+
+    def test_should_create_engine_with_keypoint_budget(self):
+        budget = KeypointBudget(100, parameter='ContrastThreshold')
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'vocabulary.dat')
+            save_vocabulary(filename, numpy.zeros((10, 128), dtype=numpy.float32), 'sift')
+
+            engine = create_vse(filename, 10, keypoint_budget=budget)
+
+            self.assertIs(engine.bag_of_visual_words.keypoint_budget, budget)
+            self.assertIs(engine.bag_of_visual_words_factory().keypoint_budget, budget)
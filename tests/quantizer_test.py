@@ -0,0 +1,75 @@
+import numpy
+import unittest
+from unittest.mock import patch
+
+from vse.quantizer import *
+
+
+class QuantizerTest(unittest.TestCase):
+    def setUp(self):
+        random = numpy.random.RandomState(0)
+        self.vocabulary = random.rand(50, 16).astype(numpy.float32)
+        self.descriptors = random.rand(300, 16).astype(numpy.float32)
+        self.expected = MatcherQuantizer(self.vocabulary).quantize(self.descriptors)
+
+    def test_should_quantize_like_matcher(self):
+        words = BruteForceQuantizer(self.vocabulary, block_size=64).quantize(self.descriptors)
+
+        numpy.testing.assert_array_equal(words, self.expected)
+
+    def test_should_quantize_approximately(self):
+        words = FlannQuantizer(self.vocabulary, checks=256).quantize(self.descriptors)
+
+        self.assertGreater(numpy.mean(words == self.expected), 0.9)
+
+    def test_should_quantize_empty_descriptors(self):
+        self.assertEqual(len(FlannQuantizer(self.vocabulary).quantize(numpy.empty((0, 16), numpy.float32))), 0)
+        self.assertEqual(len(BruteForceQuantizer(self.vocabulary).quantize(numpy.empty((0, 16), numpy.float32))), 0)
+
+    def test_should_generate_normalized_words_hist(self):
+        hist = words_hist(numpy.array([0, 2, 2, 3]), 5)
+
+        numpy.testing.assert_array_equal(hist, [0.25, 0, 0.5, 0.25, 0])
+        self.assertEqual(hist.dtype, numpy.float32)
+
+
+class HammingQuantizerTest(unittest.TestCase):
+    def setUp(self):
+        random = numpy.random.RandomState(0)
+        self.vocabulary = random.randint(256, size=(50, 32)).astype(numpy.uint8)
+        self.descriptors = random.randint(256, size=(300, 32)).astype(numpy.uint8)
+
+    def test_should_quantize_like_hamming_matcher(self):
+        words = HammingQuantizer(self.vocabulary, block_size=64).quantize(self.descriptors)
+
+        numpy.testing.assert_array_equal(words, MatcherQuantizer(self.vocabulary).quantize(self.descriptors))
+
+    def test_should_quantize_to_nearest_word(self):
+        distances = numpy.unpackbits(self.descriptors[:, None, :] ^ self.vocabulary[None, :, :], axis=2).sum(axis=2)
+        words = HammingQuantizer(self.vocabulary).quantize(self.descriptors)
+
+        numpy.testing.assert_array_equal(distances[numpy.arange(300), words], distances.min(axis=1))
+        numpy.testing.assert_array_equal(hamming_distances(self.descriptors, self.vocabulary[words]),
+                                         distances.min(axis=1))
+
+    def test_should_quantize_like_unpacked_bits_products(self):
+        bits = numpy.unpackbits(self.vocabulary, axis=1).astype(numpy.float32)
+        descriptor_bits = numpy.unpackbits(self.descriptors, axis=1).astype(numpy.float32)
+        expected = numpy.argmin(bits.sum(axis=1) - 2 * descriptor_bits.dot(bits.T), axis=1)
+
+        numpy.testing.assert_array_equal(HammingQuantizer(self.vocabulary, block_elements=1000).quantize(
+            self.descriptors), expected)
+        with patch('vse.quantizer._bitwise_count', None):
+            numpy.testing.assert_array_equal(HammingQuantizer(self.vocabulary).quantize(self.descriptors), expected)
+
+    def test_should_quantize_descriptors_of_odd_length(self):
+        vocabulary, descriptors = self.vocabulary[:, :5], self.descriptors[:, :5]
+        distances = numpy.unpackbits(descriptors[:, None, :] ^ vocabulary[None, :, :], axis=2).sum(axis=2)
+
+        words = HammingQuantizer(vocabulary).quantize(descriptors)
+
+        numpy.testing.assert_array_equal(distances[numpy.arange(300), words], distances.min(axis=1))
+        numpy.testing.assert_array_equal(hamming_distances(descriptors, vocabulary[words]), distances.min(axis=1))
+
+    def test_should_quantize_empty_descriptors(self):
+        self.assertEqual(len(HammingQuantizer(self.vocabulary).quantize(numpy.empty((0, 32), numpy.uint8))), 0)
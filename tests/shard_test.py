@@ -0,0 +1,103 @@
+import functools
+import numpy
+import pickle
+import unittest
+
+from vse import *
+
+
+class ShardedIndexTest(unittest.TestCase):
+    def setUp(self):
+        random = numpy.random.RandomState(0)
+        self.hists = random.rand(30, 50).astype(numpy.float32)
+        self.hists[self.hists < 0.5] = 0
+        self.hists /= self.hists.sum(axis=1, keepdims=True)
+        self.expected = ForwardIndex(WeighingRanker(Euclidean()))
+        self.expected.add_many(enumerate(self.hists))
+        self.index = ShardedIndex(WeighingRanker(Euclidean()), shards=3)
+        self.index.add_many(enumerate(self.hists))
+
+    def tearDown(self):
+        self.index.close()
+
+    def assert_same_results(self, index, query):
+        expected = self.expected.find(query, 5)
+        results = index.find(query, 5)
+        self.assertEqual([image_id for image_id, _ in results], [image_id for image_id, _ in expected])
+        numpy.testing.assert_allclose([score for _, score in results], [score for _, score in expected], rtol=1e-5)
+
+    def test_should_find_same_results_as_single_index(self):
+        self.assertEqual(len(self.index), 30)
+        numpy.testing.assert_allclose(self.index.vw_freq, self.expected.vw_freq, rtol=1e-6)
+        self.assert_same_results(self.index, self.hists[4])
+        self.assertEqual(len(self.index.find_many(self.hists[:4], 2)), 4)
+
+    def test_should_partition_images_by_id(self):
+        shards = [self.index.shard_of(image_id) for image_id in range(30)]
+
+        self.assertEqual(set(shards), {0, 1, 2})
+        self.assertEqual([self.index.shard_of(image_id) for image_id in range(30)], shards)
+
+    def test_should_route_equal_ids_to_same_shard(self):
+        for image_id in range(30):
+            self.assertEqual(self.index.shard_of(numpy.int64(image_id)), self.index.shard_of(image_id))
+            self.assertEqual(self.index.shard_of(float(image_id)), self.index.shard_of(image_id))
+        numpy.testing.assert_array_equal(self.index[numpy.int64(5)], self.index[5])
+        self.assertIn(numpy.int64(5), self.index)
+        self.assertNotIn(30, self.index)
+        self.assertRaises(TypeError, self.index.shard_of, (1, 2))
+
+    def test_should_add_and_remove_images(self):
+        del self.index[4]
+        del self.expected[4]
+        self.index['new'] = self.hists[4]
+        self.expected['new'] = self.hists[4]
+
+        numpy.testing.assert_array_equal(self.index['new'], self.hists[4])
+        self.assertRaises(NoImageError, self.index.__delitem__, 4)
+        self.assertRaises(DuplicatedImageError, self.index.__setitem__, 'new', self.hists[4])
+        self.assert_same_results(self.index, self.hists[4])
+
+    def test_should_return_errors_of_images_not_added(self):
+        errors = self.index.add_many([(3, self.hists[3]), (30, self.hists[0]), (30, self.hists[1])])
+
+        self.assertEqual([image_id for image_id, _ in errors], [3, 30])
+        self.assertIsInstance(errors[0][1], DuplicatedImageError)
+        self.assertEqual(len(self.index), 31)
+        self.assertEqual(self.index.stats.image_count, 31)
+
+    def test_should_keep_stats_of_images_added_before_error(self):
+        items = [(30, self.hists[0]), (31, self.hists[1]), (32, numpy.ones(40)), (3, self.hists[3])]
+
+        self.assertRaises(ValueError, self.index.add_many, items)
+
+        expected = ForwardIndex(WeighingRanker(Euclidean()))
+        expected.add_many(self.index.items())
+        self.assertIn(30, self.index)
+        self.assertEqual(self.index.stats.image_count, len(expected))
+        numpy.testing.assert_allclose(self.index.vw_freq, expected.vw_freq, rtol=1e-6)
+
+    def test_should_return_errors_in_input_order(self):
+        items = [(image_id, self.hists[image_id]) for image_id in reversed(range(30))]
+        items.insert(5, (30, self.hists[0]))
+        items.append((30, self.hists[1]))
+
+        errors = self.index.add_many(items)
+        self.expected.add_many(items)
+
+        self.assertEqual([image_id for image_id, _ in errors], list(reversed(range(30))) + [30])
+        numpy.testing.assert_allclose(self.index.vw_freq, self.expected.vw_freq, rtol=1e-6)
+        numpy.testing.assert_allclose(self.index[30], self.hists[0])
+
+    def test_should_shard_inverted_indexes(self):
+        index = ShardedIndex(WeighingRanker(Euclidean()), 2, functools.partial(InvertedIndex,
+                                                                               recognized_visual_words=50, cutoff=0))
+        with index:
+            index.add_many(enumerate(self.hists))
+
+            self.assert_same_results(index, self.hists[7])
+
+    def test_should_pickle(self):
+        with pickle.loads(pickle.dumps(self.index)) as index:
+            self.assertEqual(len(index), 30)
+            self.assert_same_results(index, self.hists[9])
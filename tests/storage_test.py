@@ -0,0 +1,124 @@
+import functools
+import os
+import numpy
+import tempfile
+import unittest
+
+from vse import *
+
+
+class StorageTest(unittest.TestCase):
+    def setUp(self):
+        random = numpy.random.RandomState(0)
+        self.hists = random.rand(10, 50).astype(numpy.float32)
+        self.hists[self.hists < 0.8] = 0
+        self.hists /= self.hists.sum(axis=1, keepdims=True)
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'index')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def create_index(self, index_class, *args):
+        index = index_class(SimpleRanker(Intersection()), *args)
+        for i, hist in enumerate(self.hists):
+            index['image{}'.format(i)] = hist
+        del index['image3']
+        return index
+
+    def assert_same_index(self, index, expected):
+        self.assertEqual(len(index), len(expected))
+        numpy.testing.assert_allclose(index.vw_freq, expected.vw_freq, rtol=1e-6)
+        for hist in self.hists:
+            self.assertEqual(index.find(hist, 3), expected.find(hist, 3))
+
+    def test_should_save_and_open_forward_index(self):
+        index = self.create_index(ForwardIndex)
+
+        save_index(index, self.path)
+        opened = open_index(self.path, index.ranker)
+
+        self.assert_same_index(opened, index)
+        self.assertIsInstance(opened.hists.data, numpy.memmap)
+
+    def test_should_save_and_open_inverted_index(self):
+        index = self.create_index(InvertedIndex, 50)
+
+        save_index(index, self.path)
+        opened = open_index(self.path, index.ranker)
+
+        self.assert_same_index(opened, index)
+        numpy.testing.assert_array_equal(opened['image4'], self.hists[4])
+
+    def test_should_keep_encoding_of_opened_index(self):
+        for encoding in ENCODINGS:
+            index = self.create_index(InvertedIndex, 50, 2.0, encoding)
+
+            save_index(index, os.path.join(self.path, encoding))
+            opened = open_index(os.path.join(self.path, encoding), index.ranker)
+
+            self.assertEqual(opened.hists.encoding, encoding)
+            self.assert_same_index(opened, index)
+            numpy.testing.assert_array_equal(opened['image4'], index['image4'])
+
+    def test_should_modify_opened_index_without_changing_files(self):
+        index = self.create_index(InvertedIndex, 50)
+        save_index(index, self.path)
+
+        opened = open_index(self.path, index.ranker)
+        del opened['image4']
+        opened['image3'] = self.hists[3]
+        reopened = open_index(self.path, index.ranker)
+
+        self.assertIn('image3', opened.ids)
+        self.assertNotIn('image4', opened.ids)
+        self.assert_same_index(reopened, index)
+
+    def test_should_save_and_open_segmented_index(self):
+        index = self.create_index(SegmentedIndex, lambda ranker: InvertedIndex(ranker, 50), 4, 2, False)
+        del index['image1']
+        index['image3'] = self.hists[3]
+
+        save_index(index, self.path)
+        opened = open_index(self.path, index.ranker)
+
+        self.assertIsInstance(opened, SegmentedIndex)
+        self.assertEqual([len(segment_index) for segment_index, _ in opened.snapshot.segments], [8, 3])
+        self.assertEqual(opened.snapshot.segments[0].tombstones, {'image1', 'image3'})
+        self.assertIsInstance(opened.snapshot.segments[0].index, InvertedIndex)
+        self.assert_same_index(opened, index)
+        opened['image1'] = self.hists[1]
+        self.assertEqual(opened.find(self.hists[1], 1)[0][0], 'image1')
+
+    def test_should_save_integer_image_ids(self):
+        index = ForwardIndex(SimpleRanker(Intersection()))
+        index.add_many(enumerate(self.hists))
+
+        save_index(index, self.path)
+        opened = open_index(self.path, index.ranker)
+
+        self.assertEqual(opened.find(self.hists[5], 1)[0][0], 5)
+
+    def test_should_not_save_index_which_cannot_be_opened(self):
+        index = self.create_index(IVFIndex, 2)
+        concurrent_index = self.create_index(ConcurrentIndex, functools.partial(IVFIndex, lists=2), 4)
+
+        self.assertRaises(TypeError, save_index, index, self.path)
+        self.assertRaises(TypeError, save_index, concurrent_index, self.path)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_should_not_open_directory_without_index(self):
+        self.assertRaises(IndexFormatError, open_index, self.directory.name, SimpleRanker(Intersection()))
+
+    def test_should_convert_legacy_pickled_index(self):
+        legacy = ForwardIndex.__new__(ForwardIndex)
+        legacy.__dict__ = {'ranker': SimpleRanker(Intersection()), 'vw_freq': [],
+                           'index': {'image{}'.format(i): hist for i, hist in enumerate(self.hists)}}
+        pickle_path = os.path.join(self.directory.name, 'index.pickle')
+        save(pickle_path, legacy)
+
+        converted = convert_pickled_index(pickle_path, self.path)
+        opened = open_index(self.path, converted.ranker)
+
+        self.assertEqual(len(opened), 10)
+        self.assert_same_index(opened, converted)
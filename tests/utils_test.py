@@ -77,6 +77,50 @@ class UtilityTest(unittest.TestCase):
         for i, image in enumerate(load_images(paths)):
             load_image_mock.assert_called_with(paths[i])
 
+    def test_should_read_jpeg_size(self):
+        _, buf = cv2.imencode('.jpg', numpy.zeros((300, 400), dtype=numpy.uint8))
+
+        self.assertEqual(jpeg_size(buf.tobytes()), (400, 300))
+
+    def test_should_not_read_size_of_other_formats(self):
+        _, buf = cv2.imencode('.png', numpy.zeros((300, 400), dtype=numpy.uint8))
+
+        self.assertIsNone(jpeg_size(buf))
+
+    def test_should_choose_reduced_decode_flag(self):
+        self.assertEqual(reduced_decode_flag(IMAGE_MAX_SIZE * 8 + 8, 10), cv2.IMREAD_REDUCED_GRAYSCALE_8)
+        self.assertEqual(reduced_decode_flag(IMAGE_MAX_SIZE * 8, 10), cv2.IMREAD_REDUCED_GRAYSCALE_4)
+        self.assertEqual(reduced_decode_flag(10, IMAGE_MAX_SIZE * 5), cv2.IMREAD_REDUCED_GRAYSCALE_4)
+        self.assertEqual(reduced_decode_flag(IMAGE_MAX_SIZE * 2 + 2, 10), cv2.IMREAD_REDUCED_GRAYSCALE_2)
+        self.assertEqual(reduced_decode_flag(IMAGE_MAX_SIZE * 2, 10), cv2.IMREAD_GRAYSCALE)
+
+    def test_should_load_reduced_image_from_buffer(self):
+        image = numpy.tile(numpy.arange(256, dtype=numpy.uint8), (IMAGE_MAX_SIZE * 3, 20))
+        _, buf = cv2.imencode('.jpg', image)
+
+        img = load_image_from_buf(memoryview(buf.tobytes()), reduced=True)
+
+        self.assertEqual(img.shape, load_image_from_buf(buf).shape)
+        self.assertEqual(max(img.shape), IMAGE_MAX_SIZE)
+
+    def test_should_validate_reduced_image_like_full_one(self):
+        image = numpy.tile(numpy.arange(256, dtype=numpy.uint8), (IMAGE_MAX_SIZE, 32))[:, :IMAGE_MAX_SIZE * 8]
+        _, buf = cv2.imencode('.jpg', image)
+
+        self.assertEqual(load_image_from_buf(buf, reduced=True).shape, load_image_from_buf(buf).shape)
+
+    def test_should_raise_exception_if_failed_to_read_reduced_image(self):
+        self.assertRaises(ImageLoaderError, load_image, 'dir/filename/', True)
+
+    @patch('vse.utils.load_image')
+    def test_should_load_images_in_parallel_in_order(self, load_image_mock):
+        load_image_mock.side_effect = lambda filename, reduced: filename
+        paths = ['dir/filename{}/'.format(i) for i in range(10)]
+
+        images = list(load_images_parallel(paths, workers=3))
+
+        self.assertEqual(images, paths)
+
     @patch('vse.utils.shutil')
     def test_should_remove_directory(self, shutil_mock):
         rmdir_if_exist('dir/filename/')
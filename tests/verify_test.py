@@ -0,0 +1,71 @@
+import numpy
+import pickle
+import time
+import unittest
+
+from vse import *
+
+
+def transformed(features, homography, noise, seed):
+    points = numpy.hstack((features.points, numpy.ones((len(features.points), 1)))).dot(homography.T)
+    points = points[:, :2] / points[:, 2:]
+    points += numpy.random.RandomState(seed).normal(0, noise, points.shape)
+    return Features(numpy.clip(numpy.rint(points), 0, 65535).astype(numpy.uint16), features.words)
+
+
+class GeometricVerifierTest(unittest.TestCase):
+    def setUp(self):
+        random = numpy.random.RandomState(0)
+        self.query = Features(random.randint(50, 400, (200, 2)).astype(numpy.uint16),
+                              random.choice(1000, 200, replace=False).astype(numpy.uint32))
+        homography = numpy.array([[0.9, 0.1, 30], [-0.1, 0.9, 20], [0, 0, 1]])
+        self.verifier = GeometricVerifier(top_k=3, min_inliers=10)
+        self.verifier.features = {'match': transformed(self.query, homography, 0.5, 1),
+                                  'shuffled': Features(random.randint(0, 500, (200, 2)).astype(numpy.uint16),
+                                                       self.query.words),
+                                  'other': Features(self.query.points, self.query.words + 1000)}
+        self.results = [('shuffled', 0.1), ('other', 0.2), ('match', 0.3), ('unknown', 0.4)]
+
+    def tearDown(self):
+        self.verifier.close()
+
+    def test_should_find_correspondences_by_visual_words(self):
+        query = Features(numpy.array([[1, 1], [2, 2], [3, 3]], dtype=numpy.uint16), numpy.array([5, 7, 9]))
+        candidate = Features(numpy.array([[10, 10], [20, 20], [30, 30]], dtype=numpy.uint16), numpy.array([9, 5, 8]))
+
+        query_points, candidate_points = correspondences(query, candidate)
+
+        numpy.testing.assert_array_equal(query_points, [[1, 1], [3, 3]])
+        numpy.testing.assert_array_equal(candidate_points, [[20, 20], [10, 10]])
+
+    def test_should_count_inliers_of_transformed_image(self):
+        self.assertGreater(self.verifier.inliers(self.query, self.verifier.features['match']), 150)
+        self.assertLess(self.verifier.inliers(self.query, self.verifier.features['shuffled']), 10)
+        self.assertEqual(self.verifier.inliers(self.query, self.verifier.features['other']), 0)
+
+    def test_should_count_inliers_of_fundamental_matrix(self):
+        verifier = GeometricVerifier(model=GeometricVerifier.FUNDAMENTAL, reprojection_threshold=1.0)
+
+        self.assertGreater(verifier.inliers(self.query, self.verifier.features['match']), 150)
+
+    def test_should_rerank_top_k_by_inliers(self):
+        results = self.verifier.verify(self.query, self.results)
+
+        self.assertEqual(results, [('match', 0.3), ('shuffled', 0.1), ('other', 0.2), ('unknown', 0.4)])
+
+    def test_should_keep_order_of_results_not_verified_in_time_budget(self):
+        inliers = self.verifier.inliers
+        self.verifier.inliers = lambda query, candidate: time.sleep(0.2) or inliers(query, candidate)
+        self.verifier.time_budget = 0.01
+
+        self.assertEqual(self.verifier.verify(self.query, self.results), self.results)
+
+    def test_should_pickle_features(self):
+        with pickle.loads(pickle.dumps(self.verifier)) as verifier:
+            self.assertEqual(verifier.verify(self.query, self.results)[0], ('match', 0.3))
+
+    def test_should_stop_worker_threads_on_close(self):
+        with GeometricVerifier() as verifier:
+            verifier.verify(self.query, [])
+
+        self.assertRaises(RuntimeError, verifier.executor.submit, verifier.inliers, self.query, self.query)
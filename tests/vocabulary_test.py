@@ -0,0 +1,173 @@
+import os
+import numpy
+import tempfile
+import unittest
+
+from vse.error import VocabularyFeatureError
+from vse.utils import load
+from vse.vocabulary import *
+
+
+class VocabularyTreeTest(unittest.TestCase):
+    def setUp(self):
+        random = numpy.random.RandomState(0)
+        self.descriptors = [random.rand(200, 8).astype(numpy.float32) for i in range(5)]
+        self.tree = VocabularyTree.train(self.descriptors, branch_factor=3, depth=2, seed=0)
+
+    def test_should_train_complete_tree(self):
+        self.assertEqual(len(self.tree), 9)
+        self.assertEqual(self.tree.centers.shape, (12, 8))
+
+    def test_should_quantize_to_nearest_child_on_every_level(self):
+        descriptor = self.descriptors[0][:1]
+        root_children = self.tree.centers[:3]
+        first = numpy.argmin(((root_children - descriptor) ** 2).sum(axis=1))
+        leaves = self.tree.centers[3 + 3 * first:3 + 3 * first + 3]
+        expected = 3 * first + numpy.argmin(((leaves - descriptor) ** 2).sum(axis=1))
+
+        self.assertEqual(self.tree.quantize(descriptor)[0], expected)
+
+    def test_should_train_on_too_small_sample(self):
+        tree = VocabularyTree.train([self.descriptors[0][:5]], branch_factor=3, depth=2)
+
+        self.assertEqual(len(numpy.unique(tree.quantize(self.descriptors[0][:5]))), 5)
+
+    def test_should_save_and_load_tree(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'tree.npz')
+            self.tree.save(filename)
+            tree = VocabularyTree.load(filename)
+
+        numpy.testing.assert_array_equal(tree.centers, self.tree.centers)
+        self.assertEqual((tree.branch_factor, tree.depth), (3, 2))
+
+    def test_should_sample_at_most_size_descriptors(self):
+        sample = reservoir_sample(iter(self.descriptors), 150, seed=0)
+
+        self.assertEqual(sample.shape, (150, 8))
+        self.assertTrue(all(any((row == desc).all(axis=1).any() for desc in self.descriptors) for row in sample))
+
+    def test_should_sample_all_descriptors_if_stream_is_short(self):
+        sample = reservoir_sample(self.descriptors, 10000)
+
+        numpy.testing.assert_array_equal(sample, numpy.concatenate(self.descriptors))
+
+
+class MiniBatchKMeansTest(unittest.TestCase):
+    def setUp(self):
+        random = numpy.random.RandomState(0)
+        self.centers = random.rand(4, 8).astype(numpy.float32) * 10
+        words = random.randint(4, size=(10, 50))
+        self.descriptors = [self.centers[w] + random.normal(scale=0.05, size=(50, 8)).astype(numpy.float32)
+                            for w in words]
+
+    def assert_same_centers(self, centers):
+        distances = ((centers[:, None, :] - self.centers[None, :, :]) ** 2).sum(axis=2)
+        self.assertEqual(sorted(numpy.argmin(distances, axis=1)), [0, 1, 2, 3])
+        self.assertLess(distances.min(axis=1).max(), 0.1)
+
+    def test_should_cluster_descriptor_stream(self):
+        metrics = []
+        centers = MiniBatchKMeans(4, batch_size=100, seed=0).fit(lambda: iter(self.descriptors), 2, metrics.append)
+
+        self.assert_same_centers(centers)
+        self.assertEqual([(m.epoch, m.batch) for m in metrics[4:6]], [(0, 5), (1, 1)])
+
+    def test_should_resume_from_checkpoint(self):
+        with tempfile.TemporaryDirectory() as directory:
+            checkpoint = os.path.join(directory, 'kmeans.pickle')
+            MiniBatchKMeans(4, batch_size=100, checkpoint=checkpoint, seed=0).fit(iter(self.descriptors))
+            kmeans = MiniBatchKMeans(4, batch_size=100, checkpoint=checkpoint)
+            metrics = []
+            centers = kmeans.fit(lambda: iter(self.descriptors), 2, metrics.append)
+
+        self.assert_same_centers(centers)
+        self.assertEqual({m.epoch for m in metrics}, {1})
+
+    def test_should_not_resume_from_checkpoint_of_other_clustering(self):
+        with tempfile.TemporaryDirectory() as directory:
+            checkpoint = os.path.join(directory, 'kmeans.pickle')
+            MiniBatchKMeans(4, batch_size=100, checkpoint=checkpoint, seed=0).fit(iter(self.descriptors))
+
+            self.assertRaises(ValueError, MiniBatchKMeans, 5, batch_size=100, checkpoint=checkpoint)
+            self.assertRaises(ValueError, KMajority, 4, batch_size=100, checkpoint=checkpoint)
+            kmeans = MiniBatchKMeans(4, batch_size=100, checkpoint=checkpoint)
+            self.assertRaises(ValueError, kmeans.partial_fit, numpy.zeros((100, 16), dtype=numpy.float32))
+
+    def test_should_keep_previous_checkpoint_if_saving_fails(self):
+        with tempfile.TemporaryDirectory() as directory:
+            checkpoint = os.path.join(directory, 'kmeans.pickle')
+            kmeans = MiniBatchKMeans(4, batch_size=100, checkpoint=checkpoint, seed=0)
+            kmeans.fit(iter(self.descriptors))
+            kmeans._state = lambda: {'centers': lambda: None}
+
+            self.assertRaises(Exception, kmeans.save_checkpoint)
+            self.assertEqual(os.listdir(directory), ['kmeans.pickle'])
+            self.assertEqual(load(checkpoint)['counts'].sum(), 500)
+
+    def test_should_not_train_many_epochs_on_generator(self):
+        self.assertRaises(ValueError, MiniBatchKMeans(4, batch_size=100).fit, iter(self.descriptors), 2)
+
+    def test_should_cluster_vocabulary_from_descriptor_stream(self):
+        vocabulary = cluster_vocabulary_from_descriptor_stream(iter(self.descriptors), 4, batch_size=100)
+
+        self.assertEqual(vocabulary.shape, (4, 8))
+
+
+class KMajorityTest(unittest.TestCase):
+    def setUp(self):
+        random = numpy.random.RandomState(0)
+        self.centers = random.randint(256, size=(4, 16)).astype(numpy.uint8)
+        noise = [random.randint(256, size=(50, 16)).astype(numpy.uint8) & random.randint(256, size=(50, 16)) & 0x21
+                 for i in range(10)]
+        self.descriptors = [self.centers[random.randint(4, size=50)] ^ bits.astype(numpy.uint8) for bits in noise]
+
+    def assert_same_centers(self, centers):
+        self.assertEqual(centers.dtype, numpy.uint8)
+        self.assertEqual(sorted(map(bytes, centers)), sorted(map(bytes, self.centers)))
+
+    def test_should_cluster_binary_descriptors(self):
+        self.assert_same_centers(kmajority(numpy.concatenate(self.descriptors), 4, seed=1))
+
+    def test_should_cluster_binary_descriptor_stream(self):
+        metrics = []
+        centers = KMajority(4, batch_size=100, seed=1).fit(lambda: iter(self.descriptors), 2, metrics.append)
+
+        self.assert_same_centers(centers)
+        self.assertEqual(metrics[-1].center_shift, 0)
+
+    def test_should_infer_binary_descriptor_stream_without_feature(self):
+        for descriptors, epochs in ((iter(self.descriptors), 1), (lambda: iter([None] + self.descriptors), 2)):
+            vocabulary = cluster_vocabulary_from_descriptor_stream(descriptors, 4, batch_size=100, epochs=epochs)
+
+            self.assertEqual(vocabulary.dtype, numpy.uint8)
+            self.assertEqual(vocabulary.shape, self.centers.shape)
+
+    def test_should_resume_from_checkpoint(self):
+        with tempfile.TemporaryDirectory() as directory:
+            checkpoint = os.path.join(directory, 'kmajority.pickle')
+            KMajority(4, batch_size=100, checkpoint=checkpoint, seed=1).fit(iter(self.descriptors))
+            kmajority = KMajority(4, batch_size=100, checkpoint=checkpoint)
+
+            self.assertEqual(kmajority.counts.sum(), 500)
+            self.assertEqual(kmajority.bit_sums.shape, (4, 128))
+
+    def test_should_tag_vocabulary_with_feature(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'vocabulary.dat')
+            vocabulary = cluster_vocabulary_from_descriptor_stream(iter(self.descriptors), 4, batch_size=100,
+                                                                   filename=filename, feature='orb')
+
+            self.assertEqual(vocabulary.dtype, numpy.uint8)
+            self.assertEqual(load(filename)['feature'], 'orb')
+
+    def test_should_not_load_tree_for_other_feature(self):
+        random = numpy.random.RandomState(0)
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'tree.npz')
+            cluster_vocabulary_tree_from_descriptors([random.rand(50, 8).astype(numpy.float32)], 2, 2,
+                                                     filename=filename, feature='sift')
+
+            self.assertEqual(VocabularyTree.load(filename).feature, 'sift')
+            self.assertRaises(VocabularyFeatureError, VocabularyTree.load, filename, 'surf')
+            self.assertRaises(VocabularyFeatureError, VocabularyTree.load, filename, 'orb')
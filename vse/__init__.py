@@ -1,9 +1,21 @@
 """vse package"""
+from vse.aio import *
+from vse.cache import *
 from vse.comparator import *
+from vse.dedup import *
+from vse.encoding import *
 from vse.engine import *
 from vse.error import *
+from vse.features import *
 from vse.index import *
+from vse.instrument import *
+from vse.keypoints import *
+from vse.quantizer import *
 from vse.ranker import *
+from vse.shard import *
+from vse.storage import *
 from vse.utils import *
+from vse.verify import *
+from vse.vocabulary import *
 
 __version__ = '0.1.5'
@@ -0,0 +1,150 @@
+"""asyncio facade of visual search engine
+
+Decoding, feature extraction and quantization run in an executor, so they do not block the event loop.
+Concurrent queries are collected into micro-batches ranked by a single Index.find_many call.
+Index is accessed under a lock, so concurrent additions, removals and queries stay consistent.
+"""
+
+import asyncio
+import concurrent.futures
+import threading
+import time
+
+from vse.engine import _init_worker, _worker_generate_features, _worker_generate_hist
+from vse.instrument import StageTimings
+
+__all__ = ['AsyncVisualSearchEngine',
+           'process_executor',
+           ]
+
+
+def process_executor(engine, processes=None):
+    """Returns process pool generating histograms with bag of visual words created by engine factory."""
+    if not engine.bag_of_visual_words_factory:
+        raise ValueError('bag_of_visual_words_factory is required to generate histograms in processes')
+    return concurrent.futures.ProcessPoolExecutor(processes, initializer=_init_worker,
+                                                  initargs=(engine.bag_of_visual_words_factory,))
+
+
+class AsyncVisualSearchEngine:
+    """Async facade of VisualSearchEngine. Histograms are generated in executor (default thread pool of the loop,
+    or a process_executor). At most max_concurrency calls are processed at once, further calls wait.
+    Queries arriving within batch_delay seconds are ranked together, at most batch_size at once.
+    """
+
+    def __init__(self, engine, executor=None, max_concurrency=64, batch_size=32, batch_delay=0.001):
+        self.engine = engine
+        self.executor = executor
+        self.max_concurrency = max_concurrency
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.index_lock = threading.Lock()
+        self.timings = StageTimings()
+        self._semaphore = None
+        self._batch = []
+        self._flush_handle = None
+        self._tasks = set()
+
+    async def afind_similar(self, image, n=1):
+        """Returns at most n similar images."""
+        async with self._limit():
+            query_hist, query_features = await self._generate(image)
+            verifier = self.engine.verifier
+            if verifier is None:
+                return await self._find(query_hist, n)
+            results = await self._find(query_hist, max(n, verifier.top_k))
+            start = time.perf_counter()
+            results = await asyncio.get_running_loop().run_in_executor(None, verifier.verify, query_features, results)
+            self.timings.record('verify', time.perf_counter() - start)
+            return results[:n]
+
+    async def aadd_to_index(self, image_id, image):
+        """Adds image id and its histogram to index."""
+        async with self._limit():
+            hist, features = await self._generate(image)
+            await self._run_locked('add', self._add, image_id, hist, features)
+
+    async def aremove_from_index(self, image_id):
+        """Removes item with image_id."""
+        async with self._limit():
+            await self._run_locked('remove', self.engine.remove_from_index, image_id)
+
+    def _add(self, image_id, hist, features):
+        self.engine.image_index[image_id] = hist
+        if features is not None:
+            self.engine.verifier.features[image_id] = features
+
+    def _limit(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    async def _generate(self, image):
+        """Returns histogram and features of image, features are None if the engine has no verifier."""
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        if not isinstance(self.executor, concurrent.futures.ProcessPoolExecutor):
+            result = await loop.run_in_executor(self.executor, self.engine._generate, image)
+        elif self.engine.verifier is not None:
+            result = await loop.run_in_executor(self.executor, _worker_generate_features, image)
+        else:
+            hist_cache = self.engine.hist_cache
+            key = self.engine._cache_key(image) if hist_cache is not None else None
+            hist = hist_cache.get(key) if key is not None else None
+            if hist is None:
+                hist = await loop.run_in_executor(self.executor, _worker_generate_hist, image)
+                if key is not None:
+                    hist_cache.put(key, hist)
+            result = hist, None
+        self.timings.record('hist', time.perf_counter() - start)
+        return result
+
+    async def _run_locked(self, stage, function, *args):
+
+        def locked():
+            with self.index_lock:
+                return function(*args)
+
+        start = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(None, locked)
+        finally:
+            self.timings.record(stage, time.perf_counter() - start)
+
+    def _find(self, query_hist, n):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._batch.append((query_hist, n, future, time.perf_counter()))
+        if len(self._batch) >= self.batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.batch_delay, self._flush)
+        return future
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._batch = self._batch, []
+        if batch:
+            task = asyncio.ensure_future(self._rank_batch(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _rank_batch(self, batch):
+        now = time.perf_counter()
+        for query_hist, n, future, queued in batch:
+            self.timings.record('queue', now - queued)
+        self.timings.record('batch_size', len(batch))
+        query_hists = [query_hist for query_hist, n, future, queued in batch]
+        try:
+            results = await self._run_locked('rank', self.engine.image_index.find_many, query_hists,
+                                             max(n for query_hist, n, future, queued in batch))
+        except Exception as error:
+            for query_hist, n, future, queued in batch:
+                if not future.done():
+                    future.set_exception(error)
+            return
+        for (query_hist, n, future, queued), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result[:n])
@@ -0,0 +1,164 @@
+"""Histogram cache keyed by image content hash and fingerprint of the configuration generating histograms."""
+
+import collections
+import hashlib
+import shelve
+import threading
+import time
+
+import cv2
+import numpy
+
+from vse import instrument
+from vse.error import ImageLoaderError
+
+__all__ = ['HistCache',
+           'ShelveHistStore',
+           'configuration_fingerprint',
+           'image_key',
+           ]
+
+
+def image_key(image, fingerprint=''):
+    """Returns content hash of an image given as encoded buffer, file path or loaded image array, combined with
+    fingerprint of the configuration generating histograms (see configuration_fingerprint).
+    Raises ImageLoaderError if image file cannot be read.
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update('{}\0'.format(fingerprint).encode())
+    if isinstance(image, str):
+        try:
+            with open(image, 'rb') as file:
+                digest.update(file.read())
+        except OSError:
+            raise ImageLoaderError(image) from None
+    elif isinstance(image, (bytes, bytearray, memoryview)):
+        digest.update(image)
+    else:
+        image = numpy.ascontiguousarray(image)
+        digest.update('{}{}'.format(image.dtype.str, image.shape).encode())
+        digest.update(image.data)
+    return digest.hexdigest()
+
+
+def configuration_fingerprint(vocabulary, extractor, *parts):
+    """Returns hash of vocabulary, extractor name and parameters (of OpenCV Feature2D) and other configuration parts
+    (their repr), so that histograms generated with another configuration get other keys.
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    vocabulary = numpy.ascontiguousarray(vocabulary)
+    digest.update('{}{}'.format(vocabulary.dtype.str, vocabulary.shape).encode())
+    digest.update(vocabulary.data)
+    digest.update(_extractor_parameters(extractor).encode())
+    for part in parts:
+        digest.update(repr(part).encode())
+    return digest.hexdigest()
+
+
+def _extractor_parameters(extractor):
+    """Returns extractor serialized with its parameters, or its type name if it cannot be serialized."""
+    if not isinstance(extractor, cv2.Feature2D):
+        return type(extractor).__name__
+    storage = cv2.FileStorage('.yml', cv2.FILE_STORAGE_WRITE | cv2.FILE_STORAGE_MEMORY)
+    extractor.write(storage, 'extractor')
+    return storage.releaseAndGetString()
+
+
+class HistCache:
+    """Bounded LRU cache of histograms. Entries expire after ttl seconds if given. If store is given
+    (e.g. ShelveHistStore), histograms missing in memory are looked up in it and every new histogram is saved to it.
+    Keys include fingerprint of the configuration, so a store can be shared by engines with different vocabularies
+    or extractors and is not read after the configuration changes.
+    """
+
+    def __init__(self, max_size=10000, ttl=None, store=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.store = store
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Returns cached histogram or None."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                hist, expires = entry
+                if expires is None or expires > time.monotonic():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    instrument.record('cache_hit', 1)
+                    return hist
+                del self.entries[key]
+        hist = self.store.get(key) if self.store is not None else None
+        with self.lock:
+            if hist is None:
+                self.misses += 1
+                instrument.record('cache_hit', 0)
+                return None
+            self.hits += 1
+            self._insert(key, hist)
+        instrument.record('cache_hit', 1)
+        return hist
+
+    def put(self, key, hist):
+        with self.lock:
+            self._insert(key, hist)
+        if self.store is not None:
+            self.store.put(key, hist)
+
+    def get_or_generate(self, image, generate_hist, fingerprint=''):
+        """Returns cached histogram of image, generate_hist(image) result is cached on miss."""
+        key = image_key(image, fingerprint)
+        hist = self.get(key)
+        if hist is None:
+            hist = generate_hist(image)
+            self.put(key, hist)
+        return hist
+
+    @property
+    def hit_rate(self):
+        requests = self.hits + self.misses
+        return self.hits / requests if requests else 0.
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def _insert(self, key, hist):
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        self.entries[key] = (hist, expires)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class ShelveHistStore:
+    """Persistent histogram store kept in a shelve database file."""
+
+    def __init__(self, filename):
+        self.shelf = shelve.open(filename)
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            return self.shelf.get(key)
+
+    def put(self, key, hist):
+        with self.lock:
+            self.shelf[key] = numpy.asarray(hist)
+
+    def close(self):
+        with self.lock:
+            self.shelf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -1,6 +1,7 @@
 import cv2
 import numpy
 from abc import ABCMeta, abstractmethod
+from vse.encoding import EncodedRows
 
 
 __all__ = ['HistComparator',
@@ -15,6 +16,9 @@ __all__ = ['HistComparator',
            'CosineAngle',
            ]
 
+DBL_EPSILON = numpy.finfo(numpy.float64).eps
+FLT_EPSILON = numpy.finfo(numpy.float32).eps
+
 
 class HistComparator(metaclass=ABCMeta):
     reversed = False
@@ -24,6 +28,17 @@ class HistComparator(metaclass=ABCMeta):
         """"Compares histograms. Returns comparison metric"""
         pass
 
+    def compare_many(self, query, matrix):
+        """Compares every row of matrix with query histogram. Returns array of metrics equal to compare(row, query)."""
+        return numpy.array([self.compare(row, query) for row in numpy.asarray(matrix)], dtype=numpy.float64)
+
+    def compare_many_queries(self, queries, matrix):
+        """Compares every row of matrix with every query histogram. Returns (len(queries), len(matrix)) array
+        of metrics equal to compare_many(query, matrix) rows.
+        """
+        return numpy.array([self.compare_many(query, matrix) for query in queries], dtype=numpy.float64) \
+            .reshape(len(queries), len(matrix))
+
 
 class Correlation(HistComparator):
     reversed = True
@@ -31,11 +46,48 @@ class Correlation(HistComparator):
     def compare(self, h1, h2):
         return cv2.compareHist(h1, h2, cv2.HISTCMP_CORREL)
 
+    def compare_many(self, query, matrix):
+        query = numpy.asarray(query, dtype=numpy.float64)
+        scale = 1. / query.size
+        if isinstance(matrix, EncodedRows):
+            s1, s11, s12 = matrix.row_sums(), matrix.squared_norms(), matrix.dot(query)
+        else:
+            s1 = matrix.sum(axis=1, dtype=numpy.float64)
+            s11 = numpy.einsum('ij,ij->i', matrix, matrix, dtype=numpy.float64)
+            s12 = matrix.dot(query)
+        s2 = query.sum()
+        s22 = query.dot(query)
+        num = s12 - s1 * s2 * scale
+        denom2 = (s11 - s1 * s1 * scale) * (s22 - s2 * s2 * scale)
+        valid = numpy.abs(denom2) > DBL_EPSILON
+        return numpy.divide(num, numpy.sqrt(numpy.abs(denom2)), out=numpy.ones_like(num), where=valid)
+
+    def compare_many_queries(self, queries, matrix):
+        if isinstance(matrix, EncodedRows):
+            return HistComparator.compare_many_queries(self, queries, matrix)
+        queries = numpy.asarray(queries, dtype=numpy.float64)
+        matrix = numpy.asarray(matrix, dtype=numpy.float64)
+        scale = 1. / matrix.shape[1]
+        s1 = matrix.sum(axis=1)
+        s11 = numpy.einsum('ij,ij->i', matrix, matrix)
+        s2 = queries.sum(axis=1)[:, numpy.newaxis]
+        s22 = numpy.einsum('ij,ij->i', queries, queries)[:, numpy.newaxis]
+        num = queries.dot(matrix.T) - s1 * s2 * scale
+        denom2 = (s11 - s1 * s1 * scale) * (s22 - s2 * s2 * scale)
+        valid = numpy.abs(denom2) > DBL_EPSILON
+        return numpy.divide(num, numpy.sqrt(numpy.abs(denom2)), out=numpy.ones_like(num), where=valid)
+
 
 class ChiSquared(HistComparator):
     def compare(self, h1, h2):
         return cv2.compareHist(h1, h2, cv2.HISTCMP_CHISQR)
 
+    def compare_many(self, query, matrix):
+        matrix = numpy.asarray(matrix, dtype=numpy.float64)
+        diff = matrix - numpy.asarray(query, dtype=numpy.float64)
+        terms = numpy.divide(diff * diff, matrix, out=numpy.zeros_like(matrix), where=numpy.abs(matrix) > DBL_EPSILON)
+        return terms.sum(axis=1)
+
 
 class Intersection(HistComparator):
     reversed = True
@@ -43,31 +95,83 @@ class Intersection(HistComparator):
     def compare(self, h1, h2):
         return cv2.compareHist(h1, h2, cv2.HISTCMP_INTERSECT)
 
+    def compare_many(self, query, matrix):
+        if isinstance(matrix, EncodedRows):
+            return matrix.minimum_sums(query)
+        return numpy.minimum(matrix, query).sum(axis=1, dtype=numpy.float64)
+
 
 class Hellinger(HistComparator):
     def compare(self, h1, h2):
         return cv2.compareHist(h1, h2, cv2.HISTCMP_HELLINGER)
 
+    def compare_many(self, query, matrix):
+        return bhattacharyya_distance(query, matrix)
+
+    def compare_many_queries(self, queries, matrix):
+        if isinstance(matrix, EncodedRows):
+            return HistComparator.compare_many_queries(self, queries, matrix)
+        return bhattacharyya_distances(queries, matrix)
+
 
 class Bhattacharyya(HistComparator):
     def compare(self, h1, h2):
         return cv2.compareHist(h1, h2, cv2.HISTCMP_BHATTACHARYYA)
 
+    def compare_many(self, query, matrix):
+        return bhattacharyya_distance(query, matrix)
+
+    def compare_many_queries(self, queries, matrix):
+        if isinstance(matrix, EncodedRows):
+            return HistComparator.compare_many_queries(self, queries, matrix)
+        return bhattacharyya_distances(queries, matrix)
+
 
 class ChiSquaredAlt(HistComparator):
     def compare(self, h1, h2):
         return cv2.compareHist(h1, h2, cv2.HISTCMP_CHISQR_ALT)
 
+    def compare_many(self, query, matrix):
+        matrix = numpy.asarray(matrix, dtype=numpy.float64)
+        query = numpy.asarray(query, dtype=numpy.float64)
+        diff = matrix - query
+        total = matrix + query
+        terms = numpy.divide(diff * diff, total, out=numpy.zeros_like(matrix), where=numpy.abs(total) > DBL_EPSILON)
+        return 2 * terms.sum(axis=1)
+
 
 class KullbackLeibler(HistComparator):
     def compare(self, h1, h2):
         return cv2.compareHist(h1, h2, cv2.HISTCMP_KL_DIV)
 
+    def compare_many(self, query, matrix):
+        matrix = numpy.asarray(matrix, dtype=numpy.float64)
+        query = numpy.asarray(query, dtype=numpy.float64)
+        query = numpy.where(numpy.abs(query) > DBL_EPSILON, query, 1e-10)
+        valid = numpy.abs(matrix) > DBL_EPSILON
+        ratio = numpy.divide(matrix, query, out=numpy.ones_like(matrix), where=valid)
+        return (matrix * numpy.log(ratio, out=numpy.zeros_like(matrix), where=valid)).sum(axis=1)
+
 
 class Euclidean(HistComparator):
     def compare(self, h1, h2):
         return numpy.linalg.norm(h1 - h2)
 
+    def compare_many(self, query, matrix):
+        if isinstance(matrix, EncodedRows):
+            query = numpy.asarray(query, dtype=numpy.float64)
+            return numpy.sqrt(numpy.maximum(matrix.squared_norms() - 2 * matrix.dot(query) + query.dot(query), 0))
+        return numpy.linalg.norm(matrix - query, axis=1)
+
+    def compare_many_queries(self, queries, matrix):
+        if isinstance(matrix, EncodedRows):
+            return HistComparator.compare_many_queries(self, queries, matrix)
+        queries = numpy.asarray(queries, dtype=numpy.float64)
+        matrix = numpy.asarray(matrix, dtype=numpy.float64)
+        squared = numpy.einsum('ij,ij->i', queries, queries)[:, numpy.newaxis] - 2 * queries.dot(matrix.T) + \
+            numpy.einsum('ij,ij->i', matrix, matrix)
+        return numpy.sqrt(numpy.maximum(squared, 0))
+
 
 class CosineAngle(HistComparator):
     reversed = True
@@ -75,6 +179,19 @@ class CosineAngle(HistComparator):
     def compare(self, h1, h2):
         return cosine_angle(h1, h2)
 
+    def compare_many(self, query, matrix):
+        if isinstance(matrix, EncodedRows):
+            return matrix.dot(unit_vector(query)) / numpy.sqrt(matrix.squared_norms())
+        return matrix.dot(unit_vector(query)) / numpy.linalg.norm(matrix, axis=1)
+
+    def compare_many_queries(self, queries, matrix):
+        if isinstance(matrix, EncodedRows):
+            return HistComparator.compare_many_queries(self, queries, matrix)
+        queries = numpy.asarray(queries, dtype=numpy.float64)
+        matrix = numpy.asarray(matrix, dtype=numpy.float64)
+        units = queries / numpy.linalg.norm(queries, axis=1)[:, numpy.newaxis]
+        return units.dot(matrix.T) / numpy.linalg.norm(matrix, axis=1)
+
 
 def unit_vector(vector):
     """Returns the unit vector of the vector."""
@@ -86,3 +203,26 @@ def cosine_angle(v1, v2):
     v1_u = unit_vector(v1)
     v2_u = unit_vector(v2)
     return numpy.dot(v1_u, v2_u)
+
+
+def bhattacharyya_distance(query, matrix):
+    """Returns OpenCV Bhattacharyya (Hellinger) distance between query and every row of matrix."""
+    query = numpy.asarray(query, dtype=numpy.float64)
+    if isinstance(matrix, EncodedRows):
+        s1 = matrix.row_sums() * query.sum()
+        s12 = matrix.sqrt_dot(numpy.sqrt(query))
+    else:
+        s1 = matrix.sum(axis=1, dtype=numpy.float64) * query.sum()
+        s12 = numpy.sqrt(numpy.asarray(matrix, dtype=numpy.float64)).dot(numpy.sqrt(query))
+    s1 = numpy.divide(1., numpy.sqrt(numpy.abs(s1)), out=numpy.ones_like(s1), where=numpy.abs(s1) > FLT_EPSILON)
+    return numpy.sqrt(numpy.maximum(1. - s12 * s1, 0.))
+
+
+def bhattacharyya_distances(queries, matrix):
+    """Returns (len(queries), len(matrix)) OpenCV Bhattacharyya (Hellinger) distances of dense histograms."""
+    queries = numpy.asarray(queries, dtype=numpy.float64)
+    matrix = numpy.asarray(matrix, dtype=numpy.float64)
+    s1 = queries.sum(axis=1)[:, numpy.newaxis] * matrix.sum(axis=1)
+    s12 = numpy.sqrt(queries).dot(numpy.sqrt(matrix).T)
+    s1 = numpy.divide(1., numpy.sqrt(numpy.abs(s1)), out=numpy.ones_like(s1), where=numpy.abs(s1) > FLT_EPSILON)
+    return numpy.sqrt(numpy.maximum(1. - s12 * s1, 0.))
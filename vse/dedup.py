@@ -0,0 +1,197 @@
+"""Near-duplicate detection
+
+Self-join of an index: every pair of indexed images is scored once by the ranker and comparator of the index
+and the pairs passing a threshold are streamed in chunks. Histograms are read from the index, weighed and written
+to temporary files block by block, and the files are mapped into memory, so that only block_size histograms
+are held at once besides the mapped files. Rows are scored in blocks of block_size x block_size with
+compare_many_queries. With cutoff, only pairs sharing a visual word above cutoff (like InvertedIndex) are scored.
+Blocks of rows are processed in a pool of processes mapping the same files, so that the arrays are kept once
+in the page cache rather than copied into every process.
+"""
+
+import collections
+import concurrent.futures
+import os
+import tempfile
+
+import numpy
+
+from vse.utils import batches
+
+__all__ = ['near_duplicates',
+           'SelfJoin',
+           ]
+
+
+def near_duplicates(index, threshold, block_size=1024, cutoff=None, processes=None, max_in_flight=None):
+    """Yields lists of (image_id_a, image_id_b, score) pairs of images in index whose score passes threshold,
+    i.e. is at least threshold for similarity comparators and at most threshold for distances.
+    Every pair is reported once, image_id_a being the one listed first by index.iter_items().
+    A list is yielded for every block of block_size images. processes defaults to the number of CPUs,
+    0 joins in the calling process. At most max_in_flight blocks are processed at once.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        join, image_ids = SelfJoin.from_items(index.iter_items(), index.ranker, index.vw_freq, threshold, directory,
+                                              block_size, cutoff)
+        if not image_ids:
+            return
+        blocks = [(start, min(start + block_size, len(image_ids))) for start in range(0, len(image_ids), block_size)]
+        for rows_a, rows_b, scores in _join_blocks(join, blocks, os.cpu_count() if processes is None else processes,
+                                                   max_in_flight):
+            yield [(image_ids[a], image_ids[b], float(score)) for a, b, score in zip(rows_a, rows_b, scores)]
+
+
+MappedArray = collections.namedtuple('MappedArray', 'filename dtype shape')
+
+
+class SelfJoin:
+    """Scores pairs of rows of a histogram matrix, each row against the rows following it."""
+    arrays = ('queries', 'items', 'row_words', 'row_offsets', 'word_rows', 'word_offsets')
+
+    def __init__(self, hists, ranker, freq_vector, threshold, block_size=1024, cutoff=None):
+        self.queries = numpy.asarray(ranker.weigh_queries(hists, freq_vector), dtype=numpy.float32)
+        self.items = numpy.asarray(ranker.weigh_items(hists, freq_vector), dtype=numpy.float32)
+        self.comparator = ranker.hist_comparator
+        self.threshold = threshold
+        self.block_size = block_size
+        self.row_words = self.row_offsets = self.word_rows = self.word_offsets = None
+        if cutoff is not None:
+            self.row_words, self.row_offsets, self.word_rows, self.word_offsets = _postings(
+                *numpy.nonzero(hists > cutoff / hists.shape[1]), *hists.shape)
+
+    @classmethod
+    def from_items(cls, items, ranker, freq_vector, threshold, directory, block_size=1024, cutoff=None):
+        """Returns join of (image_id, hist) pairs and list of their image ids. Histograms are weighed block_size
+        at a time and written straight to files in directory, which are mapped like by share.
+        """
+        join = cls(numpy.empty((0, len(freq_vector)), dtype=numpy.float32), ranker, freq_vector, threshold, block_size)
+        image_ids, rows, words = [], [], []
+        filenames = {name: os.path.join(directory, name) for name in ('queries', 'items')}
+        columns = 0
+        with open(filenames['queries'], 'wb') as queries, open(filenames['items'], 'wb') as weighted_items:
+            for block in batches(items, block_size):
+                hists = numpy.array([numpy.ravel(hist) for image_id, hist in block], dtype=numpy.float32)
+                columns = hists.shape[1]
+                queries.write(numpy.asarray(ranker.weigh_queries(hists, freq_vector), dtype=numpy.float32).tobytes())
+                weighted_items.write(numpy.asarray(ranker.weigh_items(hists, freq_vector),
+                                                   dtype=numpy.float32).tobytes())
+                if cutoff is not None:
+                    block_rows, block_words = numpy.nonzero(hists > cutoff / columns)
+                    rows.append(block_rows + len(image_ids))
+                    words.append(block_words)
+                image_ids.extend(image_id for image_id, hist in block)
+        if not image_ids:
+            return join, image_ids
+        for name, filename in filenames.items():
+            setattr(join, name, numpy.memmap(filename, numpy.float32, 'r', shape=(len(image_ids), columns)))
+        if cutoff is not None:
+            join.row_words, join.row_offsets, join.word_rows, join.word_offsets = _postings(
+                numpy.concatenate(rows), numpy.concatenate(words), len(image_ids), columns)
+            join.share(directory)
+        return join, image_ids
+
+    def share(self, directory):
+        """Saves arrays to files in directory and maps them read-only. Pickled join refers to the files."""
+        for name in self.arrays:
+            array = getattr(self, name)
+            if array is not None and array.size and not isinstance(array, numpy.memmap):
+                filename = os.path.join(directory, name)
+                array.tofile(filename)
+                setattr(self, name, numpy.memmap(filename, array.dtype, 'r', shape=array.shape))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in self.arrays:
+            if isinstance(state[name], numpy.memmap):
+                state[name] = MappedArray(state[name].filename, state[name].dtype.str, state[name].shape)
+        return state
+
+    def __setstate__(self, state):
+        for name in self.arrays:
+            if isinstance(state[name], MappedArray):
+                state[name] = numpy.memmap(state[name].filename, state[name].dtype, 'r', shape=state[name].shape)
+        self.__dict__.update(state)
+
+    def passes(self, scores):
+        if self.comparator.reversed:
+            return scores >= self.threshold
+        return scores <= self.threshold
+
+    def block(self, start, stop):
+        """Returns (rows_a, rows_b, scores) arrays of passing pairs of rows start:stop with rows following them."""
+        if self.row_words is not None:
+            return self._candidate_block(start, stop)
+        rows_a, rows_b, scores = [], [], []
+        for column_start in range(start, len(self.items), self.block_size):
+            column_stop = min(column_start + self.block_size, len(self.items))
+            block_scores = self.comparator.compare_many_queries(self.queries[start:stop],
+                                                                self.items[column_start:column_stop])
+            following = numpy.arange(column_start, column_stop) > numpy.arange(start, stop)[:, numpy.newaxis]
+            a, b = numpy.nonzero(self.passes(block_scores) & following)
+            rows_a.append(a + start)
+            rows_b.append(b + column_start)
+            scores.append(block_scores[a, b])
+        return numpy.concatenate(rows_a), numpy.concatenate(rows_b), numpy.concatenate(scores)
+
+    def _candidate_block(self, start, stop):
+        """Scores every row only against following rows sharing a visual word with it."""
+        rows_a, rows_b, scores = [], [], []
+        for row in range(start, stop):
+            words = self.row_words[self.row_offsets[row]:self.row_offsets[row + 1]]
+            if len(words) == 0:
+                continue
+            offsets = self.word_offsets
+            candidates = numpy.unique(numpy.concatenate([self.word_rows[offsets[word]:offsets[word + 1]]
+                                                         for word in words]))
+            candidates = candidates[candidates > row]
+            if len(candidates) == 0:
+                continue
+            row_scores = self.comparator.compare_many(self.queries[row], self.items[candidates])
+            passing = numpy.flatnonzero(self.passes(row_scores))
+            rows_a.append(numpy.full(len(passing), row))
+            rows_b.append(candidates[passing])
+            scores.append(row_scores[passing])
+        if not rows_a:
+            return numpy.empty(0, dtype=numpy.int64), numpy.empty(0, dtype=numpy.int64), numpy.empty(0)
+        return numpy.concatenate(rows_a), numpy.concatenate(rows_b), numpy.concatenate(scores)
+
+
+def _postings(rows, words, row_count, word_count):
+    """Returns words of every row and rows of every word given (rows, words) positions of a boolean matrix in row
+    order, as CSR arrays: row_words, row_offsets, word_rows, word_offsets. Words of row i are
+    row_words[row_offsets[i]:row_offsets[i + 1]].
+    """
+    row_offsets = numpy.concatenate(([0], numpy.cumsum(numpy.bincount(rows, minlength=row_count))))
+    word_offsets = numpy.concatenate(([0], numpy.cumsum(numpy.bincount(words, minlength=word_count))))
+    return words, row_offsets, rows[numpy.argsort(words, kind='stable')], word_offsets
+
+
+def _join_blocks(join, blocks, processes, max_in_flight):
+    """Yields results of join.block for every (start, stop) block in order. Arrays of join processed in processes
+    should be shared (see share), otherwise they are copied into every process.
+    """
+    if not processes:
+        for start, stop in blocks:
+            yield join.block(start, stop)
+        return
+    max_in_flight = max_in_flight or 2 * processes
+    with concurrent.futures.ProcessPoolExecutor(processes, initializer=_init_worker, initargs=(join,)) as executor:
+        in_flight = collections.deque()
+        for start, stop in blocks:
+            if len(in_flight) == max_in_flight:
+                yield in_flight.popleft().result()
+            in_flight.append(executor.submit(_worker_block, start, stop))
+        while in_flight:
+            yield in_flight.popleft().result()
+
+
+_worker_join = None
+
+
+def _init_worker(join):
+    global _worker_join
+    _worker_join = join
+
+
+def _worker_block(start, stop):
+    return _worker_join.block(start, stop)
@@ -0,0 +1,446 @@
+"""Histogram matrix encodings
+
+Indexes keep histograms in a growable matrix. Besides dense float32 rows, histograms can be stored as:
+
+    float16     dense half precision rows, 2 bytes per visual word
+    uint8       rows scalar-quantized to 0..255 with per-row float32 scale, 1 byte per visual word
+    sparse      CSR rows: nonzero visual words (uint16 if vocabulary has at most 65536 words) and float32 values
+
+Views of uint8 and sparse matrices are EncodedRows. Comparators score them without decoding where the metric
+can be computed from row sums, dot products, squared norms, sums of minimums or dot products of square roots;
+other metrics and weighing rankers decode rows to float32 through numpy.asarray.
+"""
+
+import collections
+from abc import ABCMeta, abstractmethod
+
+import numpy
+
+__all__ = ['ENCODINGS',
+           'EncodedRows',
+           'HistMatrix',
+           'QuantizedHistMatrix',
+           'SparseHistMatrix',
+           'create_hist_matrix',
+           ]
+
+ENCODINGS = ('float32', 'float16', 'uint8', 'sparse')
+
+WeightedRows = collections.namedtuple('WeightedRows', 'weigh freq_vector matrix')
+
+
+def create_hist_matrix(encoding='float32'):
+    """Returns empty histogram matrix storing rows with encoding, one of ENCODINGS."""
+    if encoding == 'float32':
+        return HistMatrix()
+    if encoding == 'float16':
+        return HistMatrix(numpy.float16)
+    if encoding == 'uint8':
+        return QuantizedHistMatrix()
+    if encoding == 'sparse':
+        return SparseHistMatrix()
+    raise ValueError('Unknown encoding {}, expected one of {}'.format(encoding, ', '.join(ENCODINGS)))
+
+
+class HistMatrix:
+    """Growable matrix keeping histograms as rows of one contiguous array.
+    Optionally keeps a cache of weighted rows, see weighted_rows.
+    """
+
+    def __init__(self, dtype=numpy.float32, capacity=1024):
+        self.dtype = dtype
+        self.initial_capacity = capacity
+        self.data = None
+        self.columns = None
+        self.size = 0
+        self.weighted_cache = None
+
+    @property
+    def encoding(self):
+        """Encoding of rows, one of ENCODINGS."""
+        return 'float16' if self.dtype == numpy.float16 else 'float32'
+
+    @property
+    def weighted(self):
+        """Cached weighted rows (allocated with capacity of data) or None."""
+        return None if self.weighted_cache is None else self.weighted_cache.matrix
+
+    def view(self):
+        """Returns matrix of stored rows without copying."""
+        if self.data is None:
+            return numpy.empty((0, 0), dtype=self.dtype)
+        return self.data[:self.size]
+
+    def weighted_rows(self, weigh, freq_vector, tolerance):
+        """Returns WeightedRows of the cache: rows weighted with weigh(matrix, freq) function. Weighted rows are
+        reweighed only if freq_vector differs from the cached one by more than tolerance (relative L1 distance).
+        A reweighed cache replaces the old one at once, so that concurrent readers of a matrix, which is no longer
+        modified, always get consistent rows and frequency.
+        """
+        cache = self.weighted_cache
+        if cache is None or cache.weigh != weigh or frequency_drift(cache.freq_vector, freq_vector) > tolerance:
+            freq_vector = numpy.array(freq_vector, dtype=numpy.float32)
+            matrix = numpy.empty((0, 0), dtype=numpy.float32)
+            if self.columns is not None:
+                matrix = numpy.empty((self.capacity(), self.columns), dtype=numpy.float32)
+                matrix[:self.size] = weigh(self.view(), freq_vector)
+            cache = self.weighted_cache = WeightedRows(weigh, freq_vector, matrix)
+        return cache
+
+    def capacity(self):
+        return 0 if self.data is None else len(self.data)
+
+    def append(self, hist):
+        """Appends histogram as the last row. Returns its row number."""
+        hist = numpy.ravel(hist)
+        if self.columns is None:
+            self.columns = hist.size
+            self._allocate(self.initial_capacity)
+            self.weighted_cache = None
+        elif self.size == self.capacity():
+            self._reserve(max(self.initial_capacity, 2 * self.capacity()))
+        self._check_columns(hist)
+        row = self.size
+        self._store(row, hist)
+        self.size += 1
+        self._weigh_row(row)
+        return row
+
+    def _check_columns(self, hist):
+        if hist.size != self.columns:
+            raise ValueError('Histogram of {} visual words does not match rows of {}'.format(hist.size, self.columns))
+
+    def _allocate(self, capacity):
+        self.data = numpy.empty((capacity, self.columns), dtype=self.dtype)
+
+    def move(self, source, destination):
+        """Copies row source over row destination."""
+        self.data[destination] = self.data[source]
+        if self.weighted is not None:
+            self.weighted[destination] = self.weighted[source]
+
+    def truncate(self, size):
+        """Drops rows starting from size."""
+        self.size = size
+
+    def _reserve(self, capacity):
+        data = numpy.empty((capacity, self.data.shape[1]), dtype=self.dtype)
+        data[:self.size] = self.data[:self.size]
+        self.data = data
+        self._reserve_weighted(capacity)
+
+    def _reserve_weighted(self, capacity):
+        if self.weighted_cache is not None:
+            weighted = numpy.empty((capacity, self.columns), dtype=numpy.float32)
+            weighted[:self.size] = self.weighted[:self.size]
+            self.weighted_cache = self.weighted_cache._replace(matrix=weighted)
+
+    def __getitem__(self, row):
+        """Returns copy of row decoded to float32."""
+        if not 0 <= row < self.size:
+            raise IndexError(row)
+        return self._load(row)
+
+    def _load(self, row):
+        return numpy.array(self.data[row], dtype=numpy.float32)
+
+    def __setitem__(self, row, hist):
+        if not 0 <= row < self.size:
+            raise IndexError(row)
+        hist = numpy.ravel(hist)
+        self._check_columns(hist)
+        self._store(row, hist)
+        self._weigh_row(row)
+
+    def _weigh_row(self, row):
+        cache = self.weighted_cache
+        if cache is not None:
+            cache.matrix[row] = cache.weigh(self._load(row)[numpy.newaxis], cache.freq_vector)[0]
+
+    def _store(self, row, hist):
+        self.data[row] = hist
+
+    def __len__(self):
+        return self.size
+
+    def __setstate__(self, state):
+        if 'columns' not in state:
+            state['columns'] = None if state['data'] is None else state['data'].shape[1]
+        self.__dict__.update(state)
+
+
+class QuantizedHistMatrix(HistMatrix):
+    """HistMatrix keeping rows as uint8 codes, row = codes * scale, scale = max(row) / 255."""
+
+    encoding = 'uint8'
+
+    def __init__(self, capacity=1024):
+        HistMatrix.__init__(self, numpy.uint8, capacity)
+        self.scales = None
+
+    def view(self):
+        if self.data is None:
+            return numpy.empty((0, 0), dtype=numpy.float32)
+        return QuantizedRows(self.data[:self.size], self.scales[:self.size])
+
+    def _allocate(self, capacity):
+        HistMatrix._allocate(self, capacity)
+        self.scales = numpy.zeros(capacity, dtype=numpy.float32)
+
+    def move(self, source, destination):
+        self.scales[destination] = self.scales[source]
+        HistMatrix.move(self, source, destination)
+
+    def _reserve(self, capacity):
+        scales = numpy.zeros(capacity, dtype=numpy.float32)
+        scales[:self.size] = self.scales[:self.size]
+        self.scales = scales
+        HistMatrix._reserve(self, capacity)
+
+    def _load(self, row):
+        return self.data[row] * self.scales[row]
+
+    def _store(self, row, hist):
+        maximum = float(hist.max()) if hist.size else 0.
+        scale = numpy.float32(maximum / 255) if maximum > 0 else numpy.float32(0)
+        self.scales[row] = scale
+        self.data[row] = numpy.rint(hist / scale) if scale > 0 else 0
+
+
+class SparseHistMatrix(HistMatrix):
+    """HistMatrix keeping nonzero values of rows. Rows are (start, length) ranges of shared indices and values
+    arrays, a row written again is appended to their end. The arrays are compacted into CSR row order
+    when the matrix is viewed after such writes or when half of them is garbage.
+    """
+    encoding = 'sparse'
+
+    def __init__(self, capacity=1024):
+        HistMatrix.__init__(self, numpy.float32, capacity)
+        self.starts = None
+        self.lengths = None
+        self.indices = None
+        self.values = None
+        self.used = 0
+        self.ordered = True
+
+    def capacity(self):
+        return 0 if self.starts is None else len(self.starts)
+
+    def view(self):
+        if self.starts is None:
+            return numpy.empty((0, 0), dtype=numpy.float32)
+        if not self.ordered:
+            self._compact()
+        indptr = numpy.append(self.starts[:self.size], self.used)
+        return SparseRows(indptr, self.indices[:self.used], self.values[:self.used], self.columns)
+
+    def _allocate(self, capacity):
+        self.starts = numpy.zeros(capacity, dtype=numpy.int64)
+        self.lengths = numpy.zeros(capacity, dtype=numpy.int64)
+        index_dtype = numpy.uint16 if self.columns <= numpy.iinfo(numpy.uint16).max + 1 else numpy.uint32
+        self.indices = numpy.empty(capacity, dtype=index_dtype)
+        self.values = numpy.empty(capacity, dtype=numpy.float32)
+
+    def _reserve(self, capacity):
+        for name in ('starts', 'lengths'):
+            array = numpy.zeros(capacity, dtype=numpy.int64)
+            array[:self.size] = getattr(self, name)[:self.size]
+            setattr(self, name, array)
+        self._reserve_weighted(capacity)
+
+    def _reserve_values(self, count):
+        """Makes room for count values at the end, compacting rows if at least half of values is garbage."""
+        if self.used + count <= len(self.values):
+            return
+        live = int(self.lengths[:self.size].sum())
+        if live + count <= len(self.values) // 2:
+            self._compact()
+            return
+        capacity = max(2 * len(self.values), live + count)
+        for name in ('indices', 'values'):
+            array = getattr(self, name)
+            resized = numpy.empty(capacity, dtype=array.dtype)
+            resized[:self.used] = array[:self.used]
+            setattr(self, name, resized)
+
+    def _compact(self):
+        lengths = self.lengths[:self.size]
+        indptr = numpy.concatenate(([0], numpy.cumsum(lengths)))
+        positions = _ranges(self.starts[:self.size], lengths)
+        capacity = max(len(self.values), 1)
+        indices = numpy.empty(capacity, dtype=self.indices.dtype)
+        values = numpy.empty(capacity, dtype=numpy.float32)
+        indices[:len(positions)] = self.indices[positions]
+        values[:len(positions)] = self.values[positions]
+        self.indices, self.values = indices, values
+        self.starts[:self.size] = indptr[:-1]
+        self.used = int(indptr[-1])
+        self.ordered = True
+
+    def move(self, source, destination):
+        self.starts[destination] = self.starts[source]
+        self.lengths[destination] = self.lengths[source]
+        self.ordered = False
+        if self.weighted is not None:
+            self.weighted[destination] = self.weighted[source]
+
+    def truncate(self, size):
+        if size < self.size:
+            self.lengths[size:self.size] = 0
+            self.ordered = False
+        self.size = size
+
+    def _load(self, row):
+        hist = numpy.zeros(self.columns, dtype=numpy.float32)
+        start, length = self.starts[row], self.lengths[row]
+        hist[self.indices[start:start + length]] = self.values[start:start + length]
+        return hist
+
+    def _store(self, row, hist):
+        nonzero = numpy.flatnonzero(hist)
+        self._reserve_values(len(nonzero))
+        last_end = self.starts[row - 1] + self.lengths[row - 1] if row > 0 else 0
+        self.ordered = self.ordered and row >= self.size - 1 and self.lengths[row] == 0 and self.used == last_end
+        self.indices[self.used:self.used + len(nonzero)] = nonzero
+        self.values[self.used:self.used + len(nonzero)] = hist[nonzero]
+        self.starts[row] = self.used
+        self.lengths[row] = len(nonzero)
+        self.used += len(nonzero)
+
+
+class EncodedRows(metaclass=ABCMeta):
+    """Read-only view of encoded histogram rows. numpy.asarray decodes it to float32 matrix."""
+    block_size = 4096
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        matrix = numpy.empty(self.shape, dtype=numpy.float32)
+        for start, block in self.blocks():
+            matrix[start:start + len(block)] = block
+        return matrix if dtype is None else matrix.astype(dtype, copy=False)
+
+    @abstractmethod
+    def blocks(self):
+        """Yields (first row, decoded float32 block of rows)."""
+        pass
+
+    def row_sums(self):
+        return numpy.concatenate([block.sum(axis=1, dtype=numpy.float64) for _, block in self.blocks()] or [[]])
+
+    def dot(self, vector):
+        vector = numpy.asarray(vector, dtype=numpy.float64)
+        return numpy.concatenate([block.dot(vector) for _, block in self.blocks()] or [[]])
+
+    def squared_norms(self):
+        return numpy.concatenate([numpy.einsum('ij,ij->i', block, block, dtype=numpy.float64)
+                                  for _, block in self.blocks()] or [[]])
+
+    def minimum_sums(self, vector):
+        """Returns sum of element-wise minimum of vector and every row."""
+        return numpy.concatenate([numpy.minimum(block, vector).sum(axis=1, dtype=numpy.float64)
+                                  for _, block in self.blocks()] or [[]])
+
+    def sqrt_dot(self, vector):
+        """Returns dot products of square roots of every row with vector."""
+        vector = numpy.asarray(vector, dtype=numpy.float64)
+        return numpy.concatenate([numpy.sqrt(block).dot(vector) for _, block in self.blocks()] or [[]])
+
+
+class QuantizedRows(EncodedRows):
+    def __init__(self, codes, scales):
+        self.codes = codes
+        self.scales = scales
+        self.shape = codes.shape
+
+    def __getitem__(self, rows):
+        return QuantizedRows(self.codes[rows], self.scales[rows])
+
+    def blocks(self):
+        for start in range(0, len(self.codes), self.block_size):
+            codes = self.codes[start:start + self.block_size]
+            yield start, codes * self.scales[start:start + self.block_size, numpy.newaxis]
+
+    def row_sums(self):
+        return self.codes.sum(axis=1, dtype=numpy.float64) * self.scales
+
+    def dot(self, vector):
+        vector = numpy.asarray(vector, dtype=numpy.float32)
+        return numpy.concatenate([self.codes[start:start + self.block_size].dot(vector)
+                                  for start in range(0, len(self.codes), self.block_size)] or [[]]) * self.scales
+
+    def squared_norms(self):
+        return numpy.einsum('ij,ij->i', self.codes, self.codes, dtype=numpy.float64) * numpy.square(
+            self.scales, dtype=numpy.float64)
+
+
+class SparseRows(EncodedRows):
+    """CSR rows: values of row i are values[indptr[i]:indptr[i + 1]] at columns indices[indptr[i]:indptr[i + 1]]."""
+
+    def __init__(self, indptr, indices, values, columns):
+        self.indptr = indptr
+        self.indices = indices
+        self.values = values
+        self.shape = (len(indptr) - 1, columns)
+        self._row_of = None
+
+    def row_of(self):
+        """Returns row number of every stored value."""
+        if self._row_of is None:
+            self._row_of = numpy.repeat(numpy.arange(self.shape[0]), numpy.diff(self.indptr))
+        return self._row_of
+
+    def __getitem__(self, rows):
+        rows = numpy.arange(self.shape[0])[rows]
+        starts = self.indptr[:-1][rows]
+        lengths = self.indptr[1:][rows] - starts
+        positions = _ranges(starts, lengths)
+        indptr = numpy.concatenate(([0], numpy.cumsum(lengths)))
+        return SparseRows(indptr, self.indices[positions], self.values[positions], self.shape[1])
+
+    def blocks(self):
+        for start in range(0, self.shape[0], self.block_size):
+            stop = min(start + self.block_size, self.shape[0])
+            block = numpy.zeros((stop - start, self.shape[1]), dtype=numpy.float32)
+            first, last = self.indptr[start], self.indptr[stop]
+            block[self.row_of()[first:last] - start, self.indices[first:last]] = self.values[first:last]
+            yield start, block
+
+    def _row_totals(self, values):
+        return numpy.bincount(self.row_of(), weights=values, minlength=self.shape[0])
+
+    def row_sums(self):
+        return self._row_totals(self.values)
+
+    def dot(self, vector):
+        return self._row_totals(self.values * numpy.asarray(vector, dtype=numpy.float64)[self.indices])
+
+    def squared_norms(self):
+        return self._row_totals(numpy.square(self.values, dtype=numpy.float64))
+
+    def minimum_sums(self, vector):
+        vector = numpy.asarray(vector)
+        if numpy.any(vector < 0):
+            return EncodedRows.minimum_sums(self, vector)
+        return self._row_totals(numpy.minimum(self.values, vector[self.indices]))
+
+    def sqrt_dot(self, vector):
+        return self._row_totals(numpy.sqrt(self.values, dtype=numpy.float64)
+                                * numpy.asarray(vector, dtype=numpy.float64)[self.indices])
+
+
+def _ranges(starts, lengths):
+    """Returns concatenated ranges [start, start + length) as one array."""
+    total = int(lengths.sum())
+    offsets = numpy.repeat(starts - numpy.concatenate(([0], numpy.cumsum(lengths)[:-1])), lengths)
+    return offsets + numpy.arange(total)
+
+
+def frequency_drift(cached_freq, freq_vector):
+    """Returns relative L1 distance between frequency vectors, infinity if they are not comparable."""
+    if cached_freq is None or numpy.shape(cached_freq) != numpy.shape(freq_vector):
+        return numpy.inf
+    total = cached_freq.sum(dtype=numpy.float64)
+    drift = numpy.abs(numpy.subtract(freq_vector, cached_freq, dtype=numpy.float64)).sum()
+    return drift / total if total > 0 else (numpy.inf if drift > 0 else 0.)
@@ -8,68 +8,371 @@ comparison consist in their histograms comparison.
 
 """
 
+import collections
+import concurrent.futures
+import functools
+import os
+import time
+
 import cv2
+import numpy
+from vse import instrument
+from vse.cache import configuration_fingerprint, image_key
+from vse.error import VisualSearchEngineError
+from vse.features import DEFAULT_FEATURE, check_vocabulary_feature, create_extractor, extractor_feature, is_binary, \
+    load_vocabulary, save_vocabulary
 from vse.index import InvertedIndex
+from vse.quantizer import MatcherQuantizer, words_hist
 from vse.ranker import SimpleRanker
 from vse.comparator import Intersection
-from vse.utils import load, save
+from vse.utils import batches, load_image, load_image_from_buf
+from vse.verify import image_features
+from vse.vocabulary import VocabularyTree, kmajority
 
 
-def create_vse(vocabulary_path, recognized_visual_words=1000):
-    """Create visual search engine with default configuration."""
+def create_vse(vocabulary_path, recognized_visual_words=1000, quantizer_factory=None, feature=None,
+               keypoint_budget=None):
+    """Create visual search engine with default configuration.
+    quantizer_factory is called with vocabulary, e.g. BruteForceQuantizer, by default cv2.BFMatcher is used.
+    feature (see vse.features) defaults to the one the vocabulary is tagged with, SURF for untagged vocabularies.
+    keypoint_budget (KeypointBudget) limits key points of every image, also in worker processes.
+    """
     ranker = SimpleRanker(hist_comparator=Intersection())
     inverted_index = InvertedIndex(ranker=ranker, recognized_visual_words=recognized_visual_words)
-    bag_of_visual_words = BagOfVisualWords(extractor=cv2.xfeatures2d.SURF_create(),
-                                           matcher=cv2.BFMatcher(normType=cv2.NORM_L2),
-                                           vocabulary=load(vocabulary_path))
-    return VisualSearchEngine(inverted_index, bag_of_visual_words)
+    bag_of_visual_words_factory = functools.partial(create_bag_of_visual_words, vocabulary_path, quantizer_factory,
+                                                    feature, keypoint_budget)
+    return VisualSearchEngine(inverted_index, bag_of_visual_words_factory(), bag_of_visual_words_factory)
+
+
+def create_bag_of_visual_words(vocabulary_path, quantizer_factory=None, feature=None, keypoint_budget=None):
+    """Create bag of visual words with default configuration. Vocabulary trees (.npz files) are used as quantizers.
+    Descriptors are matched with the norm of feature extractor, Hamming distance for binary features.
+    Raises VocabularyFeatureError if vocabulary was trained for another feature.
+    """
+    if vocabulary_path.endswith('.npz'):
+        tree = VocabularyTree.load(vocabulary_path, feature)
+        return BagOfVisualWords(extractor=create_extractor(tree.feature or DEFAULT_FEATURE), matcher=None,
+                                vocabulary=tree.vocabulary, quantizer=tree, keypoint_budget=keypoint_budget)
+    vocabulary, feature = load_vocabulary(vocabulary_path, feature)
+    if feature is None:
+        feature = check_vocabulary_feature(vocabulary_path, None, vocabulary.dtype == numpy.uint8, DEFAULT_FEATURE)
+    extractor = create_extractor(feature)
+    return BagOfVisualWords(extractor=extractor,
+                            matcher=cv2.BFMatcher(normType=extractor.defaultNorm()),
+                            vocabulary=vocabulary,
+                            quantizer=quantizer_factory(vocabulary) if quantizer_factory else None,
+                            keypoint_budget=keypoint_budget)
 
 
 class VisualSearchEngine:
-    def __init__(self, image_index, bag_of_visual_words):
+    """Visual search engine. bag_of_visual_words_factory is a picklable callable creating
+    bag of visual words in worker processes, OpenCV objects cannot be sent between processes.
+    If hist_cache (HistCache) is given, histograms of repeated images are not generated again.
+    If verifier (GeometricVerifier) is given, key point positions and visual words of indexed images are kept
+    and find_similar re-ranks its top results geometrically. Features are then always extracted, hist_cache is not used.
+    """
+
+    def __init__(self, image_index, bag_of_visual_words, bag_of_visual_words_factory=None, hist_cache=None,
+                 verifier=None):
         self.image_index = image_index
         self.bag_of_visual_words = bag_of_visual_words
+        self.bag_of_visual_words_factory = bag_of_visual_words_factory
+        self.hist_cache = hist_cache
+        self.verifier = verifier
 
     def add_to_index(self, image_id, image):
         """Adds image id and its histogram to index. Argument image contains binary image."""
-        hist = self.bag_of_visual_words.generate_hist(image)
+        if self.verifier is None:
+            self.image_index[image_id] = self._generate_hist(image)
+            return
+        hist, features = self._generate_features(image)
         self.image_index[image_id] = hist
+        self.verifier.features[image_id] = features
+
+    def _generate_hist(self, image):
+        if self.hist_cache is None:
+            return self.bag_of_visual_words.generate_hist(read_image(image))
+        return self.hist_cache.get_or_generate(image, lambda image: self.bag_of_visual_words.generate_hist(
+            read_image(image)), self.cache_fingerprint)
+
+    @property
+    def cache_fingerprint(self):
+        """Fingerprint of bag of visual words included in histogram cache keys."""
+        return getattr(self.bag_of_visual_words, 'fingerprint', '')
+
+    def _cache_key(self, image):
+        return image_key(image, self.cache_fingerprint)
+
+    def _generate_features(self, image):
+        return self.bag_of_visual_words.generate_features(read_image(image))
+
+    def add_many(self, images, processes=None, max_in_flight=None, batch_size=256, progress=None):
+        """Adds (image_id, image) pairs to index. Image can be a file path, an encoded image buffer or a loaded image.
+        Histograms are generated in a pool of processes (serially if processes is 0 or there is no
+        bag_of_visual_words_factory) and inserted in batches. At most max_in_flight images are processed at once.
+        progress(processed, failed, images_per_second) is called after every batch.
+        Returns list of (image_id, error) in input order for images which were not added.
+        """
+        processes = self._processes(processes)
+        errors = []
+        processed = 0
+        start = time.perf_counter()
+        for batch in batches(self._generate_hists(images, processes, max_in_flight), batch_size):
+            items = [(image_id, hist) for image_id, hist, features, error in batch if error is None]
+            rejected = _rejected_positions(items, self.image_index.add_many(items))
+            position = 0
+            for image_id, hist, features, error in batch:
+                if error is None:
+                    error = rejected.get(position)
+                    position += 1
+                if error is not None:
+                    errors.append((image_id, error))
+                elif features is not None:
+                    self.verifier.features[image_id] = features
+            processed += len(batch)
+            if progress:
+                progress(processed, len(errors), processed / max(time.perf_counter() - start, 1e-9))
+        return errors
+
+    def _processes(self, processes):
+        if processes is None:
+            return os.cpu_count() if self.bag_of_visual_words_factory else 0
+        if processes and not self.bag_of_visual_words_factory:
+            raise ValueError('bag_of_visual_words_factory is required to process images in processes')
+        return processes
+
+    def _generate_hists(self, images, processes, max_in_flight):
+        """Yields (image_id, hist, features, error) in input order, features are None without verifier."""
+        if not processes:
+            for image_id, image in images:
+                try:
+                    hist, features = self._generate(image)
+                except VisualSearchEngineError as error:
+                    yield image_id, None, None, error
+                else:
+                    yield image_id, hist, features, None
+            return
+        max_in_flight = max_in_flight or 4 * processes
+        with concurrent.futures.ProcessPoolExecutor(processes, initializer=_init_worker,
+                                                    initargs=(self.bag_of_visual_words_factory,)) as executor:
+            in_flight = collections.deque()
+            for image_id, image in images:
+                if len(in_flight) == max_in_flight:
+                    yield self._future_result(*in_flight.popleft())
+                if self.verifier is not None:
+                    in_flight.append((image_id, None, executor.submit(_worker_generate_features, image)))
+                    continue
+                try:
+                    key = self._cache_key(image) if self.hist_cache is not None else None
+                except VisualSearchEngineError as error:
+                    in_flight.append((image_id, None, _failed(error)))
+                    continue
+                hist = self.hist_cache.get(key) if key is not None else None
+                if hist is None:
+                    in_flight.append((image_id, key, executor.submit(_worker_generate_hist, image)))
+                else:
+                    in_flight.append((image_id, None, _completed(hist)))
+            while in_flight:
+                yield self._future_result(*in_flight.popleft())
+
+    def _generate(self, image):
+        """Returns histogram and features of image, features are None without verifier."""
+        if self.verifier is None:
+            return self._generate_hist(image), None
+        return self._generate_features(image)
+
+    def _future_result(self, image_id, key, future):
+        try:
+            result = future.result()
+        except VisualSearchEngineError as error:
+            return image_id, None, None, error
+        hist, features = result if self.verifier is not None else (result, None)
+        if key is not None:
+            self.hist_cache.put(key, hist)
+        return image_id, hist, features, None
 
     def remove_from_index(self, image_id):
         """Removes item with image_id."""
         del self.image_index[image_id]
+        if self.verifier is not None:
+            self.verifier.features.pop(image_id, None)
 
     def find_similar(self, image, n=1):
         """Returns at most n similar images."""
-        query_hist = self.bag_of_visual_words.generate_hist(image)
-        return self.image_index.find(query_hist, n)
+        with instrument.timed('find_similar'):
+            if self.verifier is None:
+                query_hist = self._generate_hist(image)
+                return self.image_index.find(query_hist, n)
+            query_hist, query_features = self._generate_features(image)
+            results = self.image_index.find(query_hist, max(n, self.verifier.top_k))
+            with instrument.timed('verify'):
+                return self.verifier.verify(query_features, results)[:n]
+
+    def find_similar_many(self, images, n=1, processes=None, max_in_flight=None):
+        """Returns list of at most n similar images for every image. Histograms are generated in a pool of processes
+        like in add_many and all of them are ranked by a single find_many call of the index.
+        Raises error of the first image whose histogram cannot be generated.
+        """
+        hists, features = [], []
+        for i, hist, query_features, error in self._generate_hists(enumerate(images), self._processes(processes),
+                                                                   max_in_flight):
+            if error is not None:
+                raise error
+            hists.append(hist)
+            features.append(query_features)
+        if self.verifier is None:
+            return self.image_index.find_many(hists, n)
+        results = self.image_index.find_many(hists, max(n, self.verifier.top_k))
+        with instrument.timed('verify'):
+            return [self.verifier.verify(query_features, query_results)[:n]
+                    for query_features, query_results in zip(features, results)]
 
 
 class BagOfVisualWords:
-    def __init__(self, extractor, matcher, vocabulary):
+    """Bag of visual words. Descriptors are assigned to visual words by quantizer if given,
+    otherwise by cv2.BOWImgDescriptorExtractor using matcher.
+    If keypoint_budget (KeypointBudget) is given, it limits detected key points and adjusts detector threshold.
+    """
+
+    def __init__(self, extractor, matcher, vocabulary, quantizer=None, keypoint_budget=None):
         self.extractor = extractor
-        self.extract_bow = cv2.BOWImgDescriptorExtractor(self.extractor, matcher)
-        self.extract_bow.setVocabulary(vocabulary)
+        self.quantizer = quantizer
+        self.keypoint_budget = keypoint_budget
+        if quantizer is None:
+            self.extract_bow = cv2.BOWImgDescriptorExtractor(self.extractor, matcher)
+            self.extract_bow.setVocabulary(vocabulary)
+            self.features_quantizer = MatcherQuantizer(vocabulary, matcher)
+        else:
+            self.features_quantizer = quantizer
+        self._fingerprint = None
+
+    @property
+    def fingerprint(self):
+        """Hash of vocabulary, extractor parameters, quantizer type and key point budget, which identifies
+        histograms generated by this bag of visual words in histogram caches.
+        """
+        if self._fingerprint is None:
+            budget = sorted((name, value) for name, value in vars(self.keypoint_budget).items()
+                            if not name.startswith('_')) if self.keypoint_budget is not None else None
+            self._fingerprint = configuration_fingerprint(self.features_quantizer.vocabulary, self.extractor,
+                                                          type(self.features_quantizer).__name__, budget)
+        return self._fingerprint
 
     def generate_hist(self, image):
         """Generates image visual words frequency histogram."""
-        key_points = self.extractor.detect(image)
-        hist = self.extract_bow.compute(image, key_points)[0]
-        return hist
+        key_points = self._detect(image)
+        if self.quantizer is None:
+            with instrument.timed('describe'):
+                hist = self.extract_bow.compute(image, key_points)[0]
+            return hist
+        with instrument.timed('describe'):
+            key_points, descriptors = self.extractor.compute(image, key_points)
+        if descriptors is None:
+            return words_hist(numpy.empty(0, dtype=numpy.int64), len(self.quantizer))
+        with instrument.timed('quantize'):
+            return words_hist(self.quantizer.quantize(descriptors), len(self.quantizer))
+
+    def _detect(self, image):
+        with instrument.timed('detect'):
+            if self.keypoint_budget is None:
+                key_points = self.extractor.detect(image)
+            else:
+                key_points = self.keypoint_budget.detect(self.extractor, image)
+        if instrument.enabled():
+            instrument.record('keypoints', len(key_points))
+        return key_points
+
+    def generate_features(self, image):
+        """Generates visual words frequency histogram and Features (key point positions and visual words)
+        used by geometric verification. Without quantizer, visual words are assigned with matcher.
+        """
+        key_points = self._detect(image)
+        with instrument.timed('describe'):
+            key_points, descriptors = self.extractor.compute(image, key_points)
+        if descriptors is None:
+            key_points, words = [], numpy.empty(0, dtype=numpy.int64)
+        else:
+            with instrument.timed('quantize'):
+                words = self.features_quantizer.quantize(descriptors)
+        return words_hist(words, len(self.features_quantizer)), image_features(key_points, words)
+
+
+def read_image(image):
+    """Returns loaded image. Argument image can be a file path, an encoded image buffer or already loaded image."""
+    if isinstance(image, str):
+        return load_image(image)
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return load_image_from_buf(image)
+    return image
+
+
+_worker_bag_of_visual_words = None
+
+
+def _init_worker(bag_of_visual_words_factory):
+    global _worker_bag_of_visual_words
+    _worker_bag_of_visual_words = bag_of_visual_words_factory()
+
+
+def _worker_generate_hist(image):
+    return _worker_bag_of_visual_words.generate_hist(read_image(image))
+
+
+def _worker_generate_features(image):
+    return _worker_bag_of_visual_words.generate_features(read_image(image))
+
+
+def _completed(result):
+    future = concurrent.futures.Future()
+    future.set_result(result)
+    return future
+
+
+def _failed(error):
+    future = concurrent.futures.Future()
+    future.set_exception(error)
+    return future
+
+
+def _rejected_positions(items, rejected):
+    """Returns dict of position in items and error of items rejected by Index.add_many. Only repeated image ids
+    are rejected, so rejections of an image id are its last occurrences in items.
+    """
+    rejections = collections.defaultdict(collections.deque)
+    for image_id, error in rejected:
+        rejections[image_id].append(error)
+    remaining = collections.Counter(image_id for image_id, hist in items)
+    positions = {}
+    for position, (image_id, hist) in enumerate(items):
+        remaining[image_id] -= 1
+        if remaining[image_id] < len(rejections[image_id]):
+            positions[position] = rejections[image_id].popleft()
+    return positions
 
 
 def cluster_vocabulary_from_img(images, extractor, recognized_visual_words=1000, filename=''):
-    """Generates visual words vocabulary from images. Saves to file if filename given."""
+    """Generates visual words vocabulary from images. Saves to file, tagged with extractor feature, if filename given."""
     descriptors = [extractor.detectAndCompute(image, None)[1] for image in images]
-    return cluster_vocabulary_from_descriptors(descriptors, recognized_visual_words, filename)
+    return cluster_vocabulary_from_descriptors(descriptors, recognized_visual_words, filename,
+                                               extractor_feature(extractor))
 
 
-def cluster_vocabulary_from_descriptors(descriptors, recognized_visual_words=1000, filename=''):
-    """Generates visual words vocabulary from images descriptors. Saves to file if filename given."""
-    bow_kmeans_trainer = cv2.BOWKMeansTrainer(recognized_visual_words)
-    for desc in descriptors:
-        bow_kmeans_trainer.add(desc)
-    vocabulary = bow_kmeans_trainer.cluster()
+def cluster_vocabulary_from_descriptors(descriptors, recognized_visual_words=1000, filename='', feature=None):
+    """Generates visual words vocabulary from images descriptors with k-means, or k-majority if they are binary
+    (feature is binary or, without feature, descriptors are uint8). Saves to file, tagged with feature if given,
+    if filename given. Raises ValueError if there are no descriptors.
+    """
+    descriptors = [desc for desc in descriptors if desc is not None and len(desc)]
+    if not descriptors:
+        raise ValueError('no descriptors')
+    binary = is_binary(feature) if feature is not None else all(desc.dtype == numpy.uint8 for desc in descriptors)
+    if binary:
+        vocabulary = kmajority(numpy.concatenate(descriptors), recognized_visual_words)
+    else:
+        bow_kmeans_trainer = cv2.BOWKMeansTrainer(recognized_visual_words)
+        for desc in descriptors:
+            bow_kmeans_trainer.add(numpy.asarray(desc, dtype=numpy.float32))
+        vocabulary = bow_kmeans_trainer.cluster()
     if filename:
-        save(filename, vocabulary)
+        save_vocabulary(filename, vocabulary, feature)
     return vocabulary
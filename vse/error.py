@@ -3,7 +3,16 @@ import vse
 
 class VisualSearchEngineError(Exception):
     """Base class for vse exceptions."""
-    pass
+
+    def __reduce__(self):
+        return _restore_error, (type(self), self.args)
+
+
+def _restore_error(error_class, args):
+    """Recreates exception without calling its constructor, so that pickled message stays intact."""
+    error = error_class.__new__(error_class)
+    Exception.__init__(error, *args)
+    return error
 
 
 class DuplicatedImageError(VisualSearchEngineError):
@@ -39,3 +48,19 @@ class ImageLoaderError(VisualSearchEngineError):
         else:
             message = 'Cannot read image from buffer'
         VisualSearchEngineError.__init__(self, message)
+
+
+class IndexFormatError(VisualSearchEngineError):
+    """Raised if index directory does not contain supported vse index."""
+
+    def __init__(self, path, reason):
+        message = 'Cannot open index {}: {}'.format(path, reason)
+        VisualSearchEngineError.__init__(self, message)
+
+
+class VocabularyFeatureError(VisualSearchEngineError):
+    """Raised if vocabulary was trained for other descriptors than the requested feature."""
+
+    def __init__(self, filename, trained, feature):
+        message = 'Vocabulary {} was trained for {} descriptors, not {}'.format(filename, trained, feature)
+        VisualSearchEngineError.__init__(self, message)
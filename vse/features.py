@@ -0,0 +1,96 @@
+"""Feature backends
+
+Feature names map to OpenCV extractors. SIFT and SURF descriptors are float vectors compared with L2 distance.
+ORB, BRISK and AKAZE descriptors are bit strings packed in uint8 bytes, compared with Hamming distance; they are
+several times cheaper to extract and quantize. Vocabulary files are tagged with the feature they were trained for,
+so that loading a vocabulary for another feature fails at once instead of producing meaningless histograms.
+Untagged vocabularies (pickled arrays) are only checked to hold binary (uint8) or float words as the feature needs.
+"""
+
+import collections
+
+import cv2
+import numpy
+from vse.error import VocabularyFeatureError
+from vse.utils import load, save
+
+__all__ = ['FEATURES',
+           'DEFAULT_FEATURE',
+           'Feature',
+           'create_extractor',
+           'extractor_feature',
+           'is_binary',
+           'check_vocabulary_feature',
+           'load_vocabulary',
+           'save_vocabulary',
+           ]
+
+Feature = collections.namedtuple('Feature', 'factory binary')
+
+FEATURES = {'sift': Feature(lambda: cv2.SIFT_create(), False),
+            'surf': Feature(lambda: cv2.xfeatures2d.SURF_create(), False),
+            'orb': Feature(lambda: cv2.ORB_create(), True),
+            'brisk': Feature(lambda: cv2.BRISK_create(), True),
+            'akaze': Feature(lambda: cv2.AKAZE_create(), True),
+            }
+
+DEFAULT_FEATURE = 'surf'
+
+
+def _feature(name):
+    if name not in FEATURES:
+        raise ValueError('Unknown feature {}, expected one of {}'.format(name, ', '.join(sorted(FEATURES))))
+    return FEATURES[name]
+
+
+def create_extractor(feature):
+    """Returns new OpenCV extractor of feature."""
+    return _feature(feature).factory()
+
+
+def is_binary(feature):
+    """Returns True if feature descriptors are binary and compared with Hamming distance."""
+    return _feature(feature).binary
+
+
+def extractor_feature(extractor):
+    """Returns feature name of OpenCV extractor, e.g. 'orb' for cv2.ORB_create(), None if not in FEATURES."""
+    name = extractor.getDefaultName().rsplit('.', 1)[-1].lower()
+    return name if name in FEATURES else None
+
+
+def check_vocabulary_feature(filename, trained, binary, feature):
+    """Raises VocabularyFeatureError if vocabulary trained for feature trained (None if untagged), binary if its
+    words are bit strings, cannot be used for feature. Returns feature the vocabulary is used for.
+    """
+    if feature is None:
+        return trained
+    if trained is None:
+        if binary != is_binary(feature):
+            raise VocabularyFeatureError(filename, 'binary' if binary else 'float', feature)
+    elif trained != feature:
+        raise VocabularyFeatureError(filename, trained, feature)
+    return feature
+
+
+def save_vocabulary(filename, vocabulary, feature):
+    """Saves vocabulary tagged with feature it was trained for, or pickled untagged if feature is None."""
+    if feature is None:
+        save(filename, vocabulary)
+        return
+    _feature(feature)
+    save(filename, {'feature': feature, 'vocabulary': vocabulary})
+
+
+def load_vocabulary(filename, feature=None):
+    """Loads vocabulary saved with save_vocabulary or pickled untagged array. Returns (vocabulary, feature), where
+    feature is the given one or the vocabulary tag (None for untagged vocabularies).
+    Raises VocabularyFeatureError if vocabulary does not match feature.
+    """
+    data = load(filename)
+    if isinstance(data, dict):
+        vocabulary, trained = data['vocabulary'], data['feature']
+    else:
+        vocabulary, trained = data, None
+    binary = numpy.asarray(vocabulary).dtype == numpy.uint8
+    return vocabulary, check_vocabulary_feature(filename, trained, binary, feature)
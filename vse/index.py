@@ -1,32 +1,116 @@
 import abc
+import collections
+import itertools
+import threading
+import cv2
+import numpy
+from vse import instrument
+from vse.comparator import Bhattacharyya, CosineAngle, Hellinger, Intersection
+from vse.encoding import create_hist_matrix
 from vse.error import NoImageError, DuplicatedImageError
+from vse.utils import batches
 
 
 class Index:
     def __init__(self, ranker):
         self.ranker = ranker
-        self.vw_freq = []
+        self.stats = VisualWordStats()
+
+    @property
+    def vw_freq(self):
+        """Mean visual words frequency histogram of indexed images."""
+        return self.stats.vw_freq()
+
+    @property
+    def idf(self):
+        """Inverse document frequency of visual words."""
+        return self.stats.idf()
 
     @abc.abstractmethod
-    def find(self, query_hist, n):
+    def find(self, query_hist, n, freq_vector=None):
+        """Returns n best (image_id, diff_ratio) results. freq_vector overrides frequency statistics of the index,
+        which is used when the index is a part of a larger one.
+        """
         pass
 
+    def find_many(self, query_hists, n, freq_vector=None):
+        """Returns list of find results for every query histogram."""
+        return [self.find(query_hist, n, freq_vector) for query_hist in query_hists]
+
+    def items(self):
+        """Returns list of (image_id, hist) pairs of indexed images."""
+        return list(self.iter_items())
+
+    def iter_items(self):
+        """Yields (image_id, hist) pairs of indexed images one by one, in the order of items."""
+        for row, image_id in enumerate(self.ids.image_ids):
+            if image_id is not None:
+                yield image_id, self.hists[row]
+
+    def _rank_rows(self, query_hist, image_ids, n, rows=None, freq_vector=None):
+        """Ranks histograms stored in self.hists, all of them or only given rows."""
+        return self._rank_rows_many([query_hist], image_ids, n, rows, freq_vector)[0]
+
+    def _rank_rows_many(self, query_hists, image_ids, n, rows=None, freq_vector=None):
+        """Ranks histograms stored in self.hists against every query, rows are weighted once for all queries."""
+        instrument.record('candidate_count', len(image_ids))
+        if len(image_ids) == 0:
+            return [[] for query_hist in query_hists]
+        with instrument.timed('rank'):
+            weighted_matrix, freq_vector = self._weighted_rows(rows, freq_vector)
+            weighted_query_hists = [self.ranker.weigh_query(query_hist, freq_vector) for query_hist in query_hists]
+            return self.ranker.rank_weighted_many(weighted_query_hists, image_ids, weighted_matrix, n)
+
+    def _weighted_rows(self, rows=None, freq_vector=None):
+        """Returns rows of self.hists weighted by ranker and frequency vector used to weigh them."""
+        if freq_vector is None:
+            freq_vector = self.vw_freq
+        tolerance = self.ranker.cache_tolerance
+        if tolerance is None:
+            matrix = self.hists.view() if rows is None else self.hists.view()[rows]
+            return self.ranker.weigh_items(matrix, freq_vector), freq_vector
+        weighted_rows = self.hists.weighted_rows(self.ranker.weigh_items, freq_vector, tolerance)
+        weighted_matrix = weighted_rows.matrix[:len(self.hists)]
+        if rows is not None:
+            weighted_matrix = weighted_matrix[rows]
+        return weighted_matrix, weighted_rows.freq_vector
+
     def __setitem__(self, image_id, hist):
         self._add(image_id, hist)
-        self._update_freq_after_addition(hist)
+        self._update_freq_after_addition(self[image_id])
+
+    def add_many(self, items):
+        """Adds (image_id, hist) pairs updating frequency statistics once.
+        Returns list of (image_id, DuplicatedImageError) for images which were not added.
+        Statistics are updated with histograms as stored, so that deletions withdraw exactly what was added.
+        Other errors stop adding, statistics are still updated with images added before.
+        """
+        added, errors = [], []
+        try:
+            for image_id, hist in items:
+                try:
+                    self._add(image_id, hist)
+                except DuplicatedImageError as error:
+                    errors.append((image_id, error))
+                else:
+                    added.append(numpy.ravel(self[image_id]))
+        finally:
+            if added:
+                self._update_freq_after_addition(numpy.array(added))
+        return errors
 
     @abc.abstractmethod
     def _add(self, image_id, hist):
         pass
 
     def _update_freq_after_addition(self, hist):
-        if not self.vw_freq:
-            self.vw_freq = hist.copy()
-        index_size = len(self)
-        self.vw_freq = [(n_freq * (index_size - 1) + n) / index_size for n, n_freq in zip(hist, self.vw_freq)]
+        self.stats.add(hist)
 
     def __delitem__(self, image_id):
-        hist = self[image_id]
+        try:
+            hist = self[image_id]
+        except KeyError:
+            raise NoImageError(image_id)
         self._remove(image_id)
         self._update_freq_after_deletion(hist)
 
@@ -35,10 +119,7 @@ class Index:
         pass
 
     def _update_freq_after_deletion(self, hist):
-        index_size = len(self)
-        if index_size == 0:
-            self.vw_freq = []
-        self.vw_freq = [(n_freq * (index_size + 1) - n) / index_size for n, n_freq in zip(hist, self.vw_freq)]
+        self.stats.remove(hist)
 
     @abc.abstractmethod
     def __getitem__(self, image_id):
@@ -48,69 +129,929 @@ class Index:
     def __len__(self):
         pass
 
+    def __setstate__(self, state):
+        if 'stats' not in state:
+            self._restore_legacy(state)
+        else:
+            self.__dict__.update(state)
+
+    def _restore_legacy(self, state):
+        """Restores index pickled by vse 0.1.5 or older, which kept histograms in dicts."""
+        raise TypeError('Cannot restore {} from legacy state'.format(type(self).__name__))
+
+
+class VisualWordStats:
+    """Running visual words statistics: document frequency, total term mass and image count.
+    Derived frequency vectors are computed lazily and cached until the next update.
+    """
+
+    def __init__(self):
+        self.doc_freq = None
+        self.term_mass = None
+        self.image_count = 0
+        self._vw_freq = None
+        self._idf = None
+
+    def add(self, hists):
+        """Updates statistics with a histogram or a matrix of histograms."""
+        hists = numpy.atleast_2d(hists)
+        if len(hists) == 0:
+            return
+        if self.doc_freq is None:
+            self.doc_freq = numpy.zeros(hists.shape[1], dtype=numpy.int64)
+            self.term_mass = numpy.zeros(hists.shape[1], dtype=numpy.float64)
+        self.doc_freq += numpy.count_nonzero(hists, axis=0)
+        self.term_mass += hists.sum(axis=0, dtype=numpy.float64)
+        self.image_count += len(hists)
+        self._invalidate()
+
+    def remove(self, hists):
+        """Withdraws a histogram or a matrix of histograms from statistics."""
+        hists = numpy.atleast_2d(hists)
+        if len(hists) == 0:
+            return
+        self.image_count -= len(hists)
+        if self.image_count == 0:
+            self.doc_freq[:] = 0
+            self.term_mass[:] = 0
+        else:
+            self.doc_freq -= numpy.count_nonzero(hists, axis=0)
+            self.term_mass -= hists.sum(axis=0, dtype=numpy.float64)
+        self._invalidate()
+
+    def vw_freq(self):
+        if self._vw_freq is None:
+            if self.term_mass is None:
+                self._vw_freq = numpy.empty(0, dtype=numpy.float32)
+            elif self.image_count == 0:
+                self._vw_freq = numpy.zeros(len(self.term_mass), dtype=numpy.float32)
+            else:
+                self._vw_freq = numpy.maximum(self.term_mass / self.image_count, 0).astype(numpy.float32)
+        return self._vw_freq
+
+    def idf(self):
+        if self._idf is None:
+            if self.doc_freq is None:
+                self._idf = numpy.empty(0, dtype=numpy.float32)
+            else:
+                present = self.doc_freq > 0
+                ratio = numpy.divide(self.image_count, self.doc_freq, out=numpy.ones(len(self.doc_freq)), where=present)
+                self._idf = numpy.log(ratio).astype(numpy.float32)
+        return self._idf
+
+    def _invalidate(self):
+        self._vw_freq = None
+        self._idf = None
+
 
 class ForwardIndex(Index):
-    def __init__(self, ranker):
+    """Index ranking all images. encoding of stored histograms is one of vse.encoding.ENCODINGS."""
+
+    def __init__(self, ranker, encoding='float32'):
         Index.__init__(self, ranker)
-        self.index = {}
+        self.hists = create_hist_matrix(encoding)
+        self.ids = IdTable()
 
-    def find(self, query_hist, n):
-        return self.ranker.rank(query_hist, self.index.items(), n, self.vw_freq)
+    def find(self, query_hist, n, freq_vector=None):
+        return self._rank_rows(query_hist, self.ids.image_ids, n, freq_vector=freq_vector)
+
+    def find_many(self, query_hists, n, freq_vector=None):
+        return self._rank_rows_many(query_hists, self.ids.image_ids, n, freq_vector=freq_vector)
 
     def _add(self, image_id, hist):
-        if image_id in self.index:
+        if image_id in self.ids:
             raise DuplicatedImageError(image_id)
-        self.index[image_id] = hist
+        self.ids.assign(image_id, self.hists.append(hist))
 
     def _remove(self, image_id):
-        if image_id not in self.index:
+        if image_id not in self.ids:
             raise NoImageError(image_id)
-        del self.index[image_id]
+        row = self.ids.release(image_id)
+        last = len(self.hists) - 1
+        if row != last:
+            self.hists.move(last, row)
+            self.ids.move(last, row)
+        self.hists.truncate(last)
+        self.ids.truncate(last)
 
     def __getitem__(self, image_id):
-        return self.index[image_id]
+        return self.hists[self.ids[image_id]]
 
     def __len__(self):
-        return len(self.index)
+        return len(self.ids)
+
+    def _restore_legacy(self, state):
+        ForwardIndex.__init__(self, state['ranker'])
+        self.add_many(state['index'].items())
 
 
 class InvertedIndex(Index):
-    def __init__(self, ranker, recognized_visual_words, cutoff=2.0):
+    """Index ranking images sharing visual words with the query. encoding of stored histograms is one of
+    vse.encoding.ENCODINGS.
+    Query words whose posting lists are longer than max_posting_length are skipped as stop words, unless all of
+    them are. If prune_depth is given, only max(n, prune_depth) candidates with the best sum of posting impacts
+    over query words are ranked. Impact of a word is the minimum of query and image word frequency for
+    Intersection, square root of their product for Hellinger and Bhattacharyya (Bhattacharyya coefficient) and
+    their product divided by the image histogram norm otherwise (cosine). Posting lists are processed by descending
+    upper bound of impact; MaxScore-style, once the remaining lists cannot lift an image not seen yet into the
+    candidates, they are not read, impacts of their words are looked up in stored histograms of the images which
+    can still be candidates. Pruning is approximate, candidates are exact best images by impact, not by ranker
+    score: impacts ignore words below cutoff and ranker weighing. They follow the comparator closely for
+    Intersection, Hellinger, Bhattacharyya, CosineAngle and Correlation with SimpleRanker; with WeighingRanker
+    or distances like Euclidean results may differ from unpruned ones unless prune_depth is larger.
+    """
+    prune_depth = None
+    max_posting_length = None
+    _norms = None
+    _word_bounds = None
+
+    def __init__(self, ranker, recognized_visual_words, cutoff=2.0, encoding='float32', prune_depth=None,
+                 max_posting_length=None):
         Index.__init__(self, ranker)
-        self.index = [{} for i in range(recognized_visual_words)]
+        self.postings = [PostingList() for i in range(recognized_visual_words)]
         self.cutoff = cutoff / recognized_visual_words
+        self.hists = create_hist_matrix(encoding)
+        self.ids = IdTable()
+        self.free_docs = []
+        self.prune_depth = prune_depth
+        self.max_posting_length = max_posting_length
+
+    def find(self, query_hist, n, freq_vector=None):
+        with instrument.timed('candidates'):
+            docs = self._query_candidates(query_hist, n)
+        return self._rank_rows(query_hist, RowSelection(self.ids.image_ids, docs), n, docs, freq_vector)
+
+    def find_many(self, query_hists, n, freq_vector=None):
+        """Ranks union of candidates of all queries at once, every query only against its own candidates."""
+        with instrument.timed('candidates'):
+            candidates = [self._query_candidates(query_hist, n) for query_hist in query_hists]
+            docs = numpy.unique(numpy.concatenate(candidates)) if candidates else numpy.empty(0, dtype=numpy.int64)
+        instrument.record('candidate_count', len(docs))
+        if len(docs) == 0:
+            return [[] for query_hist in query_hists]
+        with instrument.timed('rank'):
+            weighted_matrix, freq_vector = self._weighted_rows(docs, freq_vector)
+            weighted_query_hists = [self.ranker.weigh_query(query_hist, freq_vector) for query_hist in query_hists]
+            columns = [numpy.searchsorted(docs, query_docs) for query_docs in candidates]
+            return self.ranker.rank_weighted_many(weighted_query_hists, RowSelection(self.ids.image_ids, docs),
+                                                  weighted_matrix, n, columns)
+
+    def _query_candidates(self, query_hist, n):
+        if self.prune_depth is None:
+            return self._candidates(query_hist)
+        return self._pruned_candidates(query_hist, max(n, self.prune_depth))
+
+    def _candidates(self, query_hist):
+        """Returns sorted doc ids found in posting lists of query visual words."""
+        words = self._query_words(query_hist)
+        if len(words) == 0:
+            return numpy.empty(0, dtype=numpy.int64)
+        return numpy.unique(numpy.concatenate([self.postings[word].docs() for word in words]))
+
+    def _pruned_candidates(self, query_hist, depth):
+        """Returns sorted doc ids of at most depth images with the best sum of impacts of query words."""
+        query_hist = numpy.ravel(query_hist)
+        words = self._query_words(query_hist)
+        if len(words) == 0:
+            return numpy.empty(0, dtype=numpy.int64)
+        kind = _impact_kind(self.ranker.hist_comparator)
+        impact, normalized = _IMPACTS[kind], kind == 'cosine'
+        bounds = impact(query_hist[words], self._bounds(words, normalized))
+        order = numpy.argsort(-bounds, kind='stable')
+        remaining = float(bounds.sum())
+        scores, seen = _scratch_buffers(len(self.hists))
+        touched, seen_count, threshold = [], 0, 0.
+        try:
+            for processed, position in enumerate(order):
+                if seen_count >= depth and threshold > remaining:
+                    break
+                word = words[position]
+                docs, weights = self.postings[word].docs(), self.postings[word].weights()
+                if normalized:
+                    weights = weights / self._norms[docs]
+                scores[docs] += impact(query_hist[word], weights)
+                new_docs = docs[~seen[docs]]
+                seen[new_docs] = True
+                touched.append(new_docs)
+                seen_count += len(new_docs)
+                remaining -= bounds[position]
+                if seen_count >= depth:
+                    touched = [numpy.concatenate(touched)]
+                    seen_scores = scores[touched[0]]
+                    threshold = numpy.partition(seen_scores, seen_count - depth)[seen_count - depth]
+            else:
+                processed = len(order)
+            docs = numpy.concatenate(touched)
+            doc_scores = scores[docs]
+        finally:
+            for docs_set in touched:
+                scores[docs_set] = 0
+                seen[docs_set] = False
+        if processed < len(order):
+            docs, doc_scores = self._complete_scores(query_hist, words[order[processed:]], docs, doc_scores,
+                                                     threshold - remaining, impact, normalized)
+        if len(docs) > depth:
+            docs = docs[numpy.argpartition(-doc_scores, depth - 1)[:depth]]
+        return numpy.sort(docs)
+
+    def _complete_scores(self, query_hist, words, docs, doc_scores, minimum, impact, normalized):
+        """Adds impacts of words, whose posting lists were not read, to scores of docs, which can still reach
+        the candidates (their partial score is at least minimum). Returns these docs and their scores.
+        """
+        keep = doc_scores >= minimum
+        docs, doc_scores = docs[keep], doc_scores[keep]
+        weights = numpy.asarray(self.hists.view()[docs], dtype=numpy.float32)[:, words]
+        weights = numpy.where(weights > self.cutoff, weights, 0)
+        if normalized:
+            weights = weights / self._norms[docs, numpy.newaxis]
+        return docs, doc_scores + impact(query_hist[words], weights).sum(axis=1)
+
+    def _bounds(self, words, normalized):
+        """Returns the largest posting weight, divided by histogram norm if normalized, of every word.
+        Bounds are cached until posting lists of words change.
+        """
+        if normalized and self._norms is None:
+            self._norms = _nonzero(numpy.linalg.norm(numpy.asarray(self.hists.view(), dtype=numpy.float32), axis=1))
+        if self._word_bounds is None:
+            self._word_bounds = {}
+        cached = self._word_bounds.get(normalized)
+        if cached is None:
+            cached = self._word_bounds[normalized] = numpy.full(len(self.postings), numpy.nan)
+        for word in words[numpy.isnan(cached[words])]:
+            weights = self.postings[word].weights()
+            if normalized:
+                weights = weights / self._norms[self.postings[word].docs()]
+            cached[word] = weights.max() if len(weights) else 0.
+        return cached[words]
+
+    def _invalidate_bounds(self, words):
+        if self._word_bounds is not None:
+            for cached in self._word_bounds.values():
+                cached[words] = numpy.nan
+
+    def _query_words(self, query_hist):
+        """Returns query visual words, without stop words whose posting lists exceed max_posting_length."""
+        words = self._words(query_hist)
+        if self.max_posting_length is None or len(words) == 0:
+            return words
+        lengths = numpy.array([len(self.postings[word]) for word in words])
+        if numpy.all(lengths > self.max_posting_length):
+            return words[lengths == lengths.min()]
+        return words[lengths <= self.max_posting_length]
+
+    def _words(self, hist):
+        return numpy.flatnonzero(numpy.ravel(hist) > self.cutoff)
+
+    def _add(self, image_id, hist):
+        if image_id in self.ids:
+            raise DuplicatedImageError(image_id)
+        if self.free_docs:
+            doc = self.free_docs.pop()
+            self.hists[doc] = hist
+        else:
+            doc = self.hists.append(hist)
+        self.ids.assign(image_id, doc)
+        hist = self.hists[doc]
+        words = self._words(hist)
+        for word in words:
+            self.postings[word].append(doc, hist[word])
+        if self._norms is not None:
+            if doc >= len(self._norms):
+                self._norms = numpy.resize(self._norms, max(doc + 1, 2 * len(self._norms)))
+            self._norms[doc] = _nonzero(numpy.linalg.norm(hist))
+        self._invalidate_bounds(words)
+
+    def _remove(self, image_id):
+        if image_id not in self.ids:
+            raise NoImageError(image_id)
+        doc = self.ids.release(image_id)
+        words = self._words(self.hists[doc])
+        for word in words:
+            self.postings[word].remove(doc)
+        self._invalidate_bounds(words)
+        self.free_docs.append(doc)
+
+    def __getitem__(self, image_id):
+        return self.hists[self.ids[image_id]]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _restore_legacy(self, state):
+        recognized_visual_words = len(state['index'])
+        InvertedIndex.__init__(self, state['ranker'], recognized_visual_words, state['cutoff'] * recognized_visual_words)
+        items = {}
+        for subindex in state['index']:
+            items.update(subindex)
+        self.add_many(items.items())
+
+
+class IVFIndex(Index):
+    """Approximate index ranking only images of the nprobe inverted lists whose coarse k-means centers are nearest
+    to the query. Lists and shortlists use L2 distance of transformed histograms: 'sqrt' maps Hellinger and
+    Bhattacharyya to L2, 'normalize' (unit length) maps CosineAngle and None suits Euclidean, 'auto' picks one
+    from the comparator of ranker. Centers are trained once train_size images are indexed, until then search
+    is exhaustive. With pq_subspaces, residuals to centers are product quantized to one byte per subspace and
+    candidates are shortlisted by distance to their codes, otherwise by exact distance. The rerank best
+    candidates are ranked exactly by ranker.
+    """
+    TRANSFORMS = ('auto', 'sqrt', 'normalize', None)
+
+    def __init__(self, ranker, lists=64, nprobe=8, rerank=100, transform='auto', pq_subspaces=None,
+                 train_size=None, encoding='float32', seed=None):
+        if transform not in self.TRANSFORMS:
+            raise ValueError('Unknown transform {}'.format(transform))
+        Index.__init__(self, ranker)
+        self.lists = lists
+        self.nprobe = nprobe
+        self.rerank = rerank
+        self.transform = _comparator_transform(ranker.hist_comparator) if transform == 'auto' else transform
+        self.pq_subspaces = pq_subspaces
+        self.train_size = train_size or 39 * lists
+        self.seed = seed
+        self.hists = create_hist_matrix(encoding)
+        self.ids = IdTable()
+        self.free_docs = []
+        self.centers = None
+        self.codebooks = None
+        self.code_terms = None
+        self.postings = [PostingList()]
+        self.doc_lists = numpy.zeros(0, dtype=numpy.int32)
+        self.codes = None
+
+    def find(self, query_hist, n, freq_vector=None):
+        with instrument.timed('candidates'):
+            docs = self._candidates(query_hist, max(n, self.rerank))
+        return self._rank_rows(query_hist, RowSelection(self.ids.image_ids, docs), n, docs, freq_vector)
+
+    def _candidates(self, query_hist, size):
+        """Returns sorted doc ids of at most size images nearest to the query in the probed lists,
+        all doc ids if the index is not trained.
+        """
+        if self.centers is None:
+            return numpy.sort(self.postings[0].docs())
+        query = self._transform(query_hist).ravel()
+        center_distances = self._center_distances(query[numpy.newaxis])[0]
+        probed = numpy.argsort(center_distances, kind='stable')[:self.nprobe]
+        docs = numpy.concatenate([self.postings[position].docs() for position in probed])
+        if len(docs) > size:
+            if self.codebooks is None:
+                norms = numpy.concatenate([self.postings[position].weights() for position in probed])
+                distances = norms - 2 * self._vectors(docs).dot(query)
+            else:
+                distances = self._code_distances(query, center_distances, probed, docs)
+            docs = docs[numpy.argpartition(distances, size - 1)[:size]]
+        return numpy.sort(docs)
+
+    def _code_distances(self, query, center_distances, probed, docs):
+        """Returns squared distances of query to product quantized docs of probed lists. Distance to a doc is
+        distance to its center plus, in every subspace, |code|^2 + 2 center.code (kept in code_terms)
+        minus 2 query.code.
+        """
+        positions = numpy.repeat(probed, [len(self.postings[position]) for position in probed])
+        query_terms = numpy.einsum('sw,skw->sk', self._split(query[numpy.newaxis])[:, 0], self.codebooks)
+        subspaces = numpy.arange(self.pq_subspaces)
+        codes = self.codes[docs]
+        return center_distances[positions] + (self.code_terms[positions[:, numpy.newaxis], subspaces, codes]
+                                              - 2 * query_terms[subspaces, codes]).sum(axis=1)
+
+    def train(self):
+        """Clusters indexed images into lists, trains product quantizer codebooks and reassigns images.
+        Called once train_size images are indexed, call it again after the collection has changed.
+        """
+        docs = numpy.array(sorted(self.ids.rows.values()), dtype=numpy.int64)
+        if len(docs) < self.lists:
+            raise ValueError('At least {} images are needed to train {} lists'.format(self.lists, self.lists))
+        vectors = self._vectors(docs)
+        if self.seed is not None:
+            cv2.setRNGSeed(self.seed)
+        criteria = (cv2.TERM_CRITERIA_MAX_ITER + cv2.TERM_CRITERIA_EPS, 20, 1e-4)
+        compactness, labels, self.centers = cv2.kmeans(vectors, self.lists, None, criteria, 1,
+                                                       cv2.KMEANS_PP_CENTERS)
+        if self.pq_subspaces:
+            residuals = self._split(vectors - self.centers[labels.ravel()])
+            clusters = min(256, len(docs))
+            self.codebooks = numpy.array([cv2.kmeans(subspace, clusters, None, criteria, 1,
+                                                     cv2.KMEANS_PP_CENTERS)[2] for subspace in residuals])
+            self.code_terms = (self.codebooks ** 2).sum(axis=2) + \
+                2 * numpy.einsum('slw,skw->lsk', self._split(self.centers), self.codebooks)
+            self.codes = numpy.zeros((len(self.doc_lists), self.pq_subspaces), dtype=numpy.uint8)
+        self.postings = [PostingList() for i in range(self.lists)]
+        self._assign(docs, vectors)
+
+    def _add(self, image_id, hist):
+        if image_id in self.ids:
+            raise DuplicatedImageError(image_id)
+        if self.free_docs:
+            doc = self.free_docs.pop()
+            self.hists[doc] = hist
+        else:
+            doc = self.hists.append(hist)
+        self.ids.assign(image_id, doc)
+        if self.centers is None and len(self.ids) >= self.train_size:
+            self.train()
+        else:
+            self._assign(numpy.array([doc]))
+
+    def _assign(self, docs, vectors=None):
+        """Appends docs to posting lists of their nearest centers with squared norms as weights."""
+        if vectors is None:
+            vectors = self._vectors(docs)
+        if self.centers is None:
+            positions = numpy.zeros(len(docs), dtype=numpy.int32)
+        else:
+            positions = numpy.argmin(self._center_distances(vectors), axis=1)
+        size = int(docs.max()) + 1
+        if size > len(self.doc_lists):
+            capacity = max(size, 2 * len(self.doc_lists), 8)
+            self.doc_lists = numpy.resize(self.doc_lists, capacity)
+            if self.codes is not None:
+                self.codes = numpy.resize(self.codes, (capacity, self.pq_subspaces))
+        self.doc_lists[docs] = positions
+        if self.codebooks is not None:
+            self.codes[docs] = self._encode(vectors - self.centers[positions])
+        for doc, position, norm in zip(docs, positions, numpy.einsum('ij,ij->i', vectors, vectors)):
+            self.postings[position].append(doc, norm)
+
+    def _remove(self, image_id):
+        if image_id not in self.ids:
+            raise NoImageError(image_id)
+        doc = self.ids.release(image_id)
+        self.postings[self.doc_lists[doc]].remove(doc)
+        self.free_docs.append(doc)
+
+    def _vectors(self, docs):
+        """Returns transformed histograms of docs."""
+        if len(docs) == 1:
+            return self._transform(self.hists[docs[0]])[numpy.newaxis]
+        return self._transform(self.hists.view()[docs])
+
+    def _transform(self, matrix):
+        matrix = numpy.asarray(matrix, dtype=numpy.float32)
+        if self.transform == 'sqrt':
+            return numpy.sqrt(numpy.maximum(matrix, 0))
+        if self.transform == 'normalize':
+            norms = numpy.linalg.norm(matrix, axis=-1, keepdims=True)
+            return numpy.divide(matrix, norms, out=numpy.zeros_like(matrix), where=norms != 0)
+        return matrix
+
+    def _center_distances(self, vectors):
+        """Returns (len(vectors), lists) squared distances of vectors to centers."""
+        return ((vectors ** 2).sum(axis=1)[:, numpy.newaxis] + (self.centers ** 2).sum(axis=1)
+                - 2 * vectors.dot(self.centers.T))
+
+    def _split(self, vectors):
+        """Returns (pq_subspaces, len(vectors), width) array of vectors padded with zeros and split into subspaces."""
+        width = -(-vectors.shape[1] // self.pq_subspaces)
+        padded = numpy.zeros((len(vectors), width * self.pq_subspaces), dtype=numpy.float32)
+        padded[:, :vectors.shape[1]] = vectors
+        return numpy.ascontiguousarray(padded.reshape(len(vectors), self.pq_subspaces, width).transpose(1, 0, 2))
+
+    def _encode(self, residuals):
+        """Returns (len(residuals), pq_subspaces) codes of nearest codebook centers."""
+        codes = [numpy.argmin((codebook ** 2).sum(axis=1) - 2 * subspace.dot(codebook.T), axis=1)
+                 for subspace, codebook in zip(self._split(residuals), self.codebooks)]
+        return numpy.array(codes, dtype=numpy.uint8).T.reshape(len(residuals), self.pq_subspaces)
+
+    def __getitem__(self, image_id):
+        return self.hists[self.ids[image_id]]
+
+    def __len__(self):
+        return len(self.ids)
+
+
+_IMPACTS = {'minimum': numpy.minimum,
+            'sqrt': lambda query, weights: numpy.sqrt(query * weights),
+            'cosine': numpy.multiply,
+            }
+
+
+def _impact_kind(comparator):
+    """Returns kind of posting impacts approximating comparator."""
+    if isinstance(comparator, Intersection):
+        return 'minimum'
+    if isinstance(comparator, (Hellinger, Bhattacharyya)):
+        return 'sqrt'
+    return 'cosine'
+
 
-    def find(self, query_hist, n):
-        return self.ranker.rank(query_hist, self._items(query_hist), n, self.vw_freq)
+_scratch = threading.local()
 
-    def _items(self, query_hist):
-        results = {}
-        for visual_word_freq, subindex in zip(query_hist, self.index):
-            if visual_word_freq > self.cutoff:
-                results.update(subindex)
-        return results.items()
+
+def _scratch_buffers(size):
+    """Returns thread-local zeroed score and seen flag arrays of at least size elements.
+    Callers reset elements they set, so that arrays are not allocated for every query.
+    """
+    scores = getattr(_scratch, 'scores', None)
+    if scores is None or len(scores) < size:
+        capacity = max(size, 2 * len(scores) if scores is not None else 1024)
+        _scratch.scores = numpy.zeros(capacity, dtype=numpy.float64)
+        _scratch.seen = numpy.zeros(capacity, dtype=bool)
+    return _scratch.scores, _scratch.seen
+
+
+def _nonzero(norms):
+    """Returns norms with zeros replaced by ones, so that they can divide."""
+    return numpy.where(norms > 0, norms, 1)
+
+
+def _comparator_transform(comparator):
+    """Returns IVFIndex transform mapping comparator to L2 distance."""
+    if isinstance(comparator, (Hellinger, Bhattacharyya)):
+        return 'sqrt'
+    if isinstance(comparator, CosineAngle):
+        return 'normalize'
+    return None
+
+
+Segment = collections.namedtuple('Segment', 'index tombstones')
+Snapshot = collections.namedtuple('Snapshot', 'segments delta freq_vector')
+
+
+class ConcurrentIndex(Index):
+    """Index safe for concurrent queries and writes. Queries read immutable segment indexes and a small delta index,
+    writes go to the delta. Deletions of segment images are recorded as tombstones. Once the delta and tombstones
+    reach merge_threshold, everything is merged into a single new segment built by index_factory.
+    Segments, delta and frequency vector are kept in one Snapshot tuple replaced at once, so queries hold a lock
+    only while reading the delta and are not blocked by a merge. Writes are serialized.
+    """
+    _transient = ('write_lock', 'delta_lock')
+
+    def __init__(self, ranker, index_factory=ForwardIndex, merge_threshold=1024):
+        Index.__init__(self, ranker)
+        self.index_factory = index_factory
+        self.merge_threshold = merge_threshold
+        self.snapshot = Snapshot((), ForwardIndex(ranker), self.stats.vw_freq())
+        self._create_locks()
+
+    def _create_locks(self):
+        self.write_lock = threading.RLock()
+        self.delta_lock = threading.Lock()
+
+    @property
+    def vw_freq(self):
+        return self.snapshot.freq_vector
+
+    def find(self, query_hist, n, freq_vector=None):
+        return self.find_many([query_hist], n, freq_vector)[0]
+
+    def find_many(self, query_hists, n, freq_vector=None):
+        with self.delta_lock:
+            snapshot = self.snapshot
+            if freq_vector is None:
+                freq_vector = snapshot.freq_vector
+            delta_results = snapshot.delta.find_many(query_hists, n, freq_vector)
+        results = []
+        for index, tombstones in snapshot.segments:
+            results.append([[result for result in partial_results if result[0] not in tombstones]
+                            for partial_results in index.find_many(query_hists, n + len(tombstones), freq_vector)])
+        results.append(delta_results)
+        return [self.ranker.merge(query_results, n) for query_results in zip(*results)]
+
+    def __setitem__(self, image_id, hist):
+        with self.write_lock:
+            Index.__setitem__(self, image_id, hist)
+            self._publish()
+
+    def add_many(self, items):
+        with self.write_lock:
+            try:
+                errors = Index.add_many(self, items)
+            finally:
+                self._publish()
+        return errors
+
+    def __delitem__(self, image_id):
+        with self.write_lock:
+            Index.__delitem__(self, image_id)
+            self._publish()
 
     def _add(self, image_id, hist):
-        for visual_word_freq, subindex in zip(hist, self.index):
-            if visual_word_freq > self.cutoff:
-                if image_id in subindex:
-                    raise DuplicatedImageError(image_id)
-                subindex[image_id] = hist
+        if self._contains(image_id):
+            raise DuplicatedImageError(image_id)
+        with self.delta_lock:
+            self.snapshot.delta[image_id] = hist
 
     def _remove(self, image_id):
-        found = False
-        for subindex in self.index:
-            if image_id in subindex:
-                found = True
-                del subindex[image_id]
-        if not found:
+        with self.delta_lock:
+            try:
+                del self.snapshot.delta[image_id]
+                return
+            except NoImageError:
+                pass
+        position = _segment_position(self.snapshot.segments, image_id)
+        if position is None:
             raise NoImageError(image_id)
+        with self.delta_lock:
+            segments = list(self.snapshot.segments)
+            index, tombstones = segments[position]
+            segments[position] = Segment(index, tombstones | {image_id})
+            self.snapshot = self.snapshot._replace(segments=tuple(segments))
+
+    def _publish(self):
+        """Publishes frequency statistics of the last write, merges the delta if it is large enough."""
+        with self.delta_lock:
+            self.snapshot = self.snapshot._replace(freq_vector=self.stats.vw_freq())
+        snapshot = self.snapshot
+        if len(snapshot.delta) + sum(len(tombstones) for index, tombstones in snapshot.segments) \
+                >= self.merge_threshold:
+            self._merge()
+
+    def merge(self):
+        """Merges segments, tombstones and the delta into a single segment."""
+        with self.write_lock:
+            self._merge()
+
+    def _merge(self):
+        snapshot = self.snapshot
+        index = self._merge_indexes(snapshot.segments, snapshot.delta)
+        self._restore_stats(itertools.chain(_live_items(snapshot.segments), snapshot.delta.iter_items()),
+                            index.iter_items())
+        with self.delta_lock:
+            self.snapshot = Snapshot((Segment(index, frozenset()),), ForwardIndex(self.ranker),
+                                     self.stats.vw_freq())
+
+    def _restore_stats(self, moved, stored):
+        """Withdraws (image_id, hist) pairs moved to another index from statistics and adds stored pairs,
+        the same images as stored by that index, which may encode them with loss.
+        """
+        for batch in batches(moved, 1024):
+            self.stats.remove(numpy.array([numpy.ravel(hist) for image_id, hist in batch]))
+        for batch in batches(stored, 1024):
+            self.stats.add(numpy.array([numpy.ravel(hist) for image_id, hist in batch]))
+
+    def _merge_indexes(self, segments, delta=None):
+        """Returns new index built by index_factory of images alive in segments and delta."""
+        index = self.index_factory(self.ranker)
+        index.add_many(_live_items(segments))
+        if delta is not None:
+            index.add_many(delta.items())
+        return index
+
+    def iter_items(self):
+        """Yields (image_id, hist) pairs of images alive in segments and the delta of the snapshot current
+        when iteration starts.
+        """
+        with self.delta_lock:
+            snapshot = self.snapshot
+            delta_items = [(image_id, numpy.array(hist)) for image_id, hist in snapshot.delta.items()]
+        yield from _live_items(snapshot.segments)
+        yield from delta_items
+
+    def _contains(self, image_id):
+        try:
+            self[image_id]
+        except KeyError:
+            return False
+        return True
 
     def __getitem__(self, image_id):
-        for subindex in self.index:
-            if image_id in subindex:
-                return subindex[image_id]
-        raise KeyError(image_id)
+        with self.delta_lock:
+            snapshot = self.snapshot
+            if image_id in snapshot.delta.ids:
+                return snapshot.delta[image_id]
+        position = _segment_position(snapshot.segments, image_id)
+        if position is None:
+            raise KeyError(image_id)
+        return snapshot.segments[position].index[image_id]
+
+    def __len__(self):
+        snapshot = self.snapshot
+        return sum(len(index) - len(tombstones) for index, tombstones in snapshot.segments) + len(snapshot.delta)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in self._transient:
+            state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._create_locks()
+
+
+class SegmentedIndex(ConcurrentIndex):
+    """Log-structured ConcurrentIndex. Once the delta reaches segment_size images it is sealed: rebuilt by
+    index_factory into an immutable segment. Deletions only add tombstones. A merger compacts runs of merge_factor
+    segments of the same size tier into one, dropping deleted images, so that an image is rewritten O(log(n)) times
+    and ingest cost does not grow with the catalogue. With background set the merger runs in its own thread.
+    """
+    _transient = ConcurrentIndex._transient + ('merger_lock', '_merger', '_merge_error')
+
+    def __init__(self, ranker, index_factory=ForwardIndex, segment_size=1024, merge_factor=4, background=True):
+        ConcurrentIndex.__init__(self, ranker, index_factory, segment_size)
+        self.merge_factor = merge_factor
+        self.background = background
+
+    def _create_locks(self):
+        ConcurrentIndex._create_locks(self)
+        self.merger_lock = threading.Lock()
+        self._merger = None
+        self._merge_error = None
+
+    @property
+    def segment_size(self):
+        return self.merge_threshold
+
+    def _publish(self):
+        with self.delta_lock:
+            self.snapshot = self.snapshot._replace(freq_vector=self.stats.vw_freq())
+        if len(self.snapshot.delta) >= self.segment_size:
+            self._seal()
+
+    def _seal(self):
+        snapshot = self.snapshot
+        segment = Segment(self._merge_indexes((), snapshot.delta), frozenset())
+        self._restore_stats(snapshot.delta.iter_items(), segment.index.iter_items())
+        with self.delta_lock:
+            self.snapshot = self.snapshot._replace(segments=snapshot.segments + (segment,),
+                                                   delta=ForwardIndex(self.ranker), freq_vector=self.stats.vw_freq())
+        self._schedule_compaction()
+
+    def _schedule_compaction(self):
+        if not self.background:
+            self._compact()
+            return
+        with self.merger_lock:
+            if self._merger is None:
+                self._merger = threading.Thread(target=self._compact, daemon=True)
+                self._merger.start()
+
+    def _compact(self):
+        try:
+            while True:
+                with self.merger_lock:
+                    run = self._compaction_run(self.snapshot.segments)
+                    if run is None:
+                        self._merger = None
+                        return
+                self._replace_run(run, self._merge_indexes(run))
+        except Exception as error:
+            with self.merger_lock:
+                self._merger = None
+                if self.background:
+                    self._merge_error = error
+                    return
+            raise
+
+    def _compaction_run(self, segments):
+        """Returns the first run of merge_factor adjacent segments of the same size tier or None."""
+        tiers = [self._tier(len(index)) for index, tombstones in segments]
+        for start in range(len(segments) - self.merge_factor + 1):
+            if len(set(tiers[start:start + self.merge_factor])) == 1:
+                return segments[start:start + self.merge_factor]
+        return None
+
+    def _tier(self, size):
+        tier, capacity = 0, self.segment_size
+        while size > capacity:
+            tier += 1
+            capacity *= self.merge_factor
+        return tier
+
+    def _replace_run(self, run, index):
+        """Replaces run of segments with merged index, keeping tombstones added while it was built."""
+        with self.write_lock:
+            segments = self.snapshot.segments
+            indexes = [segment_index for segment_index, tombstones in segments]
+            start = next((position for position, segment_index in enumerate(indexes) if segment_index is run[0].index),
+                         None)
+            current = segments[start:start + len(run)] if start is not None else ()
+            if len(current) != len(run) or any(segment.index is not old.index for segment, old in zip(current, run)):
+                return
+            tombstones = frozenset().union(*(segment.tombstones - old.tombstones for segment, old in zip(current, run)))
+            self._restore_stats(_live_items(current), _live_items([Segment(index, tombstones)]))
+            with self.delta_lock:
+                self.snapshot = self.snapshot._replace(
+                    segments=segments[:start] + (Segment(index, tombstones),) + segments[start + len(run):],
+                    freq_vector=self.stats.vw_freq())
+
+    def join(self):
+        """Waits until the background merger has nothing to compact. Raises the error which stopped the merger."""
+        while True:
+            merger = self._merger
+            if merger is None:
+                break
+            merger.join()
+        error, self._merge_error = self._merge_error, None
+        if error is not None:
+            raise error
+
+
+def _live_items(segments):
+    """Yields (image_id, hist) pairs of segment images without tombstones."""
+    for segment_index, tombstones in segments:
+        for image_id, hist in segment_index.iter_items():
+            if image_id not in tombstones:
+                yield image_id, hist
+
+
+def _segment_position(segments, image_id):
+    """Returns position of the segment keeping alive image_id or None."""
+    for position, (index, tombstones) in enumerate(segments):
+        if image_id not in tombstones and image_id in index.ids:
+            return position
+    return None
+
+
+class IdTable:
+    """Two-way mapping of rows and image ids, None marks a free row. The image id to row dict is built
+    on first use, so that a table opened from disk serves ranking without reading every image id.
+    """
+
+    def __init__(self, image_ids=None, count=None):
+        self.image_ids = [] if image_ids is None else image_ids
+        self.count = len(self.image_ids) if count is None else count
+        self._rows = {} if image_ids is None else None
+
+    @property
+    def rows(self):
+        if self._rows is None:
+            self.image_ids = list(self.image_ids)
+            self._rows = {image_id: row for row, image_id in enumerate(self.image_ids) if image_id is not None}
+        return self._rows
+
+    def assign(self, image_id, row):
+        """Assigns image id to a free row or to the row following the last one."""
+        rows = self.rows
+        if row == len(self.image_ids):
+            self.image_ids.append(image_id)
+        else:
+            self.image_ids[row] = image_id
+        rows[image_id] = row
+        self.count += 1
+
+    def release(self, image_id):
+        """Removes image id. Returns its row."""
+        row = self.rows.pop(image_id)
+        self.image_ids[row] = None
+        self.count -= 1
+        return row
+
+    def move(self, source, destination):
+        """Moves image id from row source to free row destination."""
+        image_id = self.image_ids[source]
+        self.image_ids[destination] = image_id
+        self.image_ids[source] = None
+        self.rows[image_id] = destination
+
+    def truncate(self, size):
+        """Drops rows starting from size. They must be free."""
+        del self.image_ids[size:]
+
+    def __contains__(self, image_id):
+        return image_id in self.rows
+
+    def __getitem__(self, image_id):
+        return self.rows[image_id]
+
+    def __len__(self):
+        return self.count
+
+
+class PostingList:
+    """Posting list of (doc id, weight) pairs kept in two growable arrays."""
+
+    def __init__(self):
+        self.doc_array = numpy.empty(0, dtype=numpy.int64)
+        self.weight_array = numpy.empty(0, dtype=numpy.float32)
+        self.size = 0
+
+    def docs(self):
+        return self.doc_array[:self.size]
+
+    def weights(self):
+        return self.weight_array[:self.size]
+
+    def append(self, doc, weight):
+        if self.size == len(self.doc_array):
+            capacity = max(8, 2 * self.size)
+            self.doc_array = numpy.resize(self.doc_array, capacity)
+            self.weight_array = numpy.resize(self.weight_array, capacity)
+        self.doc_array[self.size] = doc
+        self.weight_array[self.size] = weight
+        self.size += 1
+
+    def remove(self, doc):
+        keep = self.docs() != doc
+        size = int(numpy.count_nonzero(keep))
+        self.doc_array[:size] = self.docs()[keep]
+        self.weight_array[:size] = self.weights()[keep]
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+
+class RowSelection:
+    """Read-only sequence of values[rows[i]] computed on access."""
+
+    def __init__(self, values, rows):
+        self.values = values
+        self.rows = rows
+
+    def __getitem__(self, i):
+        return self.values[self.rows[i]]
 
     def __len__(self):
-        return len(set(image_id for subindex in self.index for image_id in subindex))
+        return len(self.rows)
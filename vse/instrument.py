@@ -0,0 +1,188 @@
+"""Instrumentation
+
+Hot paths of the engine report stage latencies (seconds) and sizes through record(name, value):
+
+    decode, resize          image decoding and resizing (utils)
+    detect, describe        key point detection and descriptor computation or BOW assignment (BagOfVisualWords)
+    quantize                assignment of descriptors to visual words by quantizer
+    keypoints               number of detected key points
+    cache_hit               1 on hit, 0 on miss of HistCache
+    candidates              gathering of InvertedIndex candidates
+    candidate_count         number of images ranked by an index
+    rank                    weighing and scoring of candidates by ranker
+    verify                  geometric verification
+    find_similar            whole VisualSearchEngine.find_similar call
+
+Records go to hooks, objects with record(name, value) method like StageTimings or HistogramMetrics, added with
+add_hook, and to every trace() open in the current context, which collects records of a single call.
+When there are no hooks and no open traces, timed() returns a shared no-op context manager and record() returns
+at once. Records of histograms generated in worker processes are not reported.
+"""
+
+import bisect
+import contextlib
+import contextvars
+import threading
+import time
+
+__all__ = ['HistogramMetrics',
+           'StageTimings',
+           'add_hook',
+           'enabled',
+           'record',
+           'remove_hook',
+           'timed',
+           'trace',
+           ]
+
+_hooks = ()
+_traces = contextvars.ContextVar('traces', default=())
+_open_traces = 0
+_lock = threading.Lock()
+_disabled = contextlib.nullcontext()
+
+
+def add_hook(hook):
+    """Adds hook receiving every record."""
+    global _hooks
+    with _lock:
+        _hooks = _hooks + (hook,)
+
+
+def remove_hook(hook):
+    global _hooks
+    with _lock:
+        _hooks = tuple(added for added in _hooks if added is not hook)
+
+
+def enabled():
+    """Returns True if records are reported to any hook or trace."""
+    return bool(_hooks or _open_traces)
+
+
+def record(name, value):
+    """Reports value of name to hooks and traces of the current context."""
+    if not (_hooks or _open_traces):
+        return
+    for hook in _hooks:
+        hook.record(name, value)
+    for records in _traces.get():
+        records.append((name, value))
+
+
+def timed(stage):
+    """Returns context manager recording seconds spent in its block as stage."""
+    if not (_hooks or _open_traces):
+        return _disabled
+    return _Span(stage)
+
+
+class _Span:
+    __slots__ = ('stage', 'start')
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        record(self.stage, time.perf_counter() - self.start)
+
+
+@contextlib.contextmanager
+def trace():
+    """Context manager collecting list of (name, value) records reported in the current context (thread or task)
+    while it is open, e.g. records of one find_similar call.
+    """
+    global _open_traces
+    records = []
+    token = _traces.set(_traces.get() + (records,))
+    with _lock:
+        _open_traces += 1
+    try:
+        yield records
+    finally:
+        with _lock:
+            _open_traces -= 1
+        _traces.reset(token)
+
+
+class StageTimings:
+    """Count, total and maximum of values recorded for every stage."""
+
+    def __init__(self):
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    def record(self, stage, value):
+        with self.lock:
+            count, total, maximum = self.stages.get(stage, (0, 0., 0.))
+            self.stages[stage] = (count + 1, total + value, max(maximum, value))
+
+    def summary(self):
+        """Returns dict of stage name and dict of count, total, mean and max."""
+        with self.lock:
+            return {stage: {'count': count, 'total': total, 'mean': total / count, 'max': maximum}
+                    for stage, (count, total, maximum) in self.stages.items()}
+
+
+class HistogramMetrics:
+    """Histograms of recorded values with cumulative counts for bucket upper bounds, like Prometheus histograms.
+    Default bounds cover 1 microsecond to 100 seconds and counts up to 100000, three buckets per decade.
+    """
+    BOUNDS = tuple(mantissa * 10. ** exponent for exponent in range(-6, 5) for mantissa in (1, 2.5, 5)) + (1e5,)
+
+    def __init__(self, bounds=BOUNDS, prefix='vse'):
+        self.bounds = tuple(bounds)
+        self.prefix = prefix
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def record(self, name, value):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = [[0] * (len(self.bounds) + 1), 0, 0.]
+            histogram[0][bisect.bisect_left(self.bounds, value)] += 1
+            histogram[1] += 1
+            histogram[2] += value
+
+    def quantile(self, name, q):
+        """Returns upper bound of the bucket containing q-quantile of name values, inf if above all bounds."""
+        with self.lock:
+            counts, count, total = self.histograms[name]
+            return self._quantile(counts, count, q)
+
+    def _quantile(self, counts, count, q):
+        rank, seen = q * count, 0
+        for bound, bucket_count in zip(self.bounds + (float('inf'),), counts):
+            seen += bucket_count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def summary(self):
+        """Returns dict of name and dict of count, sum, mean, p50, p90 and p99."""
+        with self.lock:
+            return {name: {'count': count, 'sum': total, 'mean': total / count,
+                           'p50': self._quantile(counts, count, 0.5), 'p90': self._quantile(counts, count, 0.9),
+                           'p99': self._quantile(counts, count, 0.99)}
+                    for name, (counts, count, total) in self.histograms.items()}
+
+    def export(self):
+        """Returns histograms in Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            for name, (counts, count, total) in sorted(self.histograms.items()):
+                metric = '{}_{}'.format(self.prefix, name)
+                lines.append('# TYPE {} histogram'.format(metric))
+                cumulative = 0
+                for bound, bucket_count in zip(self.bounds, counts):
+                    cumulative += bucket_count
+                    lines.append('{}_bucket{{le="{:g}"}} {}'.format(metric, bound, cumulative))
+                lines.append('{}_bucket{{le="+Inf"}} {}'.format(metric, count))
+                lines.append('{}_sum {!r}'.format(metric, total))
+                lines.append('{}_count {}'.format(metric, count))
+        return '\n'.join(lines) + '\n'
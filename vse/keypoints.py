@@ -0,0 +1,116 @@
+"""Key point budget
+
+Highly textured images yield thousands of key points, so extraction and quantization time varies a lot between
+images. KeypointBudget keeps at most max_keypoints of the strongest key points spread over the image and adjusts
+the detector threshold of images with too many key points, so that detectors find about target key points.
+"""
+
+import threading
+
+import cv2
+import numpy
+
+__all__ = ['KeypointBudget',
+           'select_keypoints',
+           ]
+
+
+def select_keypoints(key_points, budget, image_shape, grid=4):
+    """Returns at most budget key points with the strongest response spread over grid x grid cells of image.
+    Every cell keeps its strongest budget // grid ** 2 key points, the rest of budget goes to the strongest
+    remaining ones. Key points are returned in their original order.
+    """
+    if len(key_points) <= budget:
+        return list(key_points)
+    responses = numpy.array([key_point.response for key_point in key_points], dtype=numpy.float64)
+    points = numpy.array([key_point.pt for key_point in key_points], dtype=numpy.float64).reshape(-1, 2)
+    height, width = image_shape[:2]
+    columns = numpy.clip((points[:, 0] * grid // max(width, 1)).astype(numpy.int64), 0, grid - 1)
+    rows = numpy.clip((points[:, 1] * grid // max(height, 1)).astype(numpy.int64), 0, grid - 1)
+    cells = rows * grid + columns
+    order = numpy.lexsort((-responses, cells))
+    sorted_cells = cells[order]
+    rank = numpy.arange(len(order)) - numpy.searchsorted(sorted_cells, sorted_cells, 'left')
+    quota = budget // (grid * grid)
+    selected = order[rank < quota]
+    rest = order[rank >= quota]
+    rest = rest[numpy.argsort(-responses[rest], kind='stable')][:budget - len(selected)]
+    return [key_points[i] for i in numpy.sort(numpy.concatenate((selected, rest)))]
+
+
+class KeypointBudget:
+    """Limits key points detected by an extractor to max_keypoints selected by select_keypoints.
+    If parameter is given, e.g. 'HessianThreshold' (SURF), 'ContrastThreshold' (SIFT), 'Threshold' (AKAZE)
+    or 'FastThreshold' (ORB), the threshold is chosen before detecting: key points of the image are estimated by
+    detecting them in a probe, the image downscaled by probe_scale, assuming their number grows with image area.
+    If the estimate is off target (by default twice max_keypoints) by more than tolerance, the image is detected
+    with the threshold multiplied by (estimated / target) ** gain, at most by 2, and kept within bounds. The probe
+    costs about probe_scale ** 2 of a detection, every image is detected once. The threshold is restored afterwards,
+    so key points of an image do not depend on images detected before, and query and indexed images get the same
+    histograms in every process. By default the threshold is not lowered below its initial value, so images with
+    few key points are not searched for more of them. Adjusted detections are serialized by a lock, so threads sharing
+    the extractor (e.g. the default executor of AsyncVisualSearchEngine) do not see each other's thresholds; use
+    processes to detect in parallel. The extractor must not be used without the budget while detecting.
+    """
+
+    def __init__(self, max_keypoints=500, grid=4, parameter=None, target=None, gain=0.5, tolerance=0.25,
+                 bounds=None, probe_scale=0.25):
+        self.max_keypoints = max_keypoints
+        self.grid = grid
+        self.parameter = parameter
+        self.target = target or 2 * max_keypoints
+        self.gain = gain
+        self.tolerance = tolerance
+        self.bounds = bounds
+        self.probe_scale = probe_scale
+        self._lock = threading.Lock()
+
+    def detect(self, extractor, image):
+        """Returns key points of image detected by extractor, at most max_keypoints."""
+        if self.parameter is None:
+            key_points = extractor.detect(image)
+        else:
+            with self._lock:
+                key_points = self._detect_adjusted(extractor, image)
+        return select_keypoints(key_points, self.max_keypoints, image.shape, self.grid)
+
+    def _detect_adjusted(self, extractor, image):
+        """Returns key points of image detected with threshold adjusted to the number estimated with a probe."""
+        initial = getattr(extractor, 'get' + self.parameter)()
+        threshold = self.threshold(initial, self.estimate(extractor, image))
+        if threshold == initial:
+            return extractor.detect(image)
+        setter = getattr(extractor, 'set' + self.parameter)
+        setter(threshold)
+        try:
+            return extractor.detect(image)
+        finally:
+            setter(initial)
+
+    def estimate(self, extractor, image):
+        """Returns number of key points extractor is estimated to detect in image, from its downscaled probe."""
+        height, width = image.shape[:2]
+        size = (max(int(round(width * self.probe_scale)), 1), max(int(round(height * self.probe_scale)), 1))
+        probe = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+        return len(extractor.detect(probe)) * width * height / (size[0] * size[1])
+
+    def threshold(self, value, detected):
+        """Returns threshold to use for an image where threshold value finds about detected key points."""
+        ratio = detected / self.target
+        if 1 / (1 + self.tolerance) <= ratio <= 1 + self.tolerance:
+            return value
+        lower, upper = self.bounds if self.bounds is not None else (value, float('inf'))
+        updated = value * min(max(ratio ** self.gain, 0.5), 2.)
+        updated = min(max(updated, lower), upper)
+        if isinstance(value, int):
+            updated = max(int(round(updated)), 1)
+        return updated
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
@@ -0,0 +1,143 @@
+"""Quantizers assigning image descriptors to the nearest visual words of a vocabulary."""
+
+import cv2
+import numpy
+from abc import ABCMeta, abstractmethod
+
+__all__ = ['Quantizer',
+           'MatcherQuantizer',
+           'BruteForceQuantizer',
+           'FlannQuantizer',
+           'HammingQuantizer',
+           'hamming_distances',
+           'words_hist',
+           ]
+
+
+class Quantizer(metaclass=ABCMeta):
+    def __init__(self, vocabulary):
+        self.vocabulary = vocabulary
+
+    @abstractmethod
+    def quantize(self, descriptors):
+        """Returns index of the nearest visual word for every descriptor."""
+        pass
+
+    def __len__(self):
+        return len(self.vocabulary)
+
+
+class MatcherQuantizer(Quantizer):
+    """Assigns visual words with OpenCV descriptor matcher, the way cv2.BOWImgDescriptorExtractor does.
+    The default brute force matcher compares binary (uint8) vocabularies with Hamming distance, counting bits
+    of XORed packed descriptors, and float ones with L2 distance.
+    """
+
+    def __init__(self, vocabulary, matcher=None):
+        Quantizer.__init__(self, vocabulary)
+        if matcher is None:
+            matcher = cv2.BFMatcher(normType=cv2.NORM_HAMMING if vocabulary.dtype == numpy.uint8 else cv2.NORM_L2)
+        self.matcher = matcher
+
+    def quantize(self, descriptors):
+        matches = self.matcher.match(numpy.asarray(descriptors, dtype=self.vocabulary.dtype), self.vocabulary)
+        return numpy.array([match.trainIdx for match in matches], dtype=numpy.int64)
+
+
+class BruteForceQuantizer(Quantizer):
+    """Exact nearest visual word search computing squared L2 distances as blocked matrix products."""
+
+    def __init__(self, vocabulary, block_size=4096):
+        Quantizer.__init__(self, numpy.asarray(vocabulary, dtype=numpy.float32))
+        self.block_size = block_size
+        self.squared_norms = numpy.einsum('ij,ij->i', self.vocabulary, self.vocabulary)
+
+    def quantize(self, descriptors):
+        descriptors = numpy.asarray(descriptors, dtype=numpy.float32)
+        words = numpy.empty(len(descriptors), dtype=numpy.int64)
+        for start in range(0, len(descriptors), self.block_size):
+            block = descriptors[start:start + self.block_size]
+            distances = self.squared_norms - 2 * block.dot(self.vocabulary.T)
+            words[start:start + len(block)] = numpy.argmin(distances, axis=1)
+        return words
+
+
+class FlannQuantizer(Quantizer):
+    """Approximate nearest visual word search in randomized k-d trees built by FLANN."""
+    FLANN_INDEX_KDTREE = 1
+
+    def __init__(self, vocabulary, trees=4, checks=32):
+        Quantizer.__init__(self, numpy.asarray(vocabulary, dtype=numpy.float32))
+        self.checks = checks
+        self.index = cv2.flann_Index(self.vocabulary, {'algorithm': self.FLANN_INDEX_KDTREE, 'trees': trees})
+
+    def quantize(self, descriptors):
+        if len(descriptors) == 0:
+            return numpy.empty(0, dtype=numpy.int64)
+        descriptors = numpy.ascontiguousarray(descriptors, dtype=numpy.float32)
+        indices, _ = self.index.knnSearch(descriptors, 1, params={'checks': self.checks})
+        return indices.ravel().astype(numpy.int64)
+
+
+class HammingQuantizer(Quantizer):
+    """Exact nearest visual word search for binary descriptors (bits packed in uint8 bytes, e.g. ORB) by Hamming
+    distance: population count of XORed packed descriptors, taken 64 bits at a time with numpy.bitwise_count
+    (NumPy 2) or byte by byte from a lookup table. Distances of a block of descriptors to all visual words are
+    accumulated word by word of packed bits, blocks hold at most block_elements distances.
+    """
+
+    def __init__(self, vocabulary, block_size=1024, block_elements=1 << 16):
+        Quantizer.__init__(self, numpy.asarray(vocabulary, dtype=numpy.uint8))
+        self.block_size = block_size
+        self.block_elements = block_elements
+        self.packed_columns = numpy.ascontiguousarray(_packed_words(self.vocabulary).T)
+
+    def quantize(self, descriptors):
+        descriptors = numpy.asarray(descriptors, dtype=numpy.uint8).reshape(-1, self.vocabulary.shape[1])
+        words = numpy.empty(len(descriptors), dtype=numpy.int64)
+        rows = max(1, min(self.block_size, self.block_elements // max(len(self.vocabulary), 1)))
+        for start in range(0, len(descriptors), rows):
+            block = _packed_words(descriptors[start:start + rows])
+            distances = numpy.zeros((len(block), len(self.vocabulary)), dtype=numpy.int32)
+            for column, vocabulary_column in zip(block.T, self.packed_columns):
+                distances += _popcount(column[:, numpy.newaxis] ^ vocabulary_column)
+            words[start:start + len(block)] = numpy.argmin(distances, axis=1)
+        return words
+
+
+def hamming_distances(descriptors, words):
+    """Returns Hamming distances between rows of two broadcastable arrays of packed binary descriptors."""
+    xored = numpy.bitwise_xor(descriptors, words)
+    return _popcount(_packed_words(xored)).sum(axis=-1, dtype=numpy.int64)
+
+
+_bitwise_count = getattr(numpy, 'bitwise_count', None)
+_POPCOUNT = numpy.unpackbits(numpy.arange(1 << 16, dtype='>u2').view(numpy.uint8)).reshape(-1, 16).sum(
+    axis=1, dtype=numpy.uint8)
+
+
+def _packed_words(descriptors):
+    """Returns packed uint8 descriptors viewed as the widest words _popcount counts: uint64 for numpy.bitwise_count,
+    uint16 for the lookup table, uint8 if the number of bytes is not divisible.
+    """
+    descriptors = numpy.ascontiguousarray(descriptors, dtype=numpy.uint8)
+    width = descriptors.shape[-1] if descriptors.ndim else 0
+    for dtype in ((numpy.uint64,) if _bitwise_count is not None else ()) + (numpy.uint16,):
+        if width and width % numpy.dtype(dtype).itemsize == 0:
+            return descriptors.view(dtype)
+    return descriptors
+
+
+def _popcount(array):
+    """Returns number of set bits of every element of an unsigned integer array."""
+    if _bitwise_count is not None:
+        return _bitwise_count(array)
+    return _POPCOUNT[array]
+
+
+def words_hist(words, recognized_visual_words):
+    """Returns visual words frequency histogram normalized by number of descriptors like cv2.BOWImgDescriptorExtractor."""
+    hist = numpy.bincount(words, minlength=recognized_visual_words).astype(numpy.float32)
+    if len(words):
+        hist /= len(words)
+    return hist
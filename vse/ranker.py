@@ -1,6 +1,6 @@
-import math
 import heapq
 import operator
+import numpy
 from abc import ABCMeta, abstractmethod
 from vse.utils import normalize
 
@@ -10,19 +10,19 @@ __all__ = ['Ranker',
            ]
 
 
-def tfidf(hist, freq_hist):
-    """Term frequency - inverse document frequency scoring."""
-    return [n * -log(n_freq) for n, n_freq in zip(hist, freq_hist)]
+BLOCK_SCORES = 1 << 22
 
 
-def log(n):
-    if n == 0:
-        return 0
-    else:
-        return math.log(n)
+def tfidf(hist, freq_hist):
+    """Term frequency - inverse document frequency scoring. Accepts histogram or matrix of histograms."""
+    freq_hist = numpy.asarray(freq_hist, dtype=numpy.float32)
+    idf = numpy.log(freq_hist, out=numpy.zeros_like(freq_hist), where=freq_hist > 0)
+    return numpy.asarray(hist, dtype=numpy.float32) * -idf
 
 
 class Ranker(metaclass=ABCMeta):
+    cache_tolerance = None
+
     def __init__(self, hist_comparator):
         self.hist_comparator = hist_comparator
 
@@ -31,6 +31,41 @@ class Ranker(metaclass=ABCMeta):
         """Ranks index items by similarity to query_hist. Returns list of tuples: (image_id, diff_ratio)."""
         pass
 
+    def rank_weighted_many(self, weighted_query_hists, image_ids, weighted_matrix, n, columns=None):
+        """Ranks rows against every weighted query, scoring blocks of queries at once with compare_many_queries.
+        columns[i], if given, are sorted positions of rows ranked for the i-th query.
+        """
+        if len(image_ids) == 0:
+            return [[] for weighted_query_hist in weighted_query_hists]
+        block_size = max(1, BLOCK_SCORES // len(image_ids))
+        results = []
+        for start in range(0, len(weighted_query_hists), block_size):
+            block = numpy.asarray(weighted_query_hists[start:start + block_size])
+            for i, scores in enumerate(self.hist_comparator.compare_many_queries(block, weighted_matrix), start):
+                if columns is None:
+                    results.append(self._n_best_rows(image_ids, scores, n))
+                else:
+                    rows = columns[i]
+                    results.append([(image_ids[rows[position]], float(scores[rows[position]]))
+                                    for position in self._n_best_positions(scores[rows], n)])
+        return results
+
+    def weigh_query(self, query_hist, freq_vector):
+        """Returns query histogram in the form compared by the ranker."""
+        return query_hist
+
+    def weigh_queries(self, matrix, freq_vector):
+        """Returns matrix of query histograms weighted like weigh_query, row by row."""
+        return matrix
+
+    def weigh_items(self, matrix, freq_vector):
+        """Returns matrix of item histograms in the form compared by the ranker."""
+        return matrix
+
+    def merge(self, results, n):
+        """Merges lists of results ranked by this ranker into n best results."""
+        return self._n_best_results([result for partial_results in results for result in partial_results], n)
+
     def _rank_best_results(self, items, n, diff_ratio_function):
         results = [(image_id, diff_ratio_function(hist)) for image_id, hist in items]
         return self._n_best_results(results, n)
@@ -42,6 +77,23 @@ class Ranker(metaclass=ABCMeta):
             function = heapq.nsmallest
         return function(n, results, key=operator.itemgetter(1))
 
+    def _n_best_rows(self, image_ids, scores, n):
+        return [(image_ids[row], float(scores[row])) for row in self._n_best_positions(scores, n)]
+
+    def _n_best_positions(self, scores, n):
+        """Returns positions of n best scores, best first, ties in position order."""
+        if n <= 0 or len(scores) == 0:
+            return []
+        keys = -scores if self.hist_comparator.reversed else scores
+        if n < len(keys):
+            kth = numpy.partition(keys, n - 1)[n - 1]
+            better = numpy.flatnonzero(keys < kth)
+            ties = numpy.flatnonzero(keys == kth)[:n - len(better)]
+            best = numpy.sort(numpy.concatenate((better, ties)))
+        else:
+            best = numpy.arange(len(keys))
+        return best[numpy.argsort(keys[best], kind='stable')]
+
 
 class SimpleRanker(Ranker):
     def __init__(self, hist_comparator):
@@ -56,16 +108,46 @@ class SimpleRanker(Ranker):
 
 
 class WeighingRanker(Ranker):
-    def __init__(self, hist_comparator, query_weigh_function=tfidf, item_weigh_function=tfidf):
+    """Ranker comparing weighted and normalized histograms.
+    If cache_tolerance is given, indexes keep weighted item histograms and reweigh them
+    only when visual words frequency drifts by more than cache_tolerance (relative L1 distance).
+    Weigh functions take a single histogram. If vectorized is set, they are called once with the whole matrix of
+    items or queries and must weigh it row by row, returning a matrix of the same shape. By default only tfidf is.
+    """
+    vectorized = None
+
+    def __init__(self, hist_comparator, query_weigh_function=tfidf, item_weigh_function=tfidf, cache_tolerance=None,
+                 vectorized=None):
         Ranker.__init__(self, hist_comparator)
         self.query_weigh_function = query_weigh_function
         self.item_weigh_function = item_weigh_function
+        self.cache_tolerance = cache_tolerance
+        self.vectorized = vectorized
 
     def rank(self, query_hist, items, n, freq_vector):
-        weighted_query_hist = normalize(self.query_weigh_function(query_hist, freq_vector))
+        weighted_query_hist = self.weigh_query(query_hist, freq_vector)
 
         def diff_ratio_function(hist):
             weighted_item_hist = normalize(self.item_weigh_function(hist, freq_vector))
             return self.hist_comparator.compare(weighted_item_hist, weighted_query_hist)
 
         return self._rank_best_results(items, n, diff_ratio_function)
+
+    def weigh_query(self, query_hist, freq_vector):
+        return normalize(self.query_weigh_function(query_hist, freq_vector))
+
+    def weigh_queries(self, matrix, freq_vector):
+        return self._weigh_rows(self.query_weigh_function, matrix, freq_vector)
+
+    def weigh_items(self, matrix, freq_vector):
+        return self._weigh_rows(self.item_weigh_function, matrix, freq_vector)
+
+    def _weigh_rows(self, weigh_function, matrix, freq_vector):
+        if not (weigh_function is tfidf if self.vectorized is None else self.vectorized):
+            weighted = [weigh_function(hist, freq_vector) for hist in matrix]
+            return normalize(numpy.reshape(numpy.asarray(weighted, dtype=numpy.float32), numpy.shape(matrix)))
+        weighted = weigh_function(matrix, freq_vector)
+        if numpy.shape(weighted) != numpy.shape(matrix):
+            raise ValueError('Vectorized weigh function returned shape %s for matrix of shape %s'
+                             % (numpy.shape(weighted), numpy.shape(matrix)))
+        return normalize(weighted)
@@ -0,0 +1,217 @@
+"""Sharded image index
+
+Images are partitioned by hash of image id across worker processes, each of them keeping its own index.
+Visual words statistics are kept in the parent process and sent with every query, so that shards rank
+with the same global frequency vector as a single index would. A query is sent to all shards at once
+and their top-n results are merged.
+"""
+
+import multiprocessing
+import numbers
+import threading
+import weakref
+import zlib
+
+import numpy
+
+from vse.error import DuplicatedImageError, NoImageError
+from vse.index import Index, ForwardIndex
+
+__all__ = ['ShardedIndex',
+           ]
+
+
+class ShardedIndex(Index):
+    """Index partitioned across shards worker processes communicating through pipes.
+    index_factory is a picklable callable creating index of a shard from ranker, e.g. ForwardIndex class
+    or functools.partial(InvertedIndex, recognized_visual_words=1000). Use it as image index of VisualSearchEngine.
+    Image ids must be strings or integers (also NumPy integers and integral floats), ids of other types raise TypeError.
+    """
+
+    def __init__(self, ranker, shards=None, index_factory=ForwardIndex, context=None):
+        Index.__init__(self, ranker)
+        self.shards = shards or multiprocessing.cpu_count()
+        self.index_factory = index_factory
+        self.context = context
+        self._start()
+
+    def _start(self):
+        context = multiprocessing.get_context(self.context)
+        self.lock = threading.Lock()
+        self.connections, self.processes = [], []
+        for shard in range(self.shards):
+            connection, worker_connection = context.Pipe()
+            process = context.Process(target=_serve, args=(worker_connection, self.index_factory, self.ranker),
+                                      daemon=True)
+            process.start()
+            worker_connection.close()
+            self.connections.append(connection)
+            self.processes.append(process)
+        self._finalizer = weakref.finalize(self, _shutdown, self.connections, self.processes)
+
+    def close(self):
+        """Stops worker processes."""
+        self._finalizer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def shard_of(self, image_id):
+        """Returns shard number of image id, stable across processes and runs. Equal ids get the same shard."""
+        return zlib.crc32(_shard_key(image_id).encode('utf-8')) % self.shards
+
+    def find(self, query_hist, n, freq_vector=None):
+        return self.find_many([query_hist], n, freq_vector)[0]
+
+    def find_many(self, query_hists, n, freq_vector=None):
+        if freq_vector is None:
+            freq_vector = self.vw_freq
+        query_hists = [numpy.asarray(query_hist, dtype=numpy.float32) for query_hist in query_hists]
+        shard_results = self._scatter({shard: ('find_many', (query_hists, n, freq_vector))
+                                       for shard in range(self.shards)})
+        return [self.ranker.merge(results, n) for results in zip(*shard_results.values())]
+
+    def add_many(self, items):
+        """Adds (image_id, hist) pairs on their shards. Returns list of (image_id, error) in input order
+        for images which were not added, frequency statistics are updated only with added histograms.
+        Other errors stop adding on the shard and are raised once statistics are updated.
+        """
+        items = [(image_id, numpy.ravel(hist)) for image_id, hist in items]
+        parts = {}
+        for position, (image_id, hist) in enumerate(items):
+            parts.setdefault(self.shard_of(image_id), []).append(position)
+        shard_results = self._scatter({shard: ('add_each', ([items[position] for position in positions],))
+                                       for shard, positions in parts.items()})
+        results = [(None, None)] * len(items)
+        for shard, positions in parts.items():
+            for position, result in zip(positions, shard_results[shard]):
+                results[position] = result
+        added = [stored for stored, error in results if stored is not None]
+        if added:
+            self._update_freq_after_addition(numpy.array(added))
+        failure = next((error for stored, error in results if error is not None
+                        and not isinstance(error, DuplicatedImageError)), None)
+        if failure is not None:
+            raise failure
+        return [(image_id, error) for (image_id, hist), (stored, error) in zip(items, results) if error is not None]
+
+    def items(self):
+        shard_items = self._scatter({shard: ('items', ()) for shard in range(self.shards)})
+        return [item for shard in range(self.shards) for item in shard_items[shard]]
+
+    def iter_items(self):
+        """Yields (image_id, hist) pairs shard by shard, items of a single shard are held at once."""
+        for shard in range(self.shards):
+            yield from self._call(shard, 'items')
+
+    def _add(self, image_id, hist):
+        self._call(self.shard_of(image_id), '__setitem__', image_id, hist)
+
+    def _remove(self, image_id):
+        self._call(self.shard_of(image_id), '__delitem__', image_id)
+
+    def __getitem__(self, image_id):
+        return self._call(self.shard_of(image_id), '__getitem__', image_id)
+
+    def __contains__(self, image_id):
+        try:
+            self[image_id]
+        except (KeyError, NoImageError):
+            return False
+        return True
+
+    def __len__(self):
+        return self.stats.image_count
+
+    def _call(self, shard, command, *args):
+        return self._scatter({shard: (command, args)})[shard]
+
+    def _scatter(self, requests):
+        """Sends {shard: (command, args)} requests to all shards first, then gathers {shard: result}.
+        Raises the first error returned by a shard.
+        """
+        with self.lock:
+            for shard, request in requests.items():
+                self.connections[shard].send(request)
+            replies = {shard: self.connections[shard].recv() for shard in requests}
+        for status, result in replies.values():
+            if status == 'error':
+                raise result
+        return {shard: result for shard, (status, result) in replies.items()}
+
+    def __getstate__(self):
+        return {'ranker': self.ranker, 'shards': self.shards, 'index_factory': self.index_factory,
+                'context': self.context, 'items': self.items()}
+
+    def __setstate__(self, state):
+        ShardedIndex.__init__(self, state['ranker'], state['shards'], state['index_factory'], state['context'])
+        self.add_many(state['items'])
+
+
+def _shard_key(image_id):
+    """Returns string hashed to route image id, the same for ids comparing equal, e.g. 5, numpy.int64(5) and 5.0."""
+    if isinstance(image_id, str):
+        return image_id
+    if isinstance(image_id, numbers.Integral):
+        return str(int(image_id))
+    if isinstance(image_id, numbers.Real) and float(image_id).is_integer():
+        return str(int(image_id))
+    raise TypeError('image id must be a string or an integer, not {}'.format(type(image_id).__name__))
+
+
+def _serve(connection, index_factory, ranker):
+    """Worker process loop executing (command, args) requests on the shard index until connection is closed."""
+    index = index_factory(ranker)
+    while True:
+        try:
+            request = connection.recv()
+        except EOFError:
+            return
+        if request is None:
+            return
+        command, args = request
+        try:
+            if command in _COMMANDS:
+                reply = 'ok', _COMMANDS[command](index, *args)
+            else:
+                reply = 'ok', getattr(index, command)(*args)
+        except Exception as error:
+            reply = 'error', error
+        connection.send(reply)
+
+
+def _add_each(index, items):
+    """Adds (image_id, hist) pairs one by one. Returns (stored histogram, None) for every added image,
+    (None, error) otherwise. Errors other than DuplicatedImageError stop adding.
+    """
+    results = []
+    for image_id, hist in items:
+        try:
+            index[image_id] = hist
+        except DuplicatedImageError as error:
+            results.append((None, error))
+        except Exception as error:
+            results.append((None, error))
+            break
+        else:
+            results.append((index[image_id], None))
+    return results
+
+
+_COMMANDS = {'add_each': _add_each}
+
+
+def _shutdown(connections, processes):
+    for connection in connections:
+        try:
+            connection.send(None)
+            connection.close()
+        except OSError:
+            pass
+    for process in processes:
+        process.join(timeout=5)
+        if process.is_alive():
+            process.terminate()
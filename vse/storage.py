@@ -0,0 +1,285 @@
+"""On-disk index format
+
+Index is saved to a directory of flat binary arrays described by meta.json:
+
+    meta.json           format version, index type, histogram encoding and array shapes
+    hists.f32           histograms matrix decoded to float32, one row per image
+    ids.i64             image ids if all of them are integers, otherwise
+    ids.bytes, ids.offsets.i64    utf-8 encoded string image ids
+    doc_freq.i64, term_mass.f64   visual words statistics
+    postings.docs.i64, postings.weights.f32, postings.offsets.i64    posting lists of InvertedIndex
+
+ConcurrentIndex and SegmentedIndex are saved as visual words statistics and meta.json listing segment-NNNN
+subdirectories, each of them an index saved as above, with their tombstones. The delta is saved as the last segment.
+
+Arrays are opened with numpy.memmap, so an index is ready to serve queries right after open_index returns
+and processes opening the same index share one page cache copy. By default pages are mapped copy-on-write:
+the index can be modified in memory, while files stay intact. Histograms of indexes with other encodings than
+float32 (see vse.encoding) are encoded again when the index is opened.
+"""
+
+import functools
+import json
+import os
+
+import numpy
+
+from vse.error import IndexFormatError
+from vse.index import ConcurrentIndex, ForwardIndex, InvertedIndex, SegmentedIndex
+from vse.index import IdTable, PostingList, Segment, Snapshot
+from vse.utils import load
+
+__all__ = ['save_index',
+           'open_index',
+           'convert_pickled_index',
+           ]
+
+FORMAT = 'vse-index'
+VERSION = 1
+
+
+def save_index(index, directory):
+    """Saves ForwardIndex, InvertedIndex, ConcurrentIndex or SegmentedIndex to directory.
+    Raises TypeError for other indexes, e.g. IVFIndex, which open_index could not open.
+    """
+    _check_savable(index)
+    os.makedirs(directory, exist_ok=True)
+    if isinstance(index, ConcurrentIndex):
+        _save_segments(index, directory)
+        return
+    rows = numpy.array([row for row, image_id in enumerate(index.ids.image_ids) if image_id is not None],
+                       dtype=numpy.int64)
+    hists = index.hists.view()[rows]
+    image_ids = [index.ids.image_ids[row] for row in rows]
+    meta = {'format': FORMAT,
+            'version': VERSION,
+            'type': type(index).__name__,
+            'rows': len(rows),
+            'columns': hists.shape[1] if len(rows) else 0,
+            'encoding': index.hists.encoding,
+            'ids': _save_ids(directory, image_ids)}
+    _save_array(directory, 'hists.f32', hists, numpy.float32)
+    _save_stats(directory, index.stats, meta)
+    if isinstance(index, InvertedIndex):
+        meta['recognized_visual_words'] = len(index.postings)
+        meta['cutoff'] = index.cutoff
+        meta['prune_depth'] = index.prune_depth
+        meta['max_posting_length'] = index.max_posting_length
+        _save_postings(directory, index.postings, rows, len(index.hists))
+    with open(os.path.join(directory, 'meta.json'), 'w') as file:
+        json.dump(meta, file, indent=2)
+
+
+def _check_savable(index):
+    if type(index) not in (ForwardIndex, InvertedIndex, ConcurrentIndex, SegmentedIndex):
+        raise TypeError('Cannot save {}, only ForwardIndex, InvertedIndex, ConcurrentIndex or SegmentedIndex'
+                        .format(type(index).__name__))
+    if isinstance(index, ConcurrentIndex):
+        for segment_index, tombstones in index.snapshot.segments:
+            _check_savable(segment_index)
+
+
+def open_index(directory, ranker, mmap_mode='c', index_factory=None):
+    """Opens index saved with save_index. With mmap_mode 'r' the index is read-only.
+    index_factory of ConcurrentIndex or SegmentedIndex defaults to one creating indexes like its first segment.
+    """
+    meta_path = os.path.join(directory, 'meta.json')
+    try:
+        with open(meta_path) as file:
+            meta = json.load(file)
+    except (OSError, ValueError) as error:
+        raise IndexFormatError(directory, error)
+    if meta.get('format') != FORMAT:
+        raise IndexFormatError(directory, 'not a vse index')
+    if meta.get('version') != VERSION:
+        raise IndexFormatError(directory, 'unsupported version {}'.format(meta.get('version')))
+
+    if meta['type'] in ('ConcurrentIndex', 'SegmentedIndex'):
+        return _open_segments(directory, meta, ranker, mmap_mode, index_factory)
+    rows, columns = meta['rows'], meta['columns']
+    encoding = meta.get('encoding', 'float32')
+    if meta['type'] == 'ForwardIndex':
+        index = ForwardIndex(ranker, encoding)
+    elif meta['type'] == 'InvertedIndex':
+        recognized_visual_words = meta['recognized_visual_words']
+        index = InvertedIndex(ranker, recognized_visual_words, meta['cutoff'] * recognized_visual_words, encoding)
+        index.cutoff = meta['cutoff']
+        index.prune_depth = meta.get('prune_depth')
+        index.max_posting_length = meta.get('max_posting_length')
+        index.postings = _open_postings(directory, recognized_visual_words, mmap_mode)
+    else:
+        raise IndexFormatError(directory, 'unknown index type {}'.format(meta['type']))
+    if rows and encoding == 'float32':
+        index.hists.data = _open_array(directory, 'hists.f32', numpy.float32, (rows, columns), mmap_mode)
+        index.hists.size = rows
+        index.hists.columns = columns
+    elif rows:
+        for hist in _open_array(directory, 'hists.f32', numpy.float32, (rows, columns), 'r'):
+            index.hists.append(hist)
+    index.ids = IdTable(_open_ids(directory, meta['ids'], rows, mmap_mode), rows)
+    _open_stats(directory, meta, index.stats, mmap_mode)
+    return index
+
+
+def convert_pickled_index(filename, directory):
+    """Converts index pickled with vse.utils.save, also by older vse versions, to the on-disk format."""
+    index = load(filename)
+    save_index(index, directory)
+    return index
+
+
+def _save_stats(directory, stats, meta):
+    meta['image_count'] = stats.image_count
+    if stats.doc_freq is not None:
+        _save_array(directory, 'doc_freq.i64', stats.doc_freq, numpy.int64)
+        _save_array(directory, 'term_mass.f64', stats.term_mass, numpy.float64)
+        meta['recognized_visual_words'] = len(stats.doc_freq)
+
+
+def _open_stats(directory, meta, stats, mmap_mode):
+    if 'recognized_visual_words' in meta and os.path.exists(os.path.join(directory, 'doc_freq.i64')):
+        words = meta['recognized_visual_words']
+        stats.doc_freq = numpy.array(_open_array(directory, 'doc_freq.i64', numpy.int64, (words,), mmap_mode))
+        stats.term_mass = numpy.array(_open_array(directory, 'term_mass.f64', numpy.float64, (words,), mmap_mode))
+        stats.image_count = meta['image_count']
+        stats._invalidate()
+
+
+def _save_segments(index, directory):
+    with index.write_lock:
+        snapshot = index.snapshot
+        segments = list(snapshot.segments)
+        if len(snapshot.delta):
+            segments.append(Segment(snapshot.delta, frozenset()))
+        meta = {'format': FORMAT,
+                'version': VERSION,
+                'type': type(index).__name__,
+                'merge_threshold': index.merge_threshold,
+                'segments': []}
+        if isinstance(index, SegmentedIndex):
+            meta['merge_factor'] = index.merge_factor
+        for number, (segment_index, tombstones) in enumerate(segments):
+            name = 'segment-{:04d}'.format(number)
+            save_index(segment_index, os.path.join(directory, name))
+            meta['segments'].append({'directory': name, 'tombstones': sorted(tombstones)})
+        _save_stats(directory, index.stats, meta)
+    with open(os.path.join(directory, 'meta.json'), 'w') as file:
+        json.dump(meta, file, indent=2)
+
+
+def _open_segments(directory, meta, ranker, mmap_mode, index_factory):
+    segments = tuple(Segment(open_index(os.path.join(directory, entry['directory']), ranker, mmap_mode),
+                             frozenset(entry['tombstones'])) for entry in meta['segments'])
+    if index_factory is None:
+        index_factory = _segment_factory(segments[0].index) if segments else ForwardIndex
+    if meta['type'] == 'SegmentedIndex':
+        index = SegmentedIndex(ranker, index_factory, meta['merge_threshold'], meta['merge_factor'])
+    else:
+        index = ConcurrentIndex(ranker, index_factory, meta['merge_threshold'])
+    _open_stats(directory, meta, index.stats, mmap_mode)
+    index.snapshot = Snapshot(segments, ForwardIndex(ranker), index.stats.vw_freq())
+    return index
+
+
+def _segment_factory(index):
+    if isinstance(index, InvertedIndex):
+        recognized_visual_words = len(index.postings)
+        return functools.partial(InvertedIndex, recognized_visual_words=recognized_visual_words,
+                                 cutoff=index.cutoff * recognized_visual_words, encoding=index.hists.encoding,
+                                 prune_depth=index.prune_depth, max_posting_length=index.max_posting_length)
+    return functools.partial(ForwardIndex, encoding=index.hists.encoding)
+
+
+def _save_array(directory, name, array, dtype):
+    numpy.ascontiguousarray(array, dtype=dtype).tofile(os.path.join(directory, name))
+
+
+def _open_array(directory, name, dtype, shape, mmap_mode):
+    if numpy.prod(shape) == 0:
+        return numpy.zeros(shape, dtype=dtype)
+    return numpy.memmap(os.path.join(directory, name), dtype=dtype, mode=mmap_mode, shape=shape)
+
+
+def _save_ids(directory, image_ids):
+    if all(isinstance(image_id, int) and not isinstance(image_id, bool) for image_id in image_ids):
+        _save_array(directory, 'ids.i64', image_ids, numpy.int64)
+        return 'int'
+    if all(isinstance(image_id, str) for image_id in image_ids):
+        encoded = [image_id.encode('utf-8') for image_id in image_ids]
+        offsets = numpy.zeros(len(encoded) + 1, dtype=numpy.int64)
+        numpy.cumsum([len(image_id) for image_id in encoded], out=offsets[1:])
+        with open(os.path.join(directory, 'ids.bytes'), 'wb') as file:
+            file.write(b''.join(encoded))
+        _save_array(directory, 'ids.offsets.i64', offsets, numpy.int64)
+        return 'str'
+    raise TypeError('Only int or str image ids can be saved')
+
+
+def _open_ids(directory, kind, rows, mmap_mode):
+    if kind == 'int':
+        return IntIds(_open_array(directory, 'ids.i64', numpy.int64, (rows,), mmap_mode))
+    offsets = _open_array(directory, 'ids.offsets.i64', numpy.int64, (rows + 1,), mmap_mode)
+    return StrIds(_open_array(directory, 'ids.bytes', numpy.uint8, (int(offsets[-1]),), mmap_mode), offsets)
+
+
+def _save_postings(directory, postings, rows, capacity):
+    renumber = numpy.full(capacity, -1, dtype=numpy.int64)
+    renumber[rows] = numpy.arange(len(rows))
+    offsets = numpy.zeros(len(postings) + 1, dtype=numpy.int64)
+    numpy.cumsum([len(posting_list) for posting_list in postings], out=offsets[1:])
+    docs = [renumber[posting_list.docs()] for posting_list in postings]
+    weights = [posting_list.weights() for posting_list in postings]
+    _save_array(directory, 'postings.docs.i64', numpy.concatenate(docs), numpy.int64)
+    _save_array(directory, 'postings.weights.f32', numpy.concatenate(weights), numpy.float32)
+    _save_array(directory, 'postings.offsets.i64', offsets, numpy.int64)
+
+
+def _open_postings(directory, recognized_visual_words, mmap_mode):
+    offsets = numpy.fromfile(os.path.join(directory, 'postings.offsets.i64'), dtype=numpy.int64)
+    docs = _open_array(directory, 'postings.docs.i64', numpy.int64, (int(offsets[-1]),), mmap_mode)
+    weights = _open_array(directory, 'postings.weights.f32', numpy.float32, (int(offsets[-1]),), mmap_mode)
+    postings = []
+    for word in range(recognized_visual_words):
+        posting_list = PostingList()
+        posting_list.doc_array = docs[offsets[word]:offsets[word + 1]]
+        posting_list.weight_array = weights[offsets[word]:offsets[word + 1]]
+        posting_list.size = len(posting_list.doc_array)
+        postings.append(posting_list)
+    return postings
+
+
+class IntIds:
+    """Read-only sequence of integer image ids stored in an array."""
+
+    def __init__(self, array):
+        self.array = array
+
+    def __getitem__(self, row):
+        return int(self.array[row])
+
+    def __iter__(self):
+        return iter(self.array.tolist())
+
+    def __len__(self):
+        return len(self.array)
+
+
+class StrIds:
+    """Read-only sequence of string image ids stored as concatenated utf-8 bytes and offsets."""
+
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+
+    def __getitem__(self, row):
+        if row < 0:
+            row += len(self)
+        return bytes(self.data[self.offsets[row]:self.offsets[row + 1]]).decode('utf-8')
+
+    def __iter__(self):
+        data = bytes(self.data)
+        offsets = self.offsets.tolist()
+        return (data[start:end].decode('utf-8') for start, end in zip(offsets, offsets[1:]))
+
+    def __len__(self):
+        return len(self.offsets) - 1
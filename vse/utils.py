@@ -1,3 +1,5 @@
+import collections
+import concurrent.futures
 import errno
 import shutil
 
@@ -5,28 +7,91 @@ import cv2
 import numpy
 import pickle
 
+from vse import instrument
 from vse.error import *
 
 IMAGE_MAX_SIZE = 1000
 IMAGE_MIN_SIZE = 150
 
 
-def load_image(filename):
-    """Reads an image from file. Image is being converted to grayscale and resized."""
-    image = cv2.imread(filename, cv2.IMREAD_GRAYSCALE)
+def load_image(filename, reduced=False):
+    """Reads an image from file. Image is being converted to grayscale and resized.
+    If reduced is True, large JPEG images are decoded at reduced resolution, see load_image_from_buf.
+    """
+    if reduced:
+        try:
+            with open(filename, 'rb') as file:
+                buf = file.read()
+        except OSError:
+            raise ImageLoaderError(filename)
+        with instrument.timed('decode'):
+            image = _decode(buf)
+    else:
+        with instrument.timed('decode'):
+            image = cv2.imread(filename, cv2.IMREAD_GRAYSCALE)
     if image is None:
         raise ImageLoaderError(filename)
-    return convert_image(image)
+    with instrument.timed('resize'):
+        return convert_image(image)
 
 
-def load_image_from_buf(buf):
-    """Reads an image from a buffer in memory. Image is being converted to grayscale and resized."""
-    if len(buf) == 0:
+def load_image_from_buf(buf, reduced=False):
+    """Reads an image from a buffer in memory (bytes, memoryview, numpy array), without copying it.
+    Image is being converted to grayscale and resized. If reduced is True, JPEG images larger than
+    IMAGE_MAX_SIZE are decoded at 1/2, 1/4 or 1/8 of their resolution, but not below IMAGE_MAX_SIZE.
+    """
+    if memoryview(buf).nbytes == 0:
         raise ImageLoaderError()
-    image = cv2.imdecode(numpy.frombuffer(buf, numpy.uint8), cv2.IMREAD_GRAYSCALE)
+    with instrument.timed('decode'):
+        image = _decode(buf) if reduced else cv2.imdecode(numpy.frombuffer(buf, numpy.uint8), cv2.IMREAD_GRAYSCALE)
     if image is None:
         raise ImageLoaderError()
-    return convert_image(image)
+    with instrument.timed('resize'):
+        return convert_image(image)
+
+
+def _decode(buf):
+    data = numpy.frombuffer(buf, numpy.uint8)
+    size = jpeg_size(data)
+    flag = reduced_decode_flag(*size) if size else cv2.IMREAD_GRAYSCALE
+    return cv2.imdecode(data, flag)
+
+
+def jpeg_size(data):
+    """Returns (width, height) read from JPEG header or None if data is not a JPEG image."""
+    data = numpy.frombuffer(data, numpy.uint8)
+    if len(data) < 4 or data[0] != 0xFF or data[1] != 0xD8:
+        return None
+    position = 2
+    while position + 9 < len(data):
+        if data[position] != 0xFF:
+            return None
+        marker = data[position + 1]
+        if marker == 0xFF:
+            position += 1
+            continue
+        if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:
+            position += 2
+            continue
+        length = (int(data[position + 2]) << 8) + int(data[position + 3])
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height = (int(data[position + 5]) << 8) + int(data[position + 6])
+            width = (int(data[position + 7]) << 8) + int(data[position + 8])
+            return width, height
+        position += 2 + length
+    return None
+
+
+def reduced_decode_flag(width, height):
+    """Returns the strongest reduced grayscale imread flag, which keeps image larger than IMAGE_MAX_SIZE,
+    so that it is still resized and validated like the full resolution image.
+    """
+    for factor, flag in ((8, cv2.IMREAD_REDUCED_GRAYSCALE_8),
+                         (4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+                         (2, cv2.IMREAD_REDUCED_GRAYSCALE_2)):
+        if max(width, height) // factor > IMAGE_MAX_SIZE:
+            return flag
+    return cv2.IMREAD_GRAYSCALE
 
 
 def convert_image(image, filename=''):
@@ -48,6 +113,21 @@ def load_images(filenames):
         yield load_image(filename)
 
 
+def load_images_parallel(filenames, workers=4, reduced=True, prefetch=None):
+    """Image generator reading and decoding images in a pool of threads, OpenCV releases GIL while decoding.
+    Images are yielded in order of filenames, at most prefetch (default 2 * workers) are loaded ahead.
+    """
+    prefetch = prefetch or 2 * workers
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        pending = collections.deque()
+        for filename in filenames:
+            if len(pending) == prefetch:
+                yield pending.popleft().result()
+            pending.append(executor.submit(load_image, filename, reduced))
+        while pending:
+            yield pending.popleft().result()
+
+
 def rmdir_if_exist(dir_path):
     """Removes directory if exists. Raises exception if other than ENOENT."""
     try:
@@ -77,6 +157,19 @@ def save(filename, data, protocol=pickle.HIGHEST_PROTOCOL):
 
 
 def normalize(hist):
-    """Normalizes histogram by casting values to [0, 1]."""
-    total_sum = sum(hist)
-    return numpy.array([val / total_sum for val in hist], dtype=numpy.float32)
+    """Normalizes histogram by casting values to [0, 1]. Matrices are normalized row by row."""
+    hist = numpy.asarray(hist, dtype=numpy.float32)
+    total_sum = hist.sum(axis=-1, keepdims=True)
+    return numpy.divide(hist, total_sum, out=numpy.zeros_like(hist), where=total_sum != 0)
+
+
+def batches(iterable, batch_size):
+    """Yields lists of at most batch_size consecutive items of iterable."""
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
@@ -0,0 +1,130 @@
+"""Geometric verification
+
+Bag of visual words ignores where features are. Verification re-ranks the best results by the number of feature
+correspondences consistent with one geometric transformation between query and candidate image, estimated with
+RANSAC. Features assigned to the same visual word correspond, so only key point positions (rounded to pixels,
+uint16) and visual words (uint32) are kept for every indexed image, descriptors are not needed.
+"""
+
+import collections
+import concurrent.futures
+import time
+
+import cv2
+import numpy
+
+__all__ = ['Features',
+           'GeometricVerifier',
+           'image_features',
+           'correspondences',
+           ]
+
+Features = collections.namedtuple('Features', 'points words')
+
+
+def image_features(key_points, words):
+    """Returns Features of key points assigned to visual words."""
+    points = numpy.array([key_point.pt for key_point in key_points], dtype=numpy.float64).reshape(-1, 2)
+    return Features(numpy.clip(numpy.rint(points), 0, numpy.iinfo(numpy.uint16).max).astype(numpy.uint16),
+                    numpy.asarray(words, dtype=numpy.uint32))
+
+
+def correspondences(query, candidate, max_multiplicity=3):
+    """Returns positions of query and candidate features assigned to the same visual word as two (k, 2) arrays.
+    Words occurring more than max_multiplicity times in either image (repeated textures) are skipped.
+    """
+    query_order = numpy.argsort(query.words, kind='stable')
+    candidate_order = numpy.argsort(candidate.words, kind='stable')
+    query_words = query.words[query_order]
+    candidate_words = candidate.words[candidate_order]
+    common = numpy.intersect1d(query_words, candidate_words)
+    query_start = numpy.searchsorted(query_words, common, 'left')
+    query_end = numpy.searchsorted(query_words, common, 'right')
+    candidate_start = numpy.searchsorted(candidate_words, common, 'left')
+    candidate_end = numpy.searchsorted(candidate_words, common, 'right')
+    keep = (query_end - query_start <= max_multiplicity) & (candidate_end - candidate_start <= max_multiplicity)
+    query_points, candidate_points = [], []
+    for q_start, q_end, c_start, c_end in zip(query_start[keep], query_end[keep], candidate_start[keep],
+                                              candidate_end[keep]):
+        query_rows, candidate_rows = numpy.meshgrid(query_order[q_start:q_end], candidate_order[c_start:c_end])
+        query_points.append(query.points[query_rows.ravel()])
+        candidate_points.append(candidate.points[candidate_rows.ravel()])
+    if not query_points:
+        return numpy.empty((0, 2), dtype=numpy.float32), numpy.empty((0, 2), dtype=numpy.float32)
+    return (numpy.concatenate(query_points).astype(numpy.float32),
+            numpy.concatenate(candidate_points).astype(numpy.float32))
+
+
+class GeometricVerifier:
+    """Re-ranks top_k results by RANSAC inliers of a homography or fundamental matrix model.
+    Candidates are verified in a pool of worker threads. Those not verified within time_budget seconds,
+    without stored features or with less than min_inliers inliers keep their order after the verified ones.
+    features maps image id to Features, the engine fills it when images are indexed.
+    close (or leaving a with block) stops the worker threads.
+    """
+    HOMOGRAPHY = 'homography'
+    FUNDAMENTAL = 'fundamental'
+
+    def __init__(self, top_k=50, min_inliers=8, model=HOMOGRAPHY, reprojection_threshold=8.0, time_budget=0.1,
+                 workers=4, max_multiplicity=3):
+        if model not in (self.HOMOGRAPHY, self.FUNDAMENTAL):
+            raise ValueError('Unknown model {}'.format(model))
+        self.top_k = top_k
+        self.min_inliers = min_inliers
+        self.model = model
+        self.reprojection_threshold = reprojection_threshold
+        self.time_budget = time_budget
+        self.workers = workers
+        self.max_multiplicity = max_multiplicity
+        self.features = {}
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers)
+
+    def inliers(self, query, candidate):
+        """Returns number of correspondences consistent with the model estimated by RANSAC."""
+        query_points, candidate_points = correspondences(query, candidate, self.max_multiplicity)
+        if self.model == self.HOMOGRAPHY:
+            if len(query_points) < 4:
+                return 0
+            model, mask = cv2.findHomography(query_points, candidate_points, cv2.RANSAC, self.reprojection_threshold)
+        else:
+            if len(query_points) < 8:
+                return 0
+            model, mask = cv2.findFundamentalMat(query_points, candidate_points, cv2.FM_RANSAC,
+                                                 self.reprojection_threshold, 0.99)
+        if model is None or mask is None:
+            return 0
+        return int(numpy.count_nonzero(mask))
+
+    def verify(self, query, results):
+        """Returns results, list of (image_id, diff_ratio), with the top_k re-ranked by inliers."""
+        start = time.perf_counter()
+        candidates = results[:self.top_k]
+        futures = {self.executor.submit(self.inliers, query, self.features[image_id]): position
+                   for position, (image_id, _) in enumerate(candidates) if image_id in self.features}
+        done, not_done = concurrent.futures.wait(futures, max(self.time_budget - (time.perf_counter() - start), 0))
+        for future in not_done:
+            future.cancel()
+        inliers = {futures[future]: future.result() for future in done}
+        verified = sorted((position for position, count in inliers.items() if count >= self.min_inliers),
+                          key=lambda position: (-inliers[position], position))
+        rest = sorted(set(range(len(candidates))).difference(verified))
+        return [candidates[position] for position in verified + rest] + results[self.top_k:]
+
+    def close(self):
+        """Stops worker threads, cancelling pending verifications."""
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['executor']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.executor = concurrent.futures.ThreadPoolExecutor(self.workers)
@@ -0,0 +1,434 @@
+"""Visual words vocabularies trained from streams of image descriptors.
+Float descriptors are clustered with k-means, binary ones (ORB, BRISK, AKAZE) with k-majority.
+"""
+
+import collections
+import itertools
+import os
+import tempfile
+
+import cv2
+import numpy
+
+from vse.features import check_vocabulary_feature, extractor_feature, is_binary, save_vocabulary
+from vse.quantizer import Quantizer, BruteForceQuantizer, MatcherQuantizer, hamming_distances
+from vse.utils import load, save
+
+__all__ = ['VocabularyTree',
+           'MiniBatchKMeans',
+           'KMajority',
+           'kmajority',
+           'BatchMetrics',
+           'reservoir_sample',
+           'cluster_vocabulary_tree_from_img',
+           'cluster_vocabulary_tree_from_descriptors',
+           'cluster_vocabulary_from_img_stream',
+           'cluster_vocabulary_from_descriptor_stream',
+           ]
+
+BatchMetrics = collections.namedtuple('BatchMetrics', ['epoch', 'batch', 'descriptors', 'inertia', 'center_shift'])
+BatchMetrics.__doc__ = """Convergence metrics of a mini-batch: mean squared distance of batch descriptors
+to their centers before the update and mean squared shift of centers caused by the update."""
+
+
+class VocabularyTree(Quantizer):
+    """Hierarchical k-means vocabulary tree (Nister and Stewenius). Visual words are leaves of a complete tree
+    with branch_factor children per node, so a descriptor is quantized with branch_factor * depth comparisons.
+    Node centers are stored level by level in one array, children of node i at level l are nodes
+    i * branch_factor ... (i + 1) * branch_factor - 1 at level l + 1.
+    Trees cluster float descriptors, feature is the name of the feature (see vse.features) the tree was trained for.
+    """
+
+    def __init__(self, centers, branch_factor, depth, block_size=4096, feature=None):
+        self.centers = numpy.asarray(centers, dtype=numpy.float32)
+        self.branch_factor = branch_factor
+        self.depth = depth
+        self.block_size = block_size
+        self.feature = feature
+        self.offsets = numpy.cumsum([0] + [branch_factor ** level for level in range(1, depth + 1)])
+        if len(self.centers) != self.offsets[-1]:
+            raise ValueError('Expected {} centers, got {}'.format(self.offsets[-1], len(self.centers)))
+        Quantizer.__init__(self, self.centers[self.offsets[-2]:])
+
+    @classmethod
+    def train(cls, descriptors, branch_factor=10, depth=3, sample_size=None, attempts=1, iterations=20, seed=None):
+        """Trains tree from an iterable of descriptor arrays. If sample_size is given, the tree is trained
+        on a reservoir sample of sample_size descriptors, so the whole stream is never held in memory.
+        """
+        if sample_size is None:
+            sample = numpy.concatenate([numpy.asarray(desc, dtype=numpy.float32) for desc in descriptors])
+        else:
+            sample = reservoir_sample(descriptors, sample_size, seed)
+        criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, iterations, 1e-4)
+        if seed is not None:
+            cv2.setRNGSeed(seed)
+        levels = []
+        groups = [sample]
+        parents = [sample.mean(axis=0)]
+        for level in range(depth):
+            centers, next_groups = [], []
+            for group, parent in zip(groups, parents):
+                group_centers, labels = _split(group, parent, branch_factor, criteria, attempts)
+                centers.append(group_centers)
+                next_groups.extend(group[labels == child] for child in range(branch_factor))
+            levels.append(numpy.concatenate(centers))
+            groups, parents = next_groups, levels[-1]
+        return cls(numpy.concatenate(levels), branch_factor, depth)
+
+    def quantize(self, descriptors):
+        descriptors = numpy.asarray(descriptors, dtype=numpy.float32)
+        words = numpy.empty(len(descriptors), dtype=numpy.int64)
+        children = numpy.arange(self.branch_factor)
+        for start in range(0, len(descriptors), self.block_size):
+            block = descriptors[start:start + self.block_size]
+            nodes = numpy.zeros(len(block), dtype=numpy.int64)
+            for level in range(self.depth):
+                candidates = nodes[:, None] * self.branch_factor + children
+                centers = self.centers[self.offsets[level] + candidates]
+                diff = centers - block[:, None, :]
+                nodes = candidates[numpy.arange(len(block)), numpy.argmin(numpy.einsum('ijk,ijk->ij', diff, diff), axis=1)]
+            words[start:start + len(block)] = nodes
+        return words
+
+    def save(self, filename):
+        """Saves tree to numpy .npz file."""
+        tags = {} if self.feature is None else {'feature': self.feature}
+        with open(filename, 'wb') as file:
+            numpy.savez(file, centers=self.centers, branch_factor=self.branch_factor, depth=self.depth, **tags)
+
+    @classmethod
+    def load(cls, filename, feature=None):
+        """Loads tree saved with save. Raises VocabularyFeatureError if tree was not trained for feature."""
+        with numpy.load(filename) as data:
+            trained = str(data['feature']) if 'feature' in data else None
+            feature = check_vocabulary_feature(filename, trained, False, feature)
+            return cls(data['centers'], int(data['branch_factor']), int(data['depth']), feature=feature)
+
+
+class MiniBatchKMeans:
+    """Mini-batch k-means (Sculley) clustering descriptors streamed in batches of batch_size, so that memory
+    usage does not depend on the number of descriptors. If checkpoint filename is given, the state is saved
+    after every epoch (and every checkpoint_every batches) and restored on creation, so that interrupted
+    training resumes where it stopped. A checkpoint of another number of clusters or descriptor type raises ValueError.
+    """
+    dtype = numpy.float32
+
+    def __init__(self, clusters=1000, batch_size=10000, checkpoint='', checkpoint_every=None, seed=None):
+        if batch_size < clusters:
+            raise ValueError('batch_size must not be smaller than number of clusters')
+        self.clusters = clusters
+        self.batch_size = batch_size
+        self.checkpoint = checkpoint
+        self.checkpoint_every = checkpoint_every
+        self.seed = seed
+        self.centers = None
+        self.counts = numpy.zeros(clusters, dtype=numpy.int64)
+        self.epoch = 0
+        self.batch = 0
+        if checkpoint and os.path.exists(checkpoint):
+            self._restore(load(checkpoint))
+
+    def partial_fit(self, descriptors):
+        """Updates centers with a batch of descriptors. Returns BatchMetrics.
+        Raises ValueError if descriptors have other dimensionality than centers.
+        """
+        descriptors = numpy.asarray(descriptors, dtype=numpy.float32)
+        if self.centers is None:
+            self._init_centers(descriptors)
+        self._check_dimensionality(descriptors)
+        quantizer = BruteForceQuantizer(self.centers)
+        words = quantizer.quantize(descriptors)
+        inertia = float(numpy.mean(((descriptors - self.centers[words]) ** 2).sum(axis=1)))
+        batch_counts = numpy.bincount(words, minlength=self.clusters)
+        batch_sums = numpy.zeros_like(self.centers, dtype=numpy.float64)
+        numpy.add.at(batch_sums, words, descriptors)
+        self.counts += batch_counts
+        updated = batch_counts > 0
+        previous = self.centers[updated].copy()
+        self.centers[updated] += ((batch_sums[updated] - batch_counts[updated, None] * previous)
+                                  / self.counts[updated, None]).astype(numpy.float32)
+        shift = float(((self.centers[updated] - previous) ** 2).sum() / self.clusters)
+        self.batch += 1
+        return BatchMetrics(self.epoch, self.batch, len(descriptors), inertia, shift)
+
+    def fit(self, descriptors, epochs=1, callback=None):
+        """Clusters descriptors. Argument descriptors is an iterable of descriptor arrays, or a callable returning
+        a new such iterable for every epoch (required if epochs > 1). Batches done before interruption are skipped.
+        callback is called with BatchMetrics of every batch. Returns centers.
+        """
+        if not callable(descriptors) and epochs - self.epoch > 1:
+            raise ValueError('descriptors must be callable to train for more than one epoch')
+        while self.epoch < epochs:
+            stream = descriptors() if callable(descriptors) else descriptors
+            skip = self.batch
+            self.batch = 0
+            for batch in _rebatch(stream, self.batch_size, self.dtype):
+                if self.batch < skip:
+                    self.batch += 1
+                    continue
+                metrics = self.partial_fit(batch)
+                if callback:
+                    callback(metrics)
+                if self.checkpoint_every and self.batch % self.checkpoint_every == 0:
+                    self.save_checkpoint()
+            self.epoch += 1
+            self.batch = 0
+            self.save_checkpoint()
+        return self.centers
+
+    def save_checkpoint(self):
+        """Saves state to a temporary file next to checkpoint and renames it over checkpoint, so that an interrupted
+        save leaves the previous checkpoint intact.
+        """
+        if not self.checkpoint:
+            return
+        descriptor, temporary = tempfile.mkstemp(suffix='.tmp', prefix=os.path.basename(self.checkpoint) + '.',
+                                                 dir=os.path.dirname(os.path.abspath(self.checkpoint)))
+        os.close(descriptor)
+        try:
+            save(temporary, self._state())
+            os.replace(temporary, self.checkpoint)
+        except BaseException:
+            os.remove(temporary)
+            raise
+
+    def _state(self):
+        return {'centers': self.centers, 'counts': self.counts, 'epoch': self.epoch, 'batch': self.batch}
+
+    def _restore(self, state):
+        """Restores state saved by _state, checking that it belongs to clustering of the same kind."""
+        centers, counts = state['centers'], numpy.asarray(state['counts'], dtype=numpy.int64)
+        if counts.shape != (self.clusters,) or centers is not None and len(centers) != self.clusters:
+            raise ValueError('Checkpoint {} has {} clusters, not {}'.format(self.checkpoint, len(counts),
+                                                                            self.clusters))
+        if centers is not None and centers.dtype != self.dtype:
+            raise ValueError('Checkpoint {} has {} centers, not {}'.format(self.checkpoint, centers.dtype,
+                                                                         numpy.dtype(self.dtype)))
+        self.centers = centers
+        self.counts = counts
+        self.epoch = int(state['epoch'])
+        self.batch = int(state['batch'])
+
+    def _check_dimensionality(self, descriptors):
+        if descriptors.ndim != 2 or descriptors.shape[1] != self.centers.shape[1]:
+            raise ValueError('Descriptors of shape {} do not match centers of dimensionality {}'.format(
+                descriptors.shape, self.centers.shape[1]))
+
+    def _init_centers(self, descriptors):
+        if len(descriptors) < self.clusters:
+            raise ValueError('First batch must contain at least {} descriptors'.format(self.clusters))
+        if self.seed is not None:
+            cv2.setRNGSeed(self.seed)
+        criteria = (cv2.TERM_CRITERIA_MAX_ITER, 1, 0)
+        compactness, labels, centers = cv2.kmeans(descriptors, self.clusters, None, criteria, 1,
+                                                  cv2.KMEANS_PP_CENTERS)
+        self.centers = centers
+
+
+class KMajority(MiniBatchKMeans):
+    """Mini-batch k-majority (Grana et al.) clustering binary descriptors, bits packed in uint8 bytes, by Hamming
+    distance. Every center is the bitwise majority of all descriptors assigned to it so far, i.e. the running
+    mean of its bits rounded, as MiniBatchKMeans keeps running means. Centers are initialized with k-means++
+    seeding in the first batch. BatchMetrics report mean Hamming distance of batch descriptors
+    to their centers as inertia and mean number of bits changed per center as center_shift.
+    """
+    dtype = numpy.uint8
+
+    def __init__(self, clusters=1000, batch_size=10000, checkpoint='', checkpoint_every=None, seed=None):
+        self.bit_sums = None
+        MiniBatchKMeans.__init__(self, clusters, batch_size, checkpoint, checkpoint_every, seed)
+
+    def partial_fit(self, descriptors):
+        """Updates centers with a batch of descriptors. Returns BatchMetrics."""
+        descriptors = numpy.asarray(descriptors, dtype=numpy.uint8)
+        if self.centers is None:
+            self._init_centers(descriptors)
+        self._check_dimensionality(descriptors)
+        # cv2.BFMatcher is as fast as HammingQuantizer with NumPy 2 and several times faster with older NumPy
+        words = MatcherQuantizer(self.centers).quantize(descriptors)
+        inertia = float(numpy.mean(hamming_distances(descriptors, self.centers[words])))
+        batch_counts = numpy.bincount(words, minlength=self.clusters)
+        updated = batch_counts > 0
+        order = numpy.argsort(words, kind='stable')
+        starts = numpy.concatenate(([0], numpy.cumsum(batch_counts)[:-1]))[updated]
+        bits = numpy.unpackbits(descriptors[order], axis=1)
+        self.counts += batch_counts
+        self.bit_sums[updated] += numpy.add.reduceat(bits, starts, axis=0, dtype=numpy.int64)
+        previous = self.centers[updated]
+        self.centers[updated] = numpy.packbits(2 * self.bit_sums[updated] > self.counts[updated, None], axis=1)
+        shift = float(hamming_distances(self.centers[updated], previous).sum() / self.clusters)
+        self.batch += 1
+        return BatchMetrics(self.epoch, self.batch, len(descriptors), inertia, shift)
+
+    def _state(self):
+        state = MiniBatchKMeans._state(self)
+        state['bit_sums'] = self.bit_sums
+        return state
+
+    def _restore(self, state):
+        MiniBatchKMeans._restore(self, state)
+        bit_sums = state.get('bit_sums')
+        if self.centers is not None and (bit_sums is None or bit_sums.shape != (self.clusters,
+                                                                                8 * self.centers.shape[1])):
+            raise ValueError('Checkpoint {} has no bit sums of its centers'.format(self.checkpoint))
+        self.bit_sums = bit_sums
+
+    def _init_centers(self, descriptors):
+        if len(descriptors) < self.clusters:
+            raise ValueError('First batch must contain at least {} descriptors'.format(self.clusters))
+        self.centers = _kmeans_pp_centers(descriptors, self.clusters, numpy.random.RandomState(self.seed))
+        self.bit_sums = numpy.zeros((self.clusters, 8 * descriptors.shape[1]), dtype=numpy.int64)
+
+
+def _kmeans_pp_centers(descriptors, clusters, random):
+    """Returns clusters binary descriptors chosen with probability proportional to squared Hamming distance
+    to the nearest descriptor chosen before.
+    """
+    chosen = [random.randint(len(descriptors))]
+    distances = hamming_distances(descriptors, descriptors[chosen[0]][None, :]).astype(numpy.float64)
+    for i in range(1, clusters):
+        weights = distances ** 2
+        total = weights.sum()
+        if total > 0:
+            chosen.append(random.choice(len(descriptors), p=weights / total))
+        else:
+            chosen.append(random.randint(len(descriptors)))
+        distances = numpy.minimum(distances, hamming_distances(descriptors, descriptors[chosen[-1]][None, :]))
+    return descriptors[chosen]
+
+
+def kmajority(descriptors, clusters, iterations=20, seed=None):
+    """Clusters binary descriptors with k-majority: descriptors are assigned to the nearest centers by Hamming
+    distance and centers moved to the bitwise majority of their descriptors until no center changes.
+    Returns centers.
+    """
+    descriptors = numpy.asarray(descriptors, dtype=numpy.uint8)
+    clustering = KMajority(clusters, max(len(descriptors), clusters), seed=seed)
+    for iteration in range(iterations):
+        if clustering.centers is not None:
+            clustering.counts[:] = 0
+            clustering.bit_sums[:] = 0
+        if clustering.partial_fit(descriptors).center_shift == 0:
+            break
+    return clustering.centers
+
+
+def _clustering(recognized_visual_words, batch_size, checkpoint, feature, descriptors):
+    """Returns KMajority for binary features, MiniBatchKMeans otherwise, and descriptors to fit. Without feature
+    descriptors are binary if the first descriptor array is uint8.
+    """
+    if feature is not None:
+        binary = is_binary(feature)
+    else:
+        first, descriptors = _peek(descriptors)
+        binary = first is not None and numpy.asarray(first).dtype == numpy.uint8
+    clustering = KMajority if binary else MiniBatchKMeans
+    return clustering(recognized_visual_words, batch_size, checkpoint), descriptors
+
+
+def _peek(descriptors):
+    """Returns first non-empty descriptor array (None if there is none) and descriptors still yielding it."""
+    stream = descriptors() if callable(descriptors) else iter(descriptors)
+    first = next((desc for desc in stream if desc is not None and len(desc)), None)
+    if callable(descriptors) or first is None:
+        return first, descriptors if callable(descriptors) else stream
+    return first, itertools.chain([first], stream)
+
+
+def _rebatch(descriptors, batch_size, dtype=numpy.float32):
+    """Yields arrays of batch_size descriptors (the last one may be smaller) from iterable of descriptor arrays."""
+    pending, pending_size = [], 0
+    for desc in descriptors:
+        if desc is None or len(desc) == 0:
+            continue
+        pending.append(numpy.asarray(desc, dtype=dtype))
+        pending_size += len(desc)
+        while pending_size >= batch_size:
+            merged = numpy.concatenate(pending)
+            yield merged[:batch_size]
+            pending, pending_size = [merged[batch_size:]], pending_size - batch_size
+    if pending_size:
+        yield numpy.concatenate(pending)
+
+
+def _split(group, parent, branch_factor, criteria, attempts):
+    """Clusters group into branch_factor centers. Too small groups keep their points and parent center as centers."""
+    if len(group) < branch_factor:
+        centers = numpy.empty((branch_factor, len(parent)), dtype=numpy.float32)
+        centers[:len(group)] = group
+        centers[len(group):] = parent
+        return centers, numpy.arange(len(group))
+    compactness, labels, centers = cv2.kmeans(group, branch_factor, None, criteria, attempts, cv2.KMEANS_PP_CENTERS)
+    return centers, labels.ravel()
+
+
+def reservoir_sample(descriptors, size, seed=None):
+    """Returns uniform sample of at most size rows from an iterable of descriptor arrays."""
+    random = numpy.random.RandomState(seed)
+    sample = None
+    seen = 0
+    for desc in descriptors:
+        if desc is None or len(desc) == 0:
+            continue
+        desc = numpy.asarray(desc, dtype=numpy.float32)
+        if sample is None:
+            sample = numpy.empty((size, desc.shape[1]), dtype=numpy.float32)
+        fill = max(0, min(size - seen, len(desc)))
+        sample[seen:seen + fill] = desc[:fill]
+        rest = desc[fill:]
+        if len(rest):
+            slots = (random.random_sample(len(rest)) * (seen + fill + numpy.arange(1, len(rest) + 1))).astype(numpy.int64)
+            chosen = slots < size
+            sample[slots[chosen]] = rest[chosen]
+        seen += len(desc)
+    if sample is None:
+        raise ValueError('No descriptors to sample')
+    return sample[:min(seen, size)]
+
+
+def cluster_vocabulary_tree_from_img(images, extractor, branch_factor=10, depth=3, sample_size=None, filename=''):
+    """Trains vocabulary tree from images. Saves to file if filename given."""
+    descriptors = (extractor.detectAndCompute(image, None)[1] for image in images)
+    return cluster_vocabulary_tree_from_descriptors(descriptors, branch_factor, depth, sample_size, filename,
+                                                    extractor_feature(extractor))
+
+
+def cluster_vocabulary_tree_from_descriptors(descriptors, branch_factor=10, depth=3, sample_size=None, filename='',
+                                             feature=None):
+    """Trains vocabulary tree from iterable of images descriptors of feature. Saves to file if filename given."""
+    if feature is not None and is_binary(feature):
+        raise ValueError('Vocabulary trees cluster float descriptors, {} descriptors are binary'.format(feature))
+    tree = VocabularyTree.train(descriptors, branch_factor, depth, sample_size)
+    tree.feature = feature
+    if filename:
+        tree.save(filename)
+    return tree
+
+
+def cluster_vocabulary_from_img_stream(images, extractor, recognized_visual_words=1000, batch_size=10000, epochs=1,
+                                       checkpoint='', callback=None, filename=''):
+    """Generates visual words vocabulary from a stream of images with mini-batch k-means (k-majority for binary
+    descriptors), in constant memory. Argument images is an image generator (e.g. load_images) or a callable
+    returning one for every epoch. Saves to file, tagged with extractor feature, if filename given.
+    """
+
+    def descriptors():
+        stream = images() if callable(images) else images
+        return (extractor.detectAndCompute(image, None)[1] for image in stream)
+
+    stream = descriptors if callable(images) else descriptors()
+    return cluster_vocabulary_from_descriptor_stream(stream, recognized_visual_words, batch_size, epochs, checkpoint,
+                                                     callback, filename, extractor_feature(extractor))
+
+
+def cluster_vocabulary_from_descriptor_stream(descriptors, recognized_visual_words=1000, batch_size=10000, epochs=1,
+                                              checkpoint='', callback=None, filename='', feature=None):
+    """Generates visual words vocabulary from a stream of descriptor arrays of feature with mini-batch k-means,
+    or k-majority if they are binary (feature is binary or, without feature, descriptors are uint8). Saves to file,
+    tagged with feature if given, if filename given.
+    """
+    clustering, descriptors = _clustering(recognized_visual_words, batch_size, checkpoint, feature, descriptors)
+    vocabulary = clustering.fit(descriptors, epochs, callback)
+    if filename:
+        save_vocabulary(filename, vocabulary, feature)
+    return vocabulary